@@ -0,0 +1,99 @@
+"""Microbenchmark for the SQLite layer in vigil_beta.py.
+
+Runs the per-message DatabaseManager calls against a fresh database:
+opening a plain connection per call (db_pool_size=0, the old behaviour),
+through the WAL-mode connection pool, and through the pool with
+write-behind batching, and prints operations per second for each.
+
+    python db_benchmark.py --ops 2000 --threads 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Tuple
+
+# vigil_beta reads its configuration at import time
+WORKDIR = tempfile.mkdtemp(prefix='vigil_db_benchmark_')
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('TELEGRAM_TOKEN', '0:benchmark')
+os.environ.setdefault('GENERATION_BACKEND', 'standin')
+os.environ['DB_NAME'] = os.path.join(WORKDIR, 'import.db')
+sys.path.insert(0, SCRIPT_DIR)
+os.chdir(WORKDIR)
+
+import logging
+import vigil_beta
+
+logging.getLogger().setLevel(logging.WARNING)
+
+BOT_ID = 1
+
+def make_user(i: int):
+    return SimpleNamespace(id=1000 + i % 200, username=f'bench{i % 200}', first_name='Bench',
+                           last_name='User', language_code='en', is_premium=False)
+
+STATS_EVERY = 10  # one /stats per this many messages
+
+def one_message(db, i: int) -> int:
+    """The DB work behind a single AI reply; returns the number of calls made"""
+    user = make_user(i)
+    chat_id = 5000 + i % 50
+    db.register_user(user, BOT_ID)
+    # Force a real read instead of the in-memory history buffer
+    vigil_beta.history_buffer.invalidate((BOT_ID, chat_id))
+    db.get_chat_history(BOT_ID, chat_id)
+    db.save_message(BOT_ID, user.id, chat_id, f'question {i}', f'answer {i} ' * 20,
+                    tokens_used=120, processing_time=0.5)
+    if i % STATS_EVERY == 0:
+        db.get_user_stats(BOT_ID, user.id)
+        return 4
+    return 3
+
+def run(db, messages: int, threads: int) -> Tuple[float, float]:
+    """Messages and database calls per second"""
+    started = time.perf_counter()
+    if threads == 1:
+        calls = sum(one_message(db, i) for i in range(messages))
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            calls = sum(executor.map(lambda i: one_message(db, i), range(messages)))
+    db.flush_all()
+    elapsed = time.perf_counter() - started
+    return messages / elapsed, calls / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SQLite connection and write strategies")
+    parser.add_argument('--ops', type=int, default=2000, help="messages to simulate per run")
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"{args.ops} messages (register_user, get_chat_history, save_message; "
+          f"get_user_stats every {STATS_EVERY})")
+    pool_size = vigil_beta.config.db_pool_size
+    modes = (
+        ('per-call connections', 0, False),
+        ('pooled WAL connections', pool_size, False),
+        ('pooled + write-behind', pool_size, True)
+    )
+    results = {}
+    for mode, (label, mode_pool_size, write_behind) in enumerate(modes):
+        for threads in sorted({1, args.threads}):
+            db_path = os.path.join(WORKDIR, f'bench_{mode}_{threads}.db')
+            db = vigil_beta.DatabaseManager(db_path, mode_pool_size, write_behind)
+            rate, ops_rate = run(db, args.ops, threads)
+            results[(mode, threads)] = rate
+            print(f"  {label:<24} {threads:>2} thread(s): {rate:8.0f} messages/s ({ops_rate:8.0f} ops/s)")
+            if db.pool:
+                db.pool.close_all()
+
+    for mode, (label, _, _) in enumerate(modes[1:], start=1):
+        for threads in sorted({1, args.threads}):
+            speedup = results[(mode, threads)] / results[(0, threads)]
+            print(f"Speedup of {label} with {threads} thread(s): {speedup:.1f}x")
+
+if __name__ == '__main__':
+    main()
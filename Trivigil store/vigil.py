@@ -6,6 +6,10 @@ import time
 import asyncio
 import html
 import re
+import json
+import hashlib
+import queue
+from collections import OrderedDict
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, render_template_string
@@ -23,6 +27,8 @@ import google.generativeai as genai
 import dotenv
 from telegram.error import InvalidToken  # Added import for token validation
 
+STARTUP_TIME = time.time()
+
 # Load environment variables - Load multiple times for reliability
 dotenv.load_dotenv()
 if not all([os.getenv('TELEGRAM_TOKEN'), os.getenv('GEMINI_API_KEY')]):
@@ -33,6 +39,14 @@ TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', 'secure_admin_token')
 DB_NAME = 'chatbot.db'
+DB_POOL_SIZE = 8  # Pooled SQLite connections
+DB_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-8192',  # 8 MB page cache per connection
+    'PRAGMA mmap_size=268435456'
+)
 LOG_FILE = 'chatbot.log'
 REQUEST_LIMIT = 3  # Max requests per user
 REQUEST_WINDOW = 30  # Seconds
@@ -41,6 +55,15 @@ FOOTER = '''\n\n
   Generated by @VigilAIRobot
 ╰─── ⋅ ⋅ ─── ✩ ─── ⋅ ⋅ ───╯'''  # Added footer
 MAX_MESSAGE_LENGTH = 4096  # Telegram message limit
+MAX_CONCURRENT_GENERATIONS = 8  # Max Gemini calls in flight
+GENERATION_TIMEOUT = 60  # Seconds per Gemini call
+MODEL_PROBE_FILE = 'model_probe.json'
+MODEL_PROBE_TTL = 6 * 3600  # Seconds before probing again at startup
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_TTL = 24 * 3600  # Seconds
+RESPONSE_CACHE_MAX_ENTRIES = 5000  # Rows kept in SQLite
+RESPONSE_CACHE_MEMORY_ENTRIES = 500  # In-memory LRU tier
+GENERATION_SETTINGS = {'temperature': 0.7, 'max_output_tokens': 1024}
 
 # Block reason constants (from genai.types.BlockReason)
 BLOCK_REASON_UNSPECIFIED = 0
@@ -85,21 +108,63 @@ genai.configure(api_key=GEMINI_API_KEY)
 # Try different models in order of preference
 model = None
 model_names = ['gemini-2.0-flash', 'gemini-1.0-pro', 'gemini-pro']
-for model_name in model_names:
+
+def probe_model(model_name):
+    """Return True if the model answers a tiny test prompt"""
     try:
-        model = genai.GenerativeModel(model_name)
-        # Test the model connection
-        model.generate_content("Test connection")
-        logger.info(f"Using model: {model_name}")
-        break
+        genai.GenerativeModel(model_name).generate_content(
+            "Test connection",
+            generation_config=genai.types.GenerationConfig(max_output_tokens=8)
+        )
+        return True
     except Exception as e:
         logger.warning(f"Model {model_name} failed: {e}")
-        continue
+        return False
+
+def probe_models():
+    """Probe all models at once and cache the preferred working one"""
+    with ThreadPoolExecutor(max_workers=len(model_names)) as executor:
+        results = list(executor.map(probe_model, model_names))
+    available = [name for name, ok in zip(model_names, results) if ok]
+    if available:
+        try:
+            with open(MODEL_PROBE_FILE, 'w') as f:
+                json.dump({'model_name': available[0], 'probed_at': time.time()}, f)
+        except OSError as e:
+            logger.warning(f"Could not save model probe cache: {e}")
+    return available
+
+def reprobe_models():
+    """Confirm the cached model in the background"""
+    global model
+    available = probe_models()
+    if available and available[0] != model.model_name.replace('models/', ''):
+        logger.warning(f"Switching to model {available[0]} after re-probe")
+        model = genai.GenerativeModel(available[0])
+
+init_start = time.time()
+try:
+    with open(MODEL_PROBE_FILE) as f:
+        cached_probe = json.load(f)
+    if time.time() - cached_probe['probed_at'] < MODEL_PROBE_TTL and cached_probe['model_name'] in model_names:
+        model = genai.GenerativeModel(cached_probe['model_name'])
+        logger.info(f"Using cached model: {cached_probe['model_name']}")
+        threading.Thread(target=reprobe_models, daemon=True).start()
+except (OSError, ValueError, KeyError):
+    pass
+
+if model is None:
+    available_models = probe_models()
+    if available_models:
+        model = genai.GenerativeModel(available_models[0])
+        logger.info(f"Using model: {available_models[0]}")
 
 if model is None:
     logger.error("All models failed to initialize. Exiting.")
     exit(1)
 
+logger.info(f"Model initialization took {time.time() - init_start:.2f}s")
+
 safety_settings = [
     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
     {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
@@ -107,9 +172,111 @@ safety_settings = [
     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
 ]
 
+# Generation pool - runs blocking Gemini calls off the event loop
+generation_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_GENERATIONS)
+generation_semaphore = None
+generation_stats = {'in_flight': 0, 'queued': 0, 'peak_queued': 0, 'completed': 0, 'timeouts': 0}
+
+def release_generation_slot():
+    generation_stats['in_flight'] -= 1
+    generation_semaphore.release()
+
+async def generate_content_async(question):
+    """Run model.generate_content in the pool with a bounded in-flight count and timeout"""
+    global generation_semaphore
+    if generation_semaphore is None:
+        generation_semaphore = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+    loop = asyncio.get_running_loop()
+    
+    generation_stats['queued'] += 1
+    generation_stats['peak_queued'] = max(generation_stats['peak_queued'], generation_stats['queued'])
+    try:
+        await generation_semaphore.acquire()
+    finally:
+        generation_stats['queued'] -= 1
+    generation_stats['in_flight'] += 1
+    
+    # Keep the slot until the worker finishes, even after a timeout
+    future = generation_executor.submit(
+        model.generate_content,
+        question,
+        safety_settings=safety_settings,
+        generation_config=genai.types.GenerationConfig(**GENERATION_SETTINGS)
+    )
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(release_generation_slot))
+    
+    try:
+        response = await asyncio.wait_for(asyncio.wrap_future(future), GENERATION_TIMEOUT)
+    except asyncio.TimeoutError:
+        generation_stats['timeouts'] += 1
+        raise
+    generation_stats['completed'] += 1
+    return response
+
+# Pooled SQLite connections, one per thread while checked out
+db_pool = queue.LifoQueue()
+db_pool_local = threading.local()
+db_pool_lock = threading.Lock()
+db_pool_owners = {}
+db_pool_stats = {'open': 0, 'checkouts': 0, 'waits': 0}
+
+class PooledConnection(sqlite3.Connection):
+    """close() hands the connection back to db_pool"""
+    def close(self):
+        release_connection(self)
+
+def get_connection():
+    held = getattr(db_pool_local, 'conn', None)
+    if held is not None:
+        db_pool_local.depth += 1
+        return held
+    try:
+        conn = db_pool.get_nowait()
+    except queue.Empty:
+        with db_pool_lock:
+            create = db_pool_stats['open'] < DB_POOL_SIZE
+            if create:
+                db_pool_stats['open'] += 1
+        if create:
+            conn = sqlite3.connect(DB_NAME, timeout=30, check_same_thread=False,
+                                   factory=PooledConnection, cached_statements=256)
+            for pragma in DB_PRAGMAS:
+                conn.execute(pragma)
+        else:
+            db_pool_stats['waits'] += 1
+            # Take back connections from threads that exited without closing them
+            with db_pool_lock:
+                for orphan in [c for c, t in db_pool_owners.items() if not t.is_alive()]:
+                    del db_pool_owners[orphan]
+                    orphan.rollback()
+                    db_pool.put(orphan)
+            try:
+                conn = db_pool.get(timeout=30)
+            except queue.Empty:
+                raise sqlite3.OperationalError("No database connection free after 30s")
+    with db_pool_lock:
+        db_pool_owners[conn] = threading.current_thread()
+    db_pool_local.conn = conn
+    db_pool_local.depth = 1
+    db_pool_stats['checkouts'] += 1
+    return conn
+
+def release_connection(conn):
+    if getattr(db_pool_local, 'conn', None) is conn:
+        db_pool_local.depth -= 1
+        if db_pool_local.depth:
+            return
+        db_pool_local.conn = None
+    with db_pool_lock:
+        if db_pool_owners.pop(conn, None) is None:
+            return
+    if conn.in_transaction:
+        conn.rollback()
+    db_pool.put(conn)
+
 # Database setup
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -139,6 +306,22 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    # vigil_beta.py keeps its own response_cache table, with another schema, in the same file
+    cursor.execute('PRAGMA table_info(response_cache)')
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'response' in columns and 'response_text' not in columns:
+        # Our cache from before the rename; it only holds cached replies
+        cursor.execute('DROP TABLE response_cache')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS simple_response_cache (
+            cache_key TEXT PRIMARY KEY,
+            prompt TEXT,
+            response TEXT,
+            created_at REAL,
+            last_hit REAL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_simple_response_cache_last_hit ON simple_response_cache(last_hit)')
     conn.commit()
     conn.close()
 
@@ -146,7 +329,7 @@ init_db()
 
 # User management
 def register_user(user_data):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     try:
         cursor.execute('''
@@ -166,7 +349,7 @@ def register_user(user_data):
 
 # Group management
 def register_group(group_id, title):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     try:
         cursor.execute('''
@@ -180,7 +363,7 @@ def register_group(group_id, title):
         conn.close()
 
 def save_message(user_id, message, response):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     try:
         cursor.execute('''
@@ -193,6 +376,80 @@ def save_message(user_id, message, response):
     finally:
         conn.close()
 
+# Response cache for repeated stateless questions
+response_cache_memory = OrderedDict()
+response_cache_lock = threading.Lock()  # cache lookups run in worker threads
+cache_stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'bypassed': 0}
+
+def response_cache_key(question):
+    """Key on the normalized question, model and generation settings"""
+    normalized = re.sub(r'\s+', ' ', question.lower()).strip().rstrip('?!. ')
+    payload = json.dumps([normalized, model.model_name, GENERATION_SETTINGS], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def remember_response(key, reply, created_at):
+    with response_cache_lock:
+        response_cache_memory[key] = (reply, created_at)
+        response_cache_memory.move_to_end(key)
+        while len(response_cache_memory) > RESPONSE_CACHE_MEMORY_ENTRIES:
+            response_cache_memory.popitem(last=False)
+
+def get_cached_response(key):
+    now = time.time()
+    with response_cache_lock:
+        entry = response_cache_memory.get(key)
+        if entry and now - entry[1] < RESPONSE_CACHE_TTL:
+            response_cache_memory.move_to_end(key)
+            cache_stats['memory_hits'] += 1
+            return entry[0]
+    
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            'SELECT response, created_at FROM simple_response_cache WHERE cache_key = ? AND created_at > ?',
+            (key, now - RESPONSE_CACHE_TTL)
+        )
+        row = cursor.fetchone()
+        if row:
+            cursor.execute('UPDATE simple_response_cache SET last_hit = ? WHERE cache_key = ?', (now, key))
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Database error: {e}")
+        row = None
+    finally:
+        conn.close()
+    
+    if row is None:
+        cache_stats['misses'] += 1
+        return None
+    cache_stats['db_hits'] += 1
+    remember_response(key, row[0], row[1])
+    return row[0]
+
+def save_cached_response(key, question, reply):
+    now = time.time()
+    remember_response(key, reply, now)
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            INSERT OR REPLACE INTO simple_response_cache (cache_key, prompt, response, created_at, last_hit)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (key, question, reply, now, now))
+        # Expire old entries and keep the table within its size limit
+        cursor.execute('DELETE FROM simple_response_cache WHERE created_at <= ?', (now - RESPONSE_CACHE_TTL,))
+        cursor.execute('''
+            DELETE FROM simple_response_cache WHERE cache_key IN (
+                SELECT cache_key FROM simple_response_cache ORDER BY last_hit DESC LIMIT -1 OFFSET ?
+            )
+        ''', (RESPONSE_CACHE_MAX_ENTRIES,))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Database error: {e}")
+    finally:
+        conn.close()
+
 # Rate limiting
 user_requests = {}
 def is_rate_limited(user_id):
@@ -227,6 +484,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "🤖 How to use this bot:\n\n"
         "/askai <your question> - Get AI response\n"
+        "/askai --fresh <your question> - Skip cached answers\n"
         "/reset - Reset conversation context\n"
         "/clearhistory - Delete your stored messages\n\n"
         "You can also mention me in groups: @VigilAIRobot <question>"
@@ -273,7 +531,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def ask_ai(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    question = ' '.join(context.args).strip()
+    args = list(context.args)
+    bypass_cache = bool(args) and args[0] == '--fresh'
+    if bypass_cache:
+        args = args[1:]
+    question = ' '.join(args).strip()
     
     if not question:
         await update.message.reply_text("Please provide a question after /askai command.")
@@ -296,7 +558,7 @@ async def ask_ai(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"Admin check error: {e}")
             return
     
-    await ai_response(update, context, question)
+    await ai_response(update, context, question, bypass_cache)
 
 def split_message(text, max_length=MAX_MESSAGE_LENGTH):
     """Split long messages into chunks that fit Telegram's limits"""
@@ -345,7 +607,8 @@ async def send_message_chunks(update, chunks):
                 # If Markdown fails, send as plain text
                 await update.message.reply_text(chunk)
 
-async def ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE, question: str):
+async def ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE, question: str,
+                      bypass_cache=False):
     user = update.effective_user
     
     # Check if model is initialized
@@ -368,41 +631,48 @@ async def ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE, questi
             action='typing'
         )
         
-        # Generate response
-        response = model.generate_content(
-            question,
-            safety_settings=safety_settings,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.7,
-                max_output_tokens=1024
-            )
-        )
-        
-        # Handle blocked responses
-        if response.prompt_feedback and response.prompt_feedback.block_reason != BLOCK_REASON_UNSPECIFIED:
-            reasons = {
-                BLOCK_REASON_SAFETY: "content safety policies",
-                BLOCK_REASON_OTHER: "unknown policies"
-            }
-            reason = reasons.get(response.prompt_feedback.block_reason, "safety policies")
-            reply = f"⚠️ Your request was blocked due to {reason}."
-            logger.warning(f"Blocked prompt from user {user.id}: {question}")
-        
-        # Handle blocked output
-        elif response.candidates and response.candidates[0].finish_reason == FINISH_REASON_SAFETY:
-            reply = "⚠️ The response was blocked due to safety concerns."
-            logger.warning(f"Blocked output for user {user.id}: {question}")
+        # Serve repeated questions from the cache
+        key = None
+        if RESPONSE_CACHE_ENABLED:
+            if bypass_cache:
+                cache_stats['bypassed'] += 1
+            else:
+                key = response_cache_key(question)
+        # SQLite lookups run in a worker thread to keep the event loop free
+        reply = await asyncio.to_thread(get_cached_response, key) if key else None
         
-        # Handle successful response
-        elif response.text:
-            # Add footer to successful responses
-            reply = response.text + FOOTER
-            logger.info(f"Response generated for user {user.id}")
-        
-        # Fallback for empty responses
-        else:
-            reply = "⚠️ I couldn't generate a response for that query."
-            logger.error(f"Empty response for user {user.id}: {question}")
+        if reply is None:
+            # Generate response
+            response = await generate_content_async(question)
+            
+            # Handle blocked responses
+            if response.prompt_feedback and response.prompt_feedback.block_reason != BLOCK_REASON_UNSPECIFIED:
+                reasons = {
+                    BLOCK_REASON_SAFETY: "content safety policies",
+                    BLOCK_REASON_OTHER: "unknown policies"
+                }
+                reason = reasons.get(response.prompt_feedback.block_reason, "safety policies")
+                reply = f"⚠️ Your request was blocked due to {reason}."
+                logger.warning(f"Blocked prompt from user {user.id}: {question}")
+            
+            # Handle blocked output
+            elif response.candidates and response.candidates[0].finish_reason == FINISH_REASON_SAFETY:
+                reply = "⚠️ The response was blocked due to safety concerns."
+                logger.warning(f"Blocked output for user {user.id}: {question}")
+            
+            # Handle successful response
+            elif response.text:
+                # Add footer to successful responses
+                reply = response.text + FOOTER
+                logger.info(f"Response generated for user {user.id}")
+            
+            # Fallback for empty responses
+            else:
+                reply = "⚠️ I couldn't generate a response for that query."
+                logger.error(f"Empty response for user {user.id}: {question}")
+            
+            if key and not reply.startswith("⚠️"):
+                await asyncio.to_thread(save_cached_response, key, question, reply)
         
         # Split long messages into chunks
         chunks = split_message(reply)
@@ -413,6 +683,9 @@ async def ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE, questi
         # Save to DB
         save_message(user.id, question, reply)
         
+    except asyncio.TimeoutError:
+        logger.error(f"Gemini timed out after {GENERATION_TIMEOUT}s for user {user.id}")
+        await update.message.reply_text("⚠️ The AI took too long to respond. Please try again.")
     except Exception as e:
         logger.error(f"Gemini error: {e}", exc_info=True)
         await update.message.reply_text("⚠️ Sorry, I encountered an error processing your request.")
@@ -423,7 +696,7 @@ async def reset_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     try:
         cursor.execute('DELETE FROM messages WHERE user_id = ?', (user.id,))
@@ -448,9 +721,15 @@ async def post_init(application: Application):
         logger.info("Bot commands set successfully")
     except Exception as e:
         logger.error(f"Error setting bot commands: {e}")
+    logger.info(f"Startup completed in {time.time() - STARTUP_TIME:.2f}s")
 
 # Flask Admin Interface
 app = Flask(__name__)
+app.jinja_env.globals.update(
+    generation_stats=generation_stats,
+    max_generations=MAX_CONCURRENT_GENERATIONS,
+    cache_stats=cache_stats
+)
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -480,6 +759,12 @@ HTML_TEMPLATE = """
                 <p>Users Registered: {{ user_count }}</p>
                 <p>Groups Registered: {{ group_count }}</p>
                 <p>Messages Processed: {{ message_count }}</p>
+                <p>Generations In Flight: {{ generation_stats.in_flight }}/{{ max_generations }}
+                   (queued: {{ generation_stats.queued }}, peak: {{ generation_stats.peak_queued }},
+                   timeouts: {{ generation_stats.timeouts }})</p>
+                <p>Response Cache: {{ cache_stats.memory_hits + cache_stats.db_hits }} hits
+                   ({{ cache_stats.memory_hits }} memory, {{ cache_stats.db_hits }} db),
+                   {{ cache_stats.misses }} misses, {{ cache_stats.bypassed }} bypassed</p>
             </div>
         </div>
 
@@ -521,7 +806,7 @@ HTML_TEMPLATE = """
 
 @app.route('/')
 def home():
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute('SELECT COUNT(*) FROM users')
@@ -600,7 +885,7 @@ def broadcast():
             broadcast_error="Message cannot be empty"
         )
     
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT user_id FROM users')
     user_ids = [row[0] for row in cursor.fetchall()]
@@ -626,7 +911,7 @@ def broadcast():
         result = f"Broadcast sent to {success} users. Failed: {failures}"
         
         # Get updated stats
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute('SELECT COUNT(*) FROM users')
         user_count = cursor.fetchone()[0]
@@ -700,6 +985,7 @@ def main():
     application = Application.builder() \
         .token(TELEGRAM_TOKEN) \
         .post_init(post_init) \
+        .concurrent_updates(True) \
         .build()
 
     # Add handlers with lowercase commands
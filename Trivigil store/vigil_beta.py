@@ -7,14 +7,24 @@ import asyncio
 import html
 import re
 import json
+import queue
 import hashlib
+import heapq
 import secrets
+import signal
+import math
+import unicodedata
+import random
+import sys
+import atexit
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional, Tuple
-from dataclasses import dataclass
-from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from contextlib import asynccontextmanager, nullcontext
 from pathlib import Path
+from types import SimpleNamespace
 
 from flask import Flask, request, render_template_string, jsonify, session, redirect
 from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup
@@ -29,10 +39,20 @@ from telegram.ext import (
     CallbackQueryHandler
 )
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
 import dotenv
-from telegram.error import InvalidToken, BadRequest, Forbidden, TimedOut
+from telegram.error import (
+    InvalidToken, BadRequest, Forbidden, TimedOut, RetryAfter, NetworkError, TelegramError
+)
 from werkzeug.security import generate_password_hash, check_password_hash
 
+try:
+    import numpy as np
+except ImportError:  # only needed for the semantic cache
+    np = None
+
+STARTUP_TIME = time.time()
+
 # Load environment variables
 dotenv.load_dotenv()
 if not all([os.getenv('TELEGRAM_TOKEN'), os.getenv('GEMINI_API_KEY')]):
@@ -44,7 +64,19 @@ class BotConfig:
     telegram_token: str
     gemini_api_key: str
     admin_token: str
+    telegram_tokens: List[str] = field(default_factory=list)  # every bot this process hosts
+    gemini_api_keys: List[str] = field(default_factory=list)  # extra keys spread the quota
     db_name: str = 'chatbot.db'
+    db_pool_size: int = 16  # pooled SQLite connections, 0 opens one per call
+    db_cache_kb: int = 16 * 1024  # page cache per connection
+    db_mmap_bytes: int = 256 * 1024 * 1024
+    db_cached_statements: int = 256  # prepared statements kept per connection
+    db_async_workers: int = 8  # threads running database calls for the bot handlers
+    write_behind_enabled: bool = True  # batch message/user writes; the last interval is lost on a crash
+    write_behind_interval_ms: int = 200
+    write_behind_batch_rows: int = 200  # flush early once this many rows are waiting
+    write_behind_max_pending: int = 5000  # writers flush themselves beyond this
+    activity_flush_interval: int = 30  # seconds between last_active / last_activity writes
     log_file: str = 'chatbot.log'
     request_limit: int = 5
     request_window: int = 60
@@ -54,15 +86,131 @@ class BotConfig:
     flask_port: int = 5000
     flask_host: str = '0.0.0.0'
     backup_interval: int = 3600  # 1 hour
+    analytics_rollup_interval: int = 60  # seconds between daily analytics rollups
+    analytics_rollup_batch: int = 5000  # messages folded per rollup transaction
     log_retention_days: int = 7
+    max_concurrent_generations: int = 8
+    generation_timeout: int = 60  # seconds per Gemini call
+    max_concurrent_updates: int = 64
+    model_probe_file: str = 'model_probe.json'
+    model_probe_ttl: int = 6 * 3600  # re-probe from scratch after 6 hours
+    response_cache_enabled: bool = True
+    response_cache_ttl: int = 24 * 3600
+    response_cache_max_entries: int = 5000  # rows kept in SQLite
+    response_cache_memory_entries: int = 500  # in-memory LRU tier
+    semantic_cache_enabled: bool = False
+    semantic_cache_backend: str = 'gemini'  # 'gemini' or 'hashing' (offline stand-in)
+    semantic_cache_threshold: float = 0.92  # minimum cosine similarity for a hit
+    semantic_cache_dir: str = 'semantic_cache'
+    semantic_cache_max_entries: int = 10000
+    summary_trigger_turns: int = 20  # unsummarized turns before compaction
+    summary_trigger_tokens: int = 4000  # or unsummarized tokens before compaction
+    summary_keep_recent: int = 8  # turns always kept verbatim
+    summary_max_turns_per_pass: int = 40  # oldest turns folded per compaction
+    summary_max_tokens_per_pass: int = 8000  # and at most this many transcript tokens
+    summary_retry_backoff: int = 60  # seconds before retrying a failed compaction, doubling per failure
+    history_buffer_max_bytes: int = 32 * 1024 * 1024  # in-memory history across all chats
+    router_short_prompt_chars: int = 280  # prompts up to this length go to the fastest flash model
+    circuit_breaker_threshold: int = 3  # consecutive 429/5xx errors before a model is skipped
+    circuit_breaker_cooldown: int = 60  # seconds before a skipped model is tried again
+    key_rpm_limit: int = 60  # per-key requests per minute, 0 disables; defaults to the admission limit
+    key_tpm_limit: int = 4_000_000  # per-key tokens per minute, 0 disables; defaults to the admission limit
+    key_cooldown: int = 60  # seconds a key rests for a model after a 429 that gives no retry delay
+    admission_rpm_limit: int = 60  # project-wide requests per minute, 0 disables
+    admission_tpm_limit: int = 4_000_000  # project-wide tokens per minute, 0 disables
+    admission_burst_seconds: float = 10.0  # bucket size, in seconds of quota
+    admission_max_wait: float = 10.0  # longer waits shed the request instead
+    context_cache_enabled: bool = True  # needs google-generativeai >= 0.7 or the stand-in
+    context_cache_min_tokens: int = 4096  # API minimum is model dependent (1024-32768)
+    context_cache_ttl: int = 600  # seconds, renewed while the chat is active
+    context_cache_idle: int = 300  # delete a chat's cache after this long without use
+    generation_backend: str = 'gemini'  # 'gemini' or 'standin' (offline load testing)
+    standin_latency_median: float = 0.8  # seconds to first token
+    standin_latency_sigma: float = 0.5  # log-normal spread
+    standin_tokens_per_second: float = 60.0
+    standin_max_reply_words: int = 300
+    standin_error_rate: float = 0.0  # injected 500s
+    standin_rate_limit_rate: float = 0.0  # injected 429s
+    standin_block_rate: float = 0.0  # safety-blocked prompts
+    standin_seed: Optional[int] = None
+    # USD per million (prompt, candidate) tokens, for cost estimates
+    model_pricing: Dict[str, Tuple[float, float]] = field(default_factory=lambda: {
+        'gemini-2.0-flash-exp': (0.0, 0.0),
+        'gemini-2.0-flash': (0.10, 0.40),
+        'gemini-1.5-pro': (1.25, 5.00),
+        'gemini-1.5-flash': (0.075, 0.30),
+        'gemini-1.0-pro': (0.50, 1.50)
+    })
+    superseded_request_policy: str = 'cancel_previous'  # or 'queue'
+    scheduler_max_depth: int = 200  # requests waiting for a generation slot
+    scheduler_max_wait: float = 30.0  # seconds before a waiting request gets the overload reply
+    # Share of generation slots per chat in each lane, relative to 'standard'
+    scheduler_lane_weights: Dict[str, float] = field(default_factory=lambda: {
+        'premium': 3.0,
+        'standard': 1.0
+    })
+    adaptive_generation: bool = True  # per-request output length and sampling
+    policy_deep_prompt_chars: int = 600  # private prompts this long get a bigger budget
+    policy_busy_queue_ratio: float = 0.5  # queued / pool size before outputs shrink
+    policy_overloaded_queue_ratio: float = 2.0
+    prefilter_enabled: bool = True  # reject hopeless prompts before calling Gemini
+    prefilter_deny_list_file: str = 'deny_list.txt'
+    prefilter_min_chars: int = 2  # letters or digits needed for a real question (CJK count double)
+    prefilter_max_chars: int = 4000
+    prefilter_max_char_run: int = 50  # same letter or digit repeated this many times, outside code
+    prefilter_max_word_share: float = 0.5  # one word making up most of the prompt
+    prefilter_max_links: int = 5
+    stream_responses: bool = True
+    stream_edit_interval: float = 1.0  # seconds between edits in private chats
+    stream_group_edit_interval: float = 3.0  # groups have a stricter edit limit
 
 # Initialize configuration
 config = BotConfig(
     telegram_token=os.getenv('TELEGRAM_TOKEN'),
     gemini_api_key=os.getenv('GEMINI_API_KEY'),
-    admin_token=os.getenv('ADMIN_TOKEN', secrets.token_urlsafe(32))
+    admin_token=os.getenv('ADMIN_TOKEN', secrets.token_urlsafe(32)),
+    db_name=os.getenv('DB_NAME', 'chatbot.db'),
+    generation_backend=os.getenv('GENERATION_BACKEND', 'gemini'),
+    admission_rpm_limit=int(os.getenv('ADMISSION_RPM_LIMIT', 60)),
+    admission_tpm_limit=int(os.getenv('ADMISSION_TPM_LIMIT', 4_000_000)),
+    key_rpm_limit=int(os.getenv('KEY_RPM_LIMIT', os.getenv('ADMISSION_RPM_LIMIT', 60))),
+    key_tpm_limit=int(os.getenv('KEY_TPM_LIMIT', os.getenv('ADMISSION_TPM_LIMIT', 4_000_000))),
+    standin_latency_median=float(os.getenv('STANDIN_LATENCY_MEDIAN', 0.8)),
+    standin_tokens_per_second=float(os.getenv('STANDIN_TOKENS_PER_SECOND', 60)),
+    standin_error_rate=float(os.getenv('STANDIN_ERROR_RATE', 0)),
+    standin_rate_limit_rate=float(os.getenv('STANDIN_RATE_LIMIT_RATE', 0)),
+    standin_block_rate=float(os.getenv('STANDIN_BLOCK_RATE', 0))
 )
 
+# GEMINI_API_KEYS (comma separated) adds keys to the pool after GEMINI_API_KEY
+config.gemini_api_keys = list(dict.fromkeys(
+    key.strip()
+    for key in [config.gemini_api_key or ''] + os.getenv('GEMINI_API_KEYS', '').split(',')
+    if key.strip()
+))
+config.gemini_api_key = config.gemini_api_key or next(iter(config.gemini_api_keys), None)
+
+# The stand-in has no real quota, so its admission and key budgets are off unless set explicitly
+if config.generation_backend == 'standin':
+    for name in ('admission_rpm_limit', 'admission_tpm_limit', 'key_rpm_limit', 'key_tpm_limit'):
+        if name.upper() not in os.environ:
+            setattr(config, name, 0)
+
+# TELEGRAM_TOKENS (comma separated) hosts more bots alongside TELEGRAM_TOKEN
+config.telegram_tokens = list(dict.fromkeys(
+    token.strip()
+    for token in [config.telegram_token or ''] + os.getenv('TELEGRAM_TOKENS', '').split(',')
+    if token.strip()
+))
+config.telegram_token = config.telegram_token or next(iter(config.telegram_tokens), None)
+
+def bot_id_from_token(token: str) -> int:
+    """Telegram bot tokens start with the bot's numeric id"""
+    return int(token.split(':', 1)[0])
+
+# Load tests drive the pipeline directly and don't need Telegram
+LOAD_TEST_MODE = '--loadtest' in sys.argv
+
 # Constants
 FOOTER = '''\n\n
 ╭─── ⋅ ⋅ ─── ✩ ─── ⋅ ⋅ ───╮
@@ -114,16 +262,1022 @@ logger = setup_logging()
 # Validate environment variables
 def validate_config():
     """Validate all required configuration"""
-    if not config.telegram_token or not config.gemini_api_key:
+    needs_telegram = not LOAD_TEST_MODE
+    needs_gemini = config.generation_backend == 'gemini'
+    if config.generation_backend not in ('gemini', 'standin'):
+        logger.error(f"CRITICAL: Unknown GENERATION_BACKEND '{config.generation_backend}'")
+        return False
+    if (needs_telegram and not config.telegram_token) or (needs_gemini and not config.gemini_api_key):
         logger.error("CRITICAL: Missing required environment variables!")
         logger.error(f"TELEGRAM_TOKEN: {'Set' if config.telegram_token else 'Missing'}")
         logger.error(f"GEMINI_API_KEY: {'Set' if config.gemini_api_key else 'Missing'}")
         return False
+    malformed = [token for token in config.telegram_tokens if not token.split(':', 1)[0].isdigit()]
+    if needs_telegram and malformed:
+        logger.error(f"CRITICAL: {len(malformed)} Telegram token(s) do not start with a bot id")
+        return False
     return True
 
 if not validate_config():
     exit(1)
 
+class GenerationTimeoutError(Exception):
+    """Raised when a Gemini call exceeds config.generation_timeout"""
+    pass
+
+class GenerationCancelledError(Exception):
+    """Raised in the worker thread to stop streaming a reply nobody is waiting for"""
+    pass
+
+class OverloadedError(Exception):
+    """Base for requests turned away to protect capacity; reason says why"""
+    component = 'overload'
+    
+    def __init__(self, reason: str):
+        super().__init__(f"{self.component} overloaded ({reason})")
+        self.reason = reason
+
+class SchedulerOverloadedError(OverloadedError):
+    """Raised when a request can't get a generation slot in time"""
+    component = 'scheduler'
+
+class AdmissionRejectedError(OverloadedError):
+    """Raised when the project-wide Gemini quota can't take a request in time"""
+    component = 'admission'
+
+class KeyPoolExhaustedError(OverloadedError):
+    """Raised when no API key has quota for a request in time"""
+    component = 'api_keys'
+
+# Bounded pool for blocking Gemini calls
+class GenerationPool:
+    """Run blocking Gemini calls on a dedicated executor so the event loop stays free"""
+    def __init__(self, max_in_flight: int, timeout: float):
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_in_flight,
+            thread_name_prefix='gemini'
+        )
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.queued = 0
+        self.peak_queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.total_queue_wait = 0.0
+    
+    def _release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+    
+    async def run(self, func, *args, **kwargs):
+        """Run func in the pool, waiting for a free slot and enforcing the timeout"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        loop = asyncio.get_running_loop()
+        
+        # Wait for a free slot
+        queued_at = time.time()
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.total_queue_wait += time.time() - queued_at
+        self.in_flight += 1
+        
+        # The slot is held until the worker thread actually finishes, even if
+        # the caller gives up on it, so timed-out calls can't pile up
+        future = self.executor.submit(func, *args, **kwargs)
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.warning(f"Gemini call timed out after {self.timeout}s")
+            raise GenerationTimeoutError(
+                f"The AI took longer than {self.timeout}s to respond. Please try again."
+            )
+        except Exception:
+            self.failed += 1
+            raise
+        
+        self.completed += 1
+        return result
+    
+    def get_stats(self) -> Dict:
+        """Current pool utilization and queue depth"""
+        started = self.completed + self.failed + self.timeouts + self.in_flight
+        return {
+            'max_in_flight': self.max_in_flight,
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'peak_queued': self.peak_queued,
+            'completed': self.completed,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'avg_queue_wait': round(self.total_queue_wait / max(1, started), 3)
+        }
+
+# Generation backends
+class GenerationBackend:
+    """Source of model objects for GeminiManager.
+    
+    Models must offer generate_content, start_chat and count_tokens with the
+    same call shapes as genai.GenerativeModel.
+    """
+    name = 'base'
+    
+    def configure(self):
+        pass
+    
+    def get_model(self, model_name: str, api_key: str = None):
+        """A model object, bound to api_key when given"""
+        raise NotImplementedError
+    
+    def supports_context_cache(self) -> bool:
+        return False
+    
+    def create_cached_content(self, model_name: str, contents: List, ttl: int):
+        """Cache contents server-side; returns a handle for model_from_cached_content"""
+        raise NotImplementedError
+    
+    def renew_cached_content(self, handle, ttl: int):
+        raise NotImplementedError
+    
+    def delete_cached_content(self, handle):
+        raise NotImplementedError
+    
+    def model_from_cached_content(self, handle):
+        raise NotImplementedError
+
+class GeminiBackend(GenerationBackend):
+    """The real Gemini API"""
+    name = 'gemini'
+    
+    def __init__(self):
+        self.clients: Dict[str, glm.GenerativeServiceClient] = {}
+    
+    def configure(self):
+        genai.configure(api_key=config.gemini_api_key)
+    
+    def get_model(self, model_name: str, api_key: str = None):
+        if not api_key:
+            return genai.GenerativeModel(model_name)
+        # One client per key so each key's quota is used independently
+        client = self.clients.get(api_key)
+        if client is None:
+            client = self.clients[api_key] = glm.GenerativeServiceClient(
+                client_options={'api_key': api_key}
+            )
+        return KeyedGeminiModel(model_name, client)
+    
+    def supports_context_cache(self) -> bool:
+        # Context caching arrived in google-generativeai 0.7
+        return hasattr(genai, 'caching')
+    
+    def create_cached_content(self, model_name: str, contents: List, ttl: int):
+        return genai.caching.CachedContent.create(
+            model=f'models/{model_name}',
+            contents=contents,
+            ttl=timedelta(seconds=ttl)
+        )
+    
+    def renew_cached_content(self, handle, ttl: int):
+        handle.update(ttl=timedelta(seconds=ttl))
+    
+    def delete_cached_content(self, handle):
+        handle.delete()
+    
+    def model_from_cached_content(self, handle):
+        return genai.GenerativeModel.from_cached_content(cached_content=handle)
+
+class KeyedGeminiChat:
+    def __init__(self, model, history: List):
+        self.model = model
+        self.history = history or []
+    
+    def send_message(self, content, **kwargs):
+        return self.model.generate_content(self.history + [content], **kwargs)
+
+class KeyedGeminiModel:
+    """genai.GenerativeModel stand-in that calls Gemini through a client bound to one API key.
+    
+    GenerativeModel always uses the globally configured key, so requests are
+    built here and sent with the public GenerativeServiceClient.
+    """
+    def __init__(self, model_name: str, client: glm.GenerativeServiceClient):
+        self.model_name = model_name if '/' in model_name else f'models/{model_name}'
+        self.client = client
+    
+    @staticmethod
+    def _contents(contents) -> List[glm.Content]:
+        if isinstance(contents, (str, dict)):
+            contents = [contents]
+        turns = []
+        for item in contents:
+            if isinstance(item, glm.Content):
+                turns.append(item)
+            elif isinstance(item, dict):
+                turns.append(glm.Content(
+                    role=item.get('role', 'user'),
+                    parts=[glm.Part(text=str(part)) for part in item.get('parts', [])]
+                ))
+            else:
+                turns.append(glm.Content(role='user', parts=[glm.Part(text=str(item))]))
+        return turns
+    
+    def generate_content(self, contents, safety_settings: List[Dict] = None,
+                         generation_config=None, stream: bool = False):
+        config_fields = {}
+        if generation_config is not None:
+            config_fields = {
+                name: value for name, value in vars(generation_config).items()
+                if value is not None and name in glm.GenerationConfig.meta.fields
+            }
+        request = glm.GenerateContentRequest(
+            model=self.model_name,
+            contents=self._contents(contents),
+            safety_settings=[glm.SafetySetting(**setting) for setting in safety_settings or []],
+            generation_config=glm.GenerationConfig(**config_fields)
+        )
+        if stream:
+            return genai.types.GenerateContentResponse.from_iterator(
+                self.client.stream_generate_content(request)
+            )
+        return genai.types.GenerateContentResponse.from_response(self.client.generate_content(request))
+    
+    def start_chat(self, history: List = None):
+        return KeyedGeminiChat(self, history)
+    
+    def count_tokens(self, contents):
+        return self.client.count_tokens(
+            glm.CountTokensRequest(model=self.model_name, contents=self._contents(contents))
+        )
+
+class StandInError(Exception):
+    """Injected API failure carrying an HTTP-style status code"""
+    def __init__(self, code: int, message: str, retry_after: float = None):
+        super().__init__(f"{code} {message}")
+        self.code = code
+        self.retry_after = retry_after
+
+class StandInResponse:
+    """Mimics the parts of GenerateContentResponse the bot reads"""
+    def __init__(self, text: str, prompt_tokens: int, block_reason: int = BLOCK_REASON_UNSPECIFIED,
+                 chunk_delays: List[float] = None, cached_tokens: int = 0):
+        self._text = text
+        self._chunk_delays = chunk_delays
+        self.prompt_feedback = SimpleNamespace(block_reason=block_reason)
+        self.candidates = [] if block_reason else [SimpleNamespace(finish_reason=1)]
+        output_tokens = 0 if block_reason else len(text.split())
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=output_tokens,
+            total_token_count=prompt_tokens + output_tokens,
+            cached_content_token_count=cached_tokens
+        )
+    
+    @property
+    def text(self) -> str:
+        if not self.candidates:
+            raise ValueError("The response was blocked and has no text")
+        return self._text
+    
+    def __iter__(self):
+        """Stream the reply a word at a time at the configured rate"""
+        if not self.candidates:
+            yield SimpleNamespace(text='')
+            return
+        words = self._text.split(' ')
+        for i, (word, delay) in enumerate(zip(words, self._chunk_delays)):
+            time.sleep(delay)
+            yield SimpleNamespace(text=word if i == 0 else ' ' + word)
+
+class StandInChat:
+    def __init__(self, model, history: List):
+        self.model = model
+        self.history = history or []
+    
+    def send_message(self, content, stream: bool = False, **kwargs):
+        return self.model.generate_content(self.history + [content], stream=stream, **kwargs)
+
+class StandInModel:
+    """Offline model with configurable latency, streaming and failure behaviour"""
+    FILLER = ("the of a to in is and that for it as with on this be are by an "
+              "model reply latency token stream load test result system value").split()
+    
+    def __init__(self, backend, model_name: str, cached_content=None):
+        self.backend = backend
+        self.model_name = model_name
+        self.cached_content = cached_content
+    
+    def count_tokens(self, contents):
+        return SimpleNamespace(total_tokens=self.backend.estimate_tokens(contents))
+    
+    def start_chat(self, history: List = None):
+        return StandInChat(self, history)
+    
+    def generate_content(self, contents, generation_config=None, stream: bool = False, **kwargs):
+        backend = self.backend
+        rng = backend.rng
+        prompt_tokens = backend.estimate_tokens(contents)
+        cached_tokens = 0
+        if self.cached_content:
+            handle = backend.cached_contents.get(self.cached_content.name)
+            if handle is None or handle.expire_time < time.time():
+                raise StandInError(404, f"Cached content {self.cached_content.name} not found (stand-in)")
+            cached_tokens = handle.token_count
+            prompt_tokens += cached_tokens
+        
+        # Time to first token, drawn from a log-normal distribution
+        first_token = rng.lognormvariate(math.log(backend.latency_median), backend.latency_sigma)
+        
+        roll = rng.random()
+        if roll < backend.rate_limit_rate:
+            time.sleep(first_token)
+            raise StandInError(429, "Resource has been exhausted (stand-in)",
+                               retry_after=round(rng.uniform(1, 5), 1))
+        if roll < backend.rate_limit_rate + backend.error_rate:
+            time.sleep(first_token)
+            raise StandInError(500, "Internal error (stand-in)")
+        if roll < backend.rate_limit_rate + backend.error_rate + backend.block_rate:
+            time.sleep(first_token)
+            return StandInResponse('', prompt_tokens, block_reason=BLOCK_REASON_SAFETY)
+        
+        max_tokens = getattr(generation_config, 'max_output_tokens', None) or 1024
+        word_count = rng.randint(min(20, max_tokens), min(backend.max_reply_words, max_tokens))
+        prompt = contents[-1] if isinstance(contents, list) else contents
+        prompt = prompt['parts'][0] if isinstance(prompt, dict) else str(prompt)
+        words = [f"Stand-in reply from {self.model_name} to: {prompt[:60]}."]
+        words += [rng.choice(self.FILLER) for _ in range(word_count)]
+        text = ' '.join(words)
+        
+        per_token = 1.0 / backend.tokens_per_second
+        delays = [first_token] + [per_token] * (len(text.split(' ')) - 1)
+        if stream:
+            return StandInResponse(text, prompt_tokens, chunk_delays=delays, cached_tokens=cached_tokens)
+        time.sleep(sum(delays))
+        return StandInResponse(text, prompt_tokens, cached_tokens=cached_tokens)
+
+class StandInBackend(GenerationBackend):
+    """Local Gemini stand-in so the pipeline can be load-tested without outside services"""
+    name = 'standin'
+    
+    def __init__(self):
+        self.latency_median = config.standin_latency_median
+        self.latency_sigma = config.standin_latency_sigma
+        self.tokens_per_second = config.standin_tokens_per_second
+        self.max_reply_words = config.standin_max_reply_words
+        self.error_rate = config.standin_error_rate
+        self.rate_limit_rate = config.standin_rate_limit_rate
+        self.block_rate = config.standin_block_rate
+        self.rng = random.Random(config.standin_seed)
+        self.cached_contents: Dict[str, SimpleNamespace] = {}
+        self.lock = threading.Lock()
+    
+    def get_model(self, model_name: str, api_key: str = None):
+        return StandInModel(self, model_name)
+    
+    def supports_context_cache(self) -> bool:
+        return True
+    
+    def create_cached_content(self, model_name: str, contents: List, ttl: int):
+        time.sleep(self.latency_median / 2)
+        with self.lock:
+            handle = SimpleNamespace(
+                name=f'cachedContents/standin-{secrets.token_hex(6)}',
+                model=model_name,
+                token_count=self.estimate_tokens(contents),
+                expire_time=time.time() + ttl
+            )
+            self.cached_contents[handle.name] = handle
+        return handle
+    
+    def renew_cached_content(self, handle, ttl: int):
+        with self.lock:
+            if handle.name not in self.cached_contents:
+                raise StandInError(404, f"Cached content {handle.name} not found (stand-in)")
+            handle.expire_time = time.time() + ttl
+    
+    def delete_cached_content(self, handle):
+        with self.lock:
+            self.cached_contents.pop(handle.name, None)
+    
+    def model_from_cached_content(self, handle):
+        return StandInModel(self, handle.model, cached_content=handle)
+    
+    @staticmethod
+    def estimate_tokens(contents) -> int:
+        if isinstance(contents, (str, dict)):
+            contents = [contents]
+        words = 0
+        for item in contents:
+            if isinstance(item, dict):
+                words += sum(len(str(part).split()) for part in item.get('parts', []))
+            else:
+                words += len(str(item or '').split())
+        return int(words * 1.3) + 1
+
+def create_generation_backend() -> GenerationBackend:
+    backends = {
+        'gemini': GeminiBackend,
+        'standin': StandInBackend
+    }
+    backend = backends[config.generation_backend]()
+    logger.info(f"Using {backend.name} generation backend")
+    return backend
+
+@dataclass
+class GenerationResult:
+    """A generated reply, the model that actually produced it and its token usage.
+    
+    Token counts are None when the API didn't report usage metadata.
+    """
+    text: str
+    model_name: str
+    latency: float = 0.0
+    prompt_tokens: Optional[int] = None
+    candidate_tokens: Optional[int] = None
+    total_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    message_tokens: Optional[int] = None  # the prompt alone, when measure_usage counted it
+    admission: Optional[List] = None  # project quota reservation, settled once usage is known
+
+# Model routing
+class CircuitBreaker:
+    """Stop sending traffic to a model after repeated rate-limit or server errors"""
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.trial_thread = None  # thread running the half-open trial
+        self.lock = threading.Lock()
+    
+    def is_available(self) -> bool:
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open':
+                return time.time() - self.opened_at >= self.cooldown
+            return not self.trial_in_flight
+    
+    def allow(self) -> bool:
+        """Whether a request may go to this model now; half-open admits a single trial"""
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() - self.opened_at >= self.cooldown:
+                self.state = 'half_open'
+                self.trial_in_flight = False
+            if self.state == 'half_open' and not self.trial_in_flight:
+                self.trial_in_flight = True
+                self.trial_thread = threading.get_ident()
+                return True
+            return False
+    
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.trial_in_flight = False
+    
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.threshold:
+                self.state = 'open'
+                self.opened_at = time.time()
+                self.trial_in_flight = False
+    
+    def record_answered(self):
+        """The model responded but rejected this request (e.g. a 400); a trial counts as passed"""
+        with self.lock:
+            if self.state == 'half_open' and self.trial_thread == threading.get_ident():
+                self.state = 'closed'
+                self.failures = 0
+                self.trial_in_flight = False
+    
+    def release_trial(self):
+        """Free the half-open trial slot if this thread still holds it (e.g. it was cancelled)"""
+        with self.lock:
+            if self.trial_in_flight and self.trial_thread == threading.get_ident():
+                self.trial_in_flight = False
+
+class ModelHealth:
+    """Rolling latency and error statistics for one model"""
+    def __init__(self, window: int = 100):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.breaker = CircuitBreaker(config.circuit_breaker_threshold, config.circuit_breaker_cooldown)
+    
+    def percentile(self, pct: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+    
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+class ModelRouter:
+    """Pick a healthy model per request from the Gemini fallback list"""
+    RETRYABLE_CODES = {429, 500, 502, 503, 504}
+    MIN_SAMPLES = 5  # latency samples needed before a model's speed is trusted
+    
+    def __init__(self, model_names: List[str]):
+        self.model_names = model_names
+        self.available = list(model_names)
+        self.health = {name: ModelHealth() for name in model_names}
+    
+    @classmethod
+    def is_retryable(cls, error: Exception) -> bool:
+        """Rate-limit and server errors are worth retrying on another model"""
+        try:
+            return int(getattr(error, 'code', 0)) in cls.RETRYABLE_CODES
+        except (TypeError, ValueError):
+            return False
+    
+    def candidates(self, prompt: str, preferred: str) -> List[str]:
+        """Healthy models in the order they should be tried"""
+        healthy = [
+            name for name in self.available
+            if self.health[name].breaker.is_available()
+        ]
+        ordered = sorted(healthy, key=lambda name: (name != preferred, self.model_names.index(name)))
+        
+        if len(prompt) <= config.router_short_prompt_chars:
+            # Short prompts: fastest healthy flash model first
+            def speed(name):
+                health = self.health[name]
+                p50 = health.percentile(0.5) if len(health.latencies) >= self.MIN_SAMPLES else None
+                return (p50 is None, p50 or 0, ordered.index(name))
+            flash = sorted([name for name in ordered if 'flash' in name], key=speed)
+            ordered = flash + [name for name in ordered if name not in flash]
+        return ordered
+    
+    def allow(self, model_name: str) -> bool:
+        return self.health[model_name].breaker.allow()
+    
+    def record_success(self, model_name: str, latency: float):
+        health = self.health[model_name]
+        health.latencies.append(latency)
+        health.outcomes.append(True)
+        health.breaker.record_success()
+    
+    def record_failure(self, model_name: str, error: Exception):
+        health = self.health[model_name]
+        health.outcomes.append(False)
+        if self.is_retryable(error):
+            health.breaker.record_failure()
+            if health.breaker.state == 'open':
+                logger.warning(f"Circuit opened for {model_name} after: {error}")
+        else:
+            health.breaker.record_answered()
+    
+    def release(self, model_name: str):
+        """Called once an attempt on the model is over, however it ended"""
+        self.health[model_name].breaker.release_trial()
+    
+    def get_stats(self) -> Dict:
+        stats = {}
+        for name, health in self.health.items():
+            p50, p95 = health.percentile(0.5), health.percentile(0.95)
+            stats[name] = {
+                'available': name in self.available,
+                'circuit': health.breaker.state,
+                'requests': len(health.outcomes),
+                'p50': round(p50, 3) if p50 is not None else None,
+                'p95': round(p95, 3) if p95 is not None else None,
+                'error_rate': round(health.error_rate * 100, 1)
+            }
+        return stats
+
+class NoHealthyModelError(Exception):
+    """Raised when every model's circuit breaker is open"""
+    pass
+
+# API key pool
+class ApiKeyState:
+    """One-minute sliding window of requests and tokens sent with a single API key"""
+    WINDOW = 60
+    
+    def __init__(self, key: str, name: str):
+        self.key = key
+        self.name = name
+        self.window: deque = deque()  # [timestamp, tokens] per request
+        self.cooldowns: Dict[str, float] = {}  # model name -> time.time() the key may serve it again
+        self.total_requests = 0
+        self.rate_limited = 0
+    
+    def _trim(self, now: float):
+        while self.window and now - self.window[0][0] > self.WINDOW:
+            self.window.popleft()
+    
+    def rpm(self, now: float) -> int:
+        self._trim(now)
+        return len(self.window)
+    
+    def tpm(self, now: float) -> int:
+        self._trim(now)
+        return sum(tokens for _, tokens in self.window)
+
+class ApiKeyPool:
+    """Spread requests over several Gemini API keys by per-minute quota headroom"""
+    def __init__(self, keys: List[str], rpm_limit: int, tpm_limit: int, cooldown: int,
+                 max_wait: float):
+        self.keys = [
+            ApiKeyState(key, f"key-{i + 1} (...{key[-4:]})")
+            for i, key in enumerate(keys)
+        ]
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.cooldown = cooldown
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+    
+    def _load(self, key: ApiKeyState, now: float, tokens: int) -> float:
+        """Fraction of the tighter quota this key would be at after the request"""
+        return max(
+            (key.rpm(now) + 1) / self.rpm_limit if self.rpm_limit else 0.0,
+            (key.tpm(now) + tokens) / self.tpm_limit if self.tpm_limit else 0.0
+        )
+    
+    def _wait(self, key: ApiKeyState, model_name: str, now: float, tokens: int) -> float:
+        """Seconds until the key could take the request without going over its quotas"""
+        wait = max(0.0, key.cooldowns.get(model_name, 0.0) - now)
+        excess_requests = key.rpm(now) + 1 - self.rpm_limit if self.rpm_limit else 0
+        if excess_requests > 0:
+            wait = max(wait, key.window[excess_requests - 1][0] + key.WINDOW - now)
+        excess_tokens = key.tpm(now) + tokens - self.tpm_limit if self.tpm_limit else 0
+        if excess_tokens > 0:
+            # Wait for enough of the window to expire
+            for stamp, used in key.window:
+                excess_tokens -= used
+                if excess_tokens <= 0:
+                    wait = max(wait, stamp + key.WINDOW - now)
+                    break
+            else:
+                return float('inf')
+        return wait
+    
+    def acquire(self, model_name: str, tokens: int, exclude=(),
+                prefer: str = None) -> Tuple[ApiKeyState, list]:
+        """Reserve a request on the least-loaded key; returns the key and its reservation.
+        
+        The preferred key is used whenever it still has headroom. When no key
+        has, this waits for the first one to free up, or raises
+        KeyPoolExhaustedError if that would take longer than max_wait.
+        Cooldowns after a 429 apply to the model that returned it only.
+        """
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            with self.lock:
+                now = time.time()
+                candidates = [key for key in self.keys if key.name not in exclude] or self.keys
+                waits = {key.name: self._wait(key, model_name, now, tokens) for key in candidates}
+                ready = [key for key in candidates if waits[key.name] == 0]
+                if ready:
+                    preferred = [key for key in ready if key.name == prefer]
+                    key = preferred[0] if preferred else min(ready, key=lambda k: self._load(k, now, tokens))
+                    reservation = [now, tokens]
+                    key.window.append(reservation)
+                    key.total_requests += 1
+                    return key, reservation
+                wait = min(waits.values())
+                cooling = all(key.cooldowns.get(model_name, 0.0) > now for key in candidates)
+            
+            if time.monotonic() + wait > deadline:
+                reason = 'cooldown' if cooling else 'quota'
+                logger.warning(f"No API key can take a {model_name} request within "
+                               f"{self.max_wait}s ({reason})")
+                raise KeyPoolExhaustedError(reason)
+            time.sleep(wait)
+    
+    def settle(self, reservation: list, tokens: int):
+        """Replace a reservation's estimated tokens with the real count"""
+        with self.lock:
+            reservation[1] = tokens
+    
+    @staticmethod
+    def retry_delay(error: Exception) -> Optional[float]:
+        """The retry delay the server sent with a 429, if any"""
+        delay = getattr(error, 'retry_after', None)
+        if delay is not None:
+            return float(delay)
+        for detail in getattr(error, 'details', None) or []:
+            retry_delay = getattr(detail, 'retry_delay', None)
+            if retry_delay is None:
+                continue
+            if hasattr(retry_delay, 'total_seconds'):
+                return retry_delay.total_seconds()
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+        match = re.search(r'retry in ([\d.]+)s', str(error), re.IGNORECASE)
+        return float(match.group(1)) if match else None
+    
+    def record_rate_limited(self, key: ApiKeyState, model_name: str, error: Exception):
+        delay = self.retry_delay(error)
+        if delay is None:
+            delay = self.cooldown
+        with self.lock:
+            key.cooldowns[model_name] = time.time() + delay
+            key.rate_limited += 1
+        logger.warning(f"API key {key.name} hit its rate limit for {model_name}; resting it for {delay:.1f}s")
+    
+    def get_stats(self) -> List[Dict]:
+        """Per-key utilization of the per-minute quotas"""
+        with self.lock:
+            now = time.time()
+            stats = []
+            for key in self.keys:
+                rpm, tpm = key.rpm(now), key.tpm(now)
+                stats.append({
+                    'name': key.name,
+                    'rpm': rpm,
+                    'rpm_limit': self.rpm_limit,
+                    'tpm': tpm,
+                    'tpm_limit': self.tpm_limit,
+                    'utilization': round(self._load(key, now, 0) * 100, 1),
+                    'cooldown': {
+                        model_name: round(until - now)
+                        for model_name, until in key.cooldowns.items() if until > now
+                    },
+                    'requests': key.total_requests,
+                    'rate_limited': key.rate_limited
+                })
+            return stats
+
+# Project-wide quota admission
+class TokenBucket:
+    """Refills at limit/60 per second up to burst_seconds worth; may go into debt"""
+    def __init__(self, per_minute: int, burst_seconds: float):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+    
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_for(self, amount: float) -> float:
+        """Seconds until the bucket could cover amount"""
+        return max(0.0, amount - self.level) / self.rate
+
+class AdmissionController:
+    """Keep the whole process under the Gemini project's RPM and TPM quotas.
+    
+    Every request reserves one request and its estimated tokens from two
+    token buckets. If the buckets are short it waits for the refill, unless
+    that would take longer than admission_max_wait, in which case it is shed.
+    settle() returns the difference once the real token count is known.
+    """
+    WINDOW = 60
+    
+    def __init__(self, rpm_limit: int, tpm_limit: int, burst_seconds: float, max_wait: float):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.max_wait = max_wait
+        self.requests = TokenBucket(rpm_limit, burst_seconds) if rpm_limit else None
+        self.tokens = TokenBucket(tpm_limit, burst_seconds) if tpm_limit else None
+        self.window: deque = deque()  # [timestamp, tokens] per admitted request
+        self.admitted = 0
+        self.delayed = 0
+        self.total_wait = 0.0
+        self.shed: Dict[str, int] = {}
+    
+    def _trim(self, now: float):
+        while self.window and now - self.window[0][0] > self.WINDOW:
+            self.window.popleft()
+    
+    async def admit(self, estimated_tokens: int) -> List:
+        """Reserve quota for one request, waiting briefly if needed; returns the reservation"""
+        now = time.monotonic()
+        waits = {}
+        for name, bucket, amount in (('rpm', self.requests, 1), ('tpm', self.tokens, estimated_tokens)):
+            if bucket:
+                bucket.refill(now)
+                waits[name] = bucket.wait_for(amount)
+        wait = max(waits.values(), default=0.0)
+        if wait > self.max_wait:
+            reason = max(waits, key=waits.get)
+            self.shed[reason] = self.shed.get(reason, 0) + 1
+            raise AdmissionRejectedError(reason)
+        
+        # Reserve now so later arrivals queue behind this request
+        if self.requests:
+            self.requests.level -= 1
+        if self.tokens:
+            self.tokens.level -= estimated_tokens
+        reservation = [time.time(), estimated_tokens]
+        self._trim(reservation[0])
+        self.window.append(reservation)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                self.release(reservation)
+                raise
+            self.delayed += 1
+            self.total_wait += wait
+        self.admitted += 1
+        return reservation
+    
+    def settle(self, reservation: List, actual_tokens: int):
+        """Correct a reservation with the real token count"""
+        if self.tokens:
+            self.tokens.level += reservation[1] - actual_tokens
+        reservation[1] = actual_tokens
+    
+    def release(self, reservation: List):
+        """Hand back the quota of a request that never reached the API"""
+        if self.requests:
+            self.requests.level += 1
+        self.settle(reservation, 0)
+        if reservation in self.window:
+            self.window.remove(reservation)
+    
+    def get_stats(self) -> Dict:
+        """Use of the project quotas over the last minute"""
+        now = time.time()
+        self._trim(now)
+        rpm = len(self.window)
+        tpm = sum(tokens for _, tokens in self.window)
+        return {
+            'rpm': rpm,
+            'rpm_limit': self.rpm_limit,
+            'rpm_utilization': round(rpm / self.rpm_limit * 100, 1) if self.rpm_limit else None,
+            'tpm': tpm,
+            'tpm_limit': self.tpm_limit,
+            'tpm_utilization': round(tpm / self.tpm_limit * 100, 1) if self.tpm_limit else None,
+            'admitted': self.admitted,
+            'delayed': self.delayed,
+            'avg_wait': round(self.total_wait / max(1, self.admitted), 3),
+            'shed': dict(self.shed)
+        }
+
+admission_controller = AdmissionController(
+    config.admission_rpm_limit,
+    config.admission_tpm_limit,
+    config.admission_burst_seconds,
+    config.admission_max_wait
+)
+
+# Server-side context caching
+class ContextCache:
+    """Reuse server-side cached-content handles for the stable history prefix of busy chats.
+    
+    Once a chat's history reaches context_cache_min_tokens it is cached on the
+    model, and later requests only send the turns after that prefix. Handles
+    are renewed while the chat is active and deleted once it goes idle. Cached
+    content belongs to the default API key, so those requests prefer it.
+    """
+    SWEEP_INTERVAL = 60
+    
+    def __init__(self, backend: GenerationBackend, key_pool: ApiKeyPool):
+        self.backend = backend
+        self.key_pool = key_pool
+        self.entries: Dict[Tuple[int, int], Dict] = {}  # keyed by (bot_id, chat_id)
+        self.lock = threading.Lock()
+        self.last_sweep = time.time()
+        self.hits = 0
+        self.created = 0
+        self.renewed = 0
+        self.evicted = 0
+        self.failed = 0
+        self.tokens_saved = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return config.context_cache_enabled and self.backend.supports_context_cache()
+    
+    @staticmethod
+    def _prefix_hash(turns: List) -> str:
+        return hashlib.sha256(json.dumps(turns, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    
+    def preferred_key(self, history: List = None) -> Optional[str]:
+        """Name of the key a request should use to benefit from the cache, if any"""
+        chat_id = getattr(history, 'chat_id', None)
+        if not self.enabled or chat_id is None:
+            return None
+        if (history.bot_id, chat_id) in self.entries or history.token_count >= config.context_cache_min_tokens:
+            return self.key_pool.keys[0].name
+        return None
+    
+    def prepare(self, model_name: str, history: List, api_key: ApiKeyState) -> Tuple[object, List]:
+        """Cached-content handle plus the turns still to send, or (None, history)"""
+        if self.preferred_key(history) is None or api_key is not self.key_pool.keys[0]:
+            return None, history
+        chat_id = history.chat_id
+        chat_key = (history.bot_id, chat_id)
+        self._sweep()
+        
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(chat_key)
+        if (entry and entry['model_name'] == model_name
+                and entry['expires_at'] > now + 5
+                and len(history) >= entry['turns']
+                and self._prefix_hash(history[:entry['turns']]) == entry['hash']):
+            entry['last_used'] = now
+            entry['hits'] += 1
+            if entry['expires_at'] - now < config.context_cache_ttl / 2:
+                self._renew(entry)
+            self.hits += 1
+            self.tokens_saved += entry['token_count']
+            return entry['handle'], history[entry['turns']:]
+        
+        if history.token_count < config.context_cache_min_tokens:
+            return None, history
+        if entry and entry['hits'] == 0 and entry['expires_at'] > now:
+            # The last cache was never reused (e.g. the history window slides
+            # every turn); stop paying for new ones until the chat goes idle
+            return None, history
+        
+        # Cache the whole current history; following turns build on it
+        try:
+            handle = self.backend.create_cached_content(model_name, list(history), config.context_cache_ttl)
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"Could not create context cache for chat {chat_id}: {e}")
+            return None, history
+        with self.lock:
+            old = self.entries.get(chat_key)
+            self.entries[chat_key] = {
+                'handle': handle,
+                'model_name': model_name,
+                'turns': len(history),
+                'hash': self._prefix_hash(list(history)),
+                'token_count': history.token_count,
+                'expires_at': now + config.context_cache_ttl,
+                'last_used': now,
+                'hits': 0
+            }
+        self.created += 1
+        logger.info(f"Cached {history.token_count} history tokens for chat {chat_id} on {model_name}")
+        if old:
+            self._delete(old)
+        return handle, []
+    
+    def _renew(self, entry: Dict):
+        try:
+            self.backend.renew_cached_content(entry['handle'], config.context_cache_ttl)
+            entry['expires_at'] = time.time() + config.context_cache_ttl
+            self.renewed += 1
+        except Exception as e:
+            logger.warning(f"Could not renew context cache: {e}")
+    
+    def _delete(self, entry: Dict):
+        try:
+            self.backend.delete_cached_content(entry['handle'])
+        except Exception as e:
+            logger.warning(f"Could not delete context cache: {e}")
+    
+    def _sweep(self):
+        """Delete caches for chats that have gone idle"""
+        now = time.time()
+        if now - self.last_sweep < self.SWEEP_INTERVAL:
+            return
+        self.last_sweep = now
+        with self.lock:
+            idle = [
+                chat_key for chat_key, entry in self.entries.items()
+                if now - entry['last_used'] > config.context_cache_idle or entry['expires_at'] < now
+            ]
+            evicted = [self.entries.pop(chat_key) for chat_key in idle]
+        for entry in evicted:
+            if entry['expires_at'] > now:
+                self._delete(entry)
+        self.evicted += len(evicted)
+    
+    def invalidate(self, bot_id: int, chat_id: int):
+        """Drop a chat's cache, e.g. after its history was cleared"""
+        with self.lock:
+            entry = self.entries.pop((bot_id, chat_id), None)
+        if entry:
+            # Deleting is an API call; keep it off the caller's thread
+            threading.Thread(target=self._delete, args=(entry,), daemon=True).start()
+    
+    def get_stats(self) -> Dict:
+        return {
+            'enabled': self.enabled,
+            'active': len(self.entries),
+            'hits': self.hits,
+            'created': self.created,
+            'renewed': self.renewed,
+            'evicted': self.evicted,
+            'failed': self.failed,
+            'tokens_saved': self.tokens_saved
+        }
+
 # Enhanced Gemini initialization
 class GeminiManager:
     def __init__(self):
@@ -135,71 +1289,406 @@ class GeminiManager:
             {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
             {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
         ]
-        self.initialize_model()
-    
-    def initialize_model(self):
-        """Initialize Gemini model with fallback options"""
-        genai.configure(api_key=config.gemini_api_key)
-        
-        model_names = [
+        self.model_names = [
             'gemini-2.0-flash-exp',
             'gemini-2.0-flash',
             'gemini-1.5-pro',
             'gemini-1.5-flash',
             'gemini-1.0-pro'
         ]
+        self.generation_settings = {
+            'temperature': 0.7,
+            'max_output_tokens': 1024,
+            'top_p': 0.8,
+            'top_k': 40
+        }
+        self.backend = create_generation_backend()
+        self.models: Dict[Tuple[str, Optional[str]], object] = {}
+        self.key_pool = ApiKeyPool(
+            # The stand-in doesn't need keys but still exercises the pool
+            config.gemini_api_keys or ['standin'],
+            config.key_rpm_limit,
+            config.key_tpm_limit,
+            config.key_cooldown,
+            config.admission_max_wait
+        )
+        self.context_cache = ContextCache(self.backend, self.key_pool)
+        self.router = ModelRouter(self.model_names)
+        self.pool = GenerationPool(config.max_concurrent_generations, config.generation_timeout)
+        self.initialize_model()
+    
+    def initialize_model(self):
+        """Initialize Gemini model with fallback options"""
+        self.backend.configure()
+        init_start = time.time()
+        
+        cached = self._load_probe_cache()
+        if cached:
+            # Serve with the cached model right away and confirm it in the background
+            self._use_model(cached['model_name'])
+            self.router.available = [
+                name for name in cached.get('available', [cached['model_name']])
+                if name in self.model_names
+            ]
+            age = time.time() - cached['probed_at']
+            logger.info(f"Using cached model {self.model_name} (probed {age:.0f}s ago)")
+            threading.Thread(target=self._reprobe, daemon=True).start()
+        else:
+            available = self.probe_models()
+            if not available:
+                logger.error("All Gemini models failed to initialize")
+                raise Exception("Could not initialize any Gemini model")
+            self._use_model(available[0])
+            self.router.available = available
+            self._save_probe_cache(available)
+            logger.info(f"Successfully initialized model: {self.model_name}")
+        
+        logger.info(f"Model initialization took {time.time() - init_start:.2f}s")
+    
+    def _get_model(self, model_name: str, api_key: ApiKeyState = None):
+        cache_key = (model_name, api_key.name if api_key else None)
+        model = self.models.get(cache_key)
+        if model is None:
+            model = self.models[cache_key] = self.backend.get_model(
+                model_name, api_key.key if api_key else None
+            )
+        return model
+    
+    def _use_model(self, model_name: str):
+        self.model = self._get_model(model_name)
+        self.model_name = model_name
+    
+    def _probe(self, model_name: str) -> bool:
+        """Check that a model answers a tiny prompt"""
+        try:
+            model = self.backend.get_model(model_name)
+            test_response = model.generate_content(
+                "Hello",
+                safety_settings=self.safety_settings,
+                generation_config=genai.types.GenerationConfig(max_output_tokens=8)
+            )
+            return bool(test_response.text)
+        except Exception as e:
+            logger.warning(f"Model {model_name} failed: {e}")
+            return False
+    
+    def probe_models(self) -> List[str]:
+        """Probe all models concurrently, returning the working ones in preference order"""
+        probe_start = time.time()
+        with ThreadPoolExecutor(max_workers=len(self.model_names)) as executor:
+            results = list(executor.map(self._probe, self.model_names))
+        available = [name for name, ok in zip(self.model_names, results) if ok]
+        logger.info(f"Probed {len(self.model_names)} models in {time.time() - probe_start:.2f}s: "
+                    f"{available or 'none available'}")
+        return available
+    
+    def _reprobe(self):
+        """Background check of the cached model choice"""
+        available = self.probe_models()
+        if not available:
+            logger.error(f"Background probe found no working models; keeping {self.model_name}")
+            return
+        if available[0] != self.model_name:
+            logger.warning(f"Switching model from {self.model_name} to {available[0]} after re-probe")
+            self._use_model(available[0])
+        self.router.available = available
+        self._save_probe_cache(available)
+    
+    def _load_probe_cache(self) -> Optional[Dict]:
+        """Return the cached probe result if it is still fresh"""
+        try:
+            with open(config.model_probe_file) as f:
+                cached = json.load(f)
+            if (time.time() - cached['probed_at'] < config.model_probe_ttl
+                    and cached.get('backend', 'gemini') == self.backend.name
+                    and cached['model_name'] in self.model_names):
+                return cached
+        except (OSError, ValueError, KeyError) as e:
+            logger.info(f"No usable model probe cache: {e}")
+        return None
+    
+    def _save_probe_cache(self, available: List[str]):
+        try:
+            with open(config.model_probe_file, 'w') as f:
+                json.dump({
+                    'backend': self.backend.name,
+                    'model_name': available[0],
+                    'available': available,
+                    'probed_at': time.time()
+                }, f)
+        except OSError as e:
+            logger.warning(f"Could not save model probe cache: {e}")
+    
+    def count_tokens(self, contents) -> int:
+        """Token count from the model's tokenizer, estimated if the call fails"""
+        try:
+            return self.model.count_tokens(contents).total_tokens
+        except Exception as e:
+            logger.warning(f"Token count failed, estimating: {e}")
+            if isinstance(contents, str):
+                contents = [contents]
+            return self.estimate_text_tokens(*contents)
+    
+    @staticmethod
+    def estimate_text_tokens(*texts: str) -> int:
+        """Rough token count (about 4 characters per token) that needs no API call"""
+        return sum(len(text or '') for text in texts) // 4 + 1
+    
+    def _send(self, prompt: str, history: List = None, stream: bool = False,
+              model_name: str = None, api_key: ApiKeyState = None, cached_content=None,
+              settings: Dict = None):
+        """Send prompt to the model, as a chat turn when there is history"""
+        if cached_content:
+            model = self.backend.model_from_cached_content(cached_content)
+        else:
+            model = self._get_model(model_name or self.model_name, api_key)
+        generation_config = genai.types.GenerationConfig(**(settings or self.generation_settings))
+        if history:
+            chat = model.start_chat(history=history)
+            return chat.send_message(
+                prompt,
+                safety_settings=self.safety_settings,
+                generation_config=generation_config,
+                stream=stream
+            )
+        return model.generate_content(
+            prompt,
+            safety_settings=self.safety_settings,
+            generation_config=generation_config,
+            stream=stream
+        )
+    
+    def _send_with_context_cache(self, prompt: str, history: List = None, stream: bool = False,
+                                 model_name: str = None, api_key: ApiKeyState = None,
+                                 settings: Dict = None):
+        """Send using the chat's server-side context cache when there is one"""
+        handle, turns = self.context_cache.prepare(model_name, history, api_key)
+        if handle is None:
+            return self._send(prompt, history, stream, model_name, api_key, settings=settings)
+        try:
+            return self._send(prompt, turns, stream, model_name, api_key, cached_content=handle,
+                              settings=settings)
+        except Exception as e:
+            if getattr(e, 'code', None) not in (403, 404):
+                raise
+            logger.warning(f"Context cache for chat {history.chat_id} is gone, resending in full: {e}")
+            self.context_cache.invalidate(history.bot_id, history.chat_id)
+            return self._send(prompt, history, stream, model_name, api_key, settings=settings)
+    
+    def _estimate_tokens(self, prompt: str, history: List = None, settings: Dict = None) -> int:
+        """Tokens to reserve against a key's quota before the real count is known"""
+        return (getattr(history, 'token_count', 0) + len(prompt) // 4 + 1
+                + (settings or self.generation_settings)['max_output_tokens'])
+    
+    def _attempt_on_keys(self, model_name: str, attempt, token_estimate: int, prefer_key: str = None):
+        """Run attempt on the least-loaded API key, moving to another key on 429"""
+        tried = set()
+        while True:
+            api_key, reservation = self.key_pool.acquire(model_name, token_estimate, exclude=tried,
+                                                         prefer=prefer_key)
+            try:
+                text, usage = attempt(model_name, api_key)
+            except Exception as e:
+                if getattr(e, 'code', None) == 429:
+                    self.key_pool.record_rate_limited(api_key, model_name, e)
+                    tried.add(api_key.name)
+                    if len(tried) < len(self.key_pool.keys) and not getattr(attempt, 'committed', False):
+                        continue
+                raise
+            self.key_pool.settle(reservation, usage.get('total_tokens', token_estimate))
+            return text, usage
+    
+    def _generate_routed(self, prompt: str, attempt, token_estimate: int,
+                         prefer_key: str = None) -> GenerationResult:
+        """Try healthy models in routing order, falling back on 429/5xx errors.
         
-        for model_name in model_names:
+        attempt(model_name, api_key) returns the reply text and its usage
+        counts; it sets attempt.committed once output has reached the user,
+        after which we can't fall back.
+        """
+        last_error = None
+        for model_name in self.router.candidates(prompt, self.model_name):
+            if not self.router.allow(model_name):
+                continue
+            started = time.time()
             try:
-                model = genai.GenerativeModel(model_name)
-                # Test the model
-                test_response = model.generate_content(
-                    "Hello",
-                    safety_settings=self.safety_settings
-                )
-                if test_response.text:
-                    self.model = model
-                    self.model_name = model_name
-                    logger.info(f"Successfully initialized model: {model_name}")
-                    return
+                text, usage = self._attempt_on_keys(model_name, attempt, token_estimate, prefer_key)
+            except GenerationCancelledError:
+                raise
+            except KeyPoolExhaustedError as e:
+                # No key can serve this model right now; that says nothing about the model's health
+                logger.warning(f"No API key free for {model_name}, falling back: {e}")
+                last_error = e
+                continue
             except Exception as e:
-                logger.warning(f"Model {model_name} failed: {e}")
+                self.router.record_failure(model_name, e)
+                if not ModelRouter.is_retryable(e) or getattr(attempt, 'committed', False):
+                    raise
+                logger.warning(f"Model {model_name} failed, falling back: {e}")
+                last_error = e
                 continue
+            else:
+                latency = time.time() - started
+                self.router.record_success(model_name, latency)
+                return GenerationResult(text, model_name, latency, **usage)
+            finally:
+                # A cancelled or failed half-open trial must not keep the model excluded
+                self.router.release(model_name)
         
-        logger.error("All Gemini models failed to initialize")
-        raise Exception("Could not initialize any Gemini model")
+        if last_error:
+            raise last_error
+        raise NoHealthyModelError("All AI models are temporarily unavailable. Please try again shortly.")
     
-    def generate_response(self, prompt: str, history: List = None) -> str:
+    def generate_response(self, prompt: str, history: List = None,
+                          settings: Dict = None) -> GenerationResult:
         """Generate response with enhanced error handling"""
+        def attempt(model_name: str, api_key: ApiKeyState):
+            response = self._send_with_context_cache(prompt, history, model_name=model_name,
+                                                     api_key=api_key, settings=settings)
+            return self._handle_response(response), self._usage(response)
+        
         try:
-            if history:
-                chat = self.model.start_chat(history=history)
-                response = chat.send_message(
-                    prompt,
-                    safety_settings=self.safety_settings,
-                    generation_config=genai.types.GenerationConfig(
-                        temperature=0.7,
-                        max_output_tokens=1024,
-                        top_p=0.8,
-                        top_k=40
-                    )
-                )
-            else:
-                response = self.model.generate_content(
-                    prompt,
-                    safety_settings=self.safety_settings,
-                    generation_config=genai.types.GenerationConfig(
-                        temperature=0.7,
-                        max_output_tokens=1024,
-                        top_p=0.8,
-                        top_k=40
-                    )
-                )
-            
-            return self._handle_response(response)
+            return self._generate_routed(prompt, attempt, self._estimate_tokens(prompt, history, settings),
+                                         self.context_cache.preferred_key(history))
         except Exception as e:
             logger.error(f"Gemini generation error: {e}")
             raise
+    
+    def generate_response_stream(self, prompt: str, history: List = None,
+                                 on_chunk=None, settings: Dict = None) -> GenerationResult:
+        """Generate a streamed response, passing each text chunk to on_chunk"""
+        def attempt(model_name: str, api_key: ApiKeyState):
+            response = self._send_with_context_cache(prompt, history, stream=True,
+                                                     model_name=model_name, api_key=api_key,
+                                                     settings=settings)
+            for chunk in response:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Blocked or empty chunk - handled once the stream resolves
+                    continue
+                if text and on_chunk:
+                    attempt.committed = True
+                    on_chunk(text)
+            return self._handle_response(response), self._usage(response)
+        attempt.committed = False
+        
+        try:
+            return self._generate_routed(prompt, attempt, self._estimate_tokens(prompt, history, settings),
+                                         self.context_cache.preferred_key(history))
+        except GenerationCancelledError:
+            logger.info("Stopped streaming a cancelled reply")
+            raise
+        except Exception as e:
+            logger.error(f"Gemini streaming error: {e}")
+            raise
+    
+    @staticmethod
+    def _usage(response) -> Dict[str, Optional[int]]:
+        """Token counts from the response's usage metadata, if the API sent any"""
+        usage = getattr(response, 'usage_metadata', None)
+        if not usage or not getattr(usage, 'total_token_count', 0):
+            return {}
+        return {
+            'prompt_tokens': usage.prompt_token_count,
+            'candidate_tokens': usage.candidates_token_count,
+            'total_tokens': usage.total_token_count,
+            'cached_tokens': getattr(usage, 'cached_content_token_count', 0)
+        }
+    
+    def measure_usage(self, result: GenerationResult, prompt: str, history: List = None):
+        """Fill in token counts for a result that came back without usage metadata.
+        
+        History is not recounted: its turns carry the counts stored when they were saved.
+        """
+        history_tokens = getattr(history, 'token_count', 0)
+        result.message_tokens = self.count_tokens(prompt)
+        result.prompt_tokens = history_tokens + result.message_tokens
+        result.candidate_tokens = self.count_tokens(result.text)
+        result.total_tokens = result.prompt_tokens + result.candidate_tokens
+    
+    @staticmethod
+    def estimate_cost(model_name: str, prompt_tokens: int, candidate_tokens: int) -> float:
+        """Estimated USD cost of one call"""
+        prompt_price, candidate_price = config.model_pricing.get(model_name, (0.0, 0.0))
+        return (prompt_tokens * prompt_price + candidate_tokens * candidate_price) / 1_000_000
+    
+    def _cacheable(self, history: List = None, bypass_cache: bool = False) -> bool:
+        """Whether the request can be served from and stored in the response caches"""
+        if not config.response_cache_enabled or history:
+            return False
+        if bypass_cache:
+            response_cache.bypassed += 1
+            return False
+        return True
+    
+    def _cache_key(self, prompt: str, model_name: str, settings: Dict = None) -> str:
+        return response_cache.make_key(prompt, model_name, settings or self.generation_settings)
+    
+    async def _run_cached(self, prompt: str, history: List, bypass_cache: bool, settings: Dict,
+                          func, *args, slot=None) -> GenerationResult:
+        """Serve from the response caches when possible, otherwise run func in the pool.
+        
+        slot, if given, returns an async context manager (a scheduler slot) held
+        around the call; it's entered only after the request was admitted.
+        """
+        cacheable = self._cacheable(history, bypass_cache)
+        vector = None
+        if cacheable:
+            # Entries are stored under the model that answered, so look up the
+            # one the router would send this request to
+            candidates = self.router.candidates(prompt, self.model_name)
+            model_name = candidates[0] if candidates else self.model_name
+            cached = await async_db.call(response_cache.get, self._cache_key(prompt, model_name, settings))
+            if cached is not None:
+                return GenerationResult(cached, 'response-cache', 0.0, 0, 0, 0)
+            if semantic_cache:
+                cached, vector = await semantic_cache.lookup_async(prompt, model_name)
+                if cached is not None:
+                    return GenerationResult(cached, 'semantic-cache', 0.0, 0, 0, 0)
+        
+        # Only requests that reach the API spend project quota. Admission comes
+        # first so waiting for quota doesn't hold a generation slot.
+        reservation = await admission_controller.admit(self._estimate_tokens(prompt, history, settings))
+        sent = False
+        try:
+            async with (slot() if slot else nullcontext()):
+                sent = True
+                result = await self.pool.run(func, *args)
+        except BaseException as e:
+            if not sent or isinstance(e, KeyPoolExhaustedError):
+                # Never reached the API
+                admission_controller.release(reservation)
+            else:
+                # The request counts, but failed calls produce no tokens we know of
+                admission_controller.settle(reservation, 0)
+            raise
+        result.admission = reservation
+        if cacheable and not result.text.startswith("⚠️"):
+            cache_key = self._cache_key(prompt, result.model_name, settings)
+            await async_db.call(response_cache.put, cache_key, prompt, result.model_name, result.text)
+            if semantic_cache:
+                await semantic_cache.add_async(prompt, result.model_name, result.text, vector)
+        return result
+    
+    async def generate_response_async(self, prompt: str, history: List = None,
+                                      bypass_cache: bool = False,
+                                      settings: Dict = None, slot=None) -> GenerationResult:
+        """Generate response without blocking the event loop"""
+        return await self._run_cached(
+            prompt, history, bypass_cache, settings,
+            self.generate_response, prompt, history, settings, slot=slot
+        )
+    
+    async def generate_response_stream_async(self, prompt: str, history: List = None,
+                                             on_chunk=None,
+                                             bypass_cache: bool = False,
+                                             settings: Dict = None, slot=None) -> GenerationResult:
+        """Streamed variant of generate_response_async"""
+        return await self._run_cached(
+            prompt, history, bypass_cache, settings,
+            self.generate_response_stream, prompt, history, on_chunk, settings, slot=slot
+        )
 
     def _handle_response(self, response) -> str:
         """Handle Gemini response with all edge cases"""
@@ -230,14 +1719,769 @@ except Exception as e:
     logger.error(f"Failed to initialize Gemini: {e}")
     exit(1)
 
+# Adaptive generation settings
+@dataclass
+class GenerationDecision:
+    """Generation settings picked for one request and the inputs behind them"""
+    settings: Dict
+    request_class: str
+    load_level: str
+    
+    @property
+    def label(self) -> str:
+        return (f"{self.request_class}/{self.load_level} "
+                f"max_tokens={self.settings['max_output_tokens']} "
+                f"temp={self.settings['temperature']}")
+
+class GenerationPolicy:
+    """Pick output length and sampling by request class, shrinking outputs under load"""
+    # Overrides of GeminiManager.generation_settings per request class
+    CLASSES = {
+        'group': {'max_output_tokens': 512},
+        'chat': {},
+        'deep': {'max_output_tokens': 2048, 'temperature': 0.5, 'top_p': 0.9}
+    }
+    LOAD_SCALES = {'normal': 1.0, 'busy': 0.6, 'overloaded': 0.35}
+    MIN_OUTPUT_TOKENS = 256
+    
+    def __init__(self, manager: GeminiManager):
+        self.manager = manager
+        self.decisions: Dict[str, int] = {}
+    
+    @staticmethod
+    def classify(chat_type: str, prompt: str) -> str:
+        if chat_type in ['group', 'supergroup']:
+            return 'group'
+        if len(prompt) >= config.policy_deep_prompt_chars:
+            return 'deep'
+        return 'chat'
+    
+    def load_level(self) -> str:
+        """Load from the generation queue depth relative to the pool size"""
+        pool = self.manager.pool
+        pressure = (pool.queued + request_scheduler.queued) / pool.max_in_flight
+        if pressure >= config.policy_overloaded_queue_ratio:
+            return 'overloaded'
+        if pressure >= config.policy_busy_queue_ratio:
+            return 'busy'
+        return 'normal'
+    
+    def decide(self, chat_type: str, prompt: str) -> GenerationDecision:
+        settings = dict(self.manager.generation_settings)
+        if not config.adaptive_generation:
+            return GenerationDecision(settings, 'fixed', 'normal')
+        
+        request_class = self.classify(chat_type, prompt)
+        load_level = self.load_level()
+        settings.update(self.CLASSES[request_class])
+        settings['max_output_tokens'] = max(
+            self.MIN_OUTPUT_TOKENS,
+            int(settings['max_output_tokens'] * self.LOAD_SCALES[load_level])
+        )
+        
+        key = f"{request_class}/{load_level}"
+        self.decisions[key] = self.decisions.get(key, 0) + 1
+        return GenerationDecision(settings, request_class, load_level)
+    
+    def get_stats(self) -> Dict:
+        return {
+            'enabled': config.adaptive_generation,
+            'load_level': self.load_level(),
+            'decisions': dict(self.decisions)
+        }
+
+generation_policy = GenerationPolicy(gemini_manager)
+
+# In-memory chat history
+class ChatHistory(list):
+    """Gemini-format history turns plus the tokens they cost"""
+    def __init__(self, turns=(), token_count: int = 0, bot_id: int = None, chat_id: int = None):
+        super().__init__(turns)
+        self.token_count = token_count
+        self.bot_id = bot_id
+        self.chat_id = chat_id
+
+class HistoryBuffer:
+    """Per-chat ring buffers of recent turns, kept under a global memory cap.
+    
+    Chats are keyed by (bot_id, chat_id). Cold loads read SQLite without the
+    lock and are only installed if no write touched the chat meanwhile.
+    """
+    TURN_OVERHEAD = 200  # rough bytes per turn beyond the text itself
+    
+    def __init__(self, max_turns: int, max_bytes: int):
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self.chats: OrderedDict = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.RLock()
+        self.versions: Dict[Tuple[int, int], int] = {}  # bumped by every change to a chat
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def _turn_size(self, turn: Dict) -> int:
+        return len(turn['message_text'] or '') + len(turn['response_text'] or '') + self.TURN_OVERHEAD
+    
+    def get(self, chat_key: Tuple[int, int]) -> Optional[Tuple[Optional[Dict], List[Dict]]]:
+        """Summary and turns (newest first) for a buffered chat, None on a miss"""
+        with self.lock:
+            entry = self.chats.get(chat_key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.chats.move_to_end(chat_key)
+            self.hits += 1
+            return entry['summary'], list(reversed(entry['turns']))
+    
+    def version(self, chat_key: Tuple[int, int]) -> int:
+        """Take before a cold read and pass to load()"""
+        with self.lock:
+            return self.versions.get(chat_key, 0)
+    
+    def _changed(self, chat_key: Tuple[int, int]):
+        self.versions[chat_key] = self.versions.get(chat_key, 0) + 1
+    
+    def load(self, chat_key: Tuple[int, int], summary: Optional[Dict], turns: List[Dict],
+             version: int) -> bool:
+        """Fill a chat's buffer after a cold read (turns newest first).
+        
+        Returns False without installing anything if the chat changed since version was taken.
+        """
+        with self.lock:
+            if self.versions.get(chat_key, 0) != version:
+                return False
+            self._drop(chat_key)
+            entry = {'summary': summary, 'turns': deque(), 'bytes': 0}
+            self.chats[chat_key] = entry
+            for turn in reversed(turns[:self.max_turns]):
+                self._push(entry, turn)
+            self._evict()
+            return True
+    
+    def append(self, chat_key: Tuple[int, int], turn: Dict):
+        """Write-through of a newly saved turn; chats not in memory stay cold"""
+        with self.lock:
+            self._changed(chat_key)
+            entry = self.chats.get(chat_key)
+            if entry is None:
+                return
+            if entry['turns'] and entry['turns'][-1]['id'] >= turn['id']:
+                return  # already picked up by a concurrent cold load
+            self._push(entry, turn)
+            self.chats.move_to_end(chat_key)
+            self._evict()
+    
+    def resolve_ids(self, chat_key: Tuple[int, int], ids: Dict[int, int]):
+        """Replace provisional write-behind ids with the ids SQLite assigned"""
+        with self.lock:
+            self._changed(chat_key)
+            entry = self.chats.get(chat_key)
+            if entry is None:
+                return
+            for turn in entry['turns']:
+                turn['id'] = ids.get(turn['id'], turn['id'])
+    
+    def set_summary(self, chat_key: Tuple[int, int], summary: Dict):
+        """Record a new summary and drop the turns it covers"""
+        with self.lock:
+            self._changed(chat_key)
+            entry = self.chats.get(chat_key)
+            if entry is None:
+                return
+            entry['summary'] = summary
+            while entry['turns'] and entry['turns'][0]['id'] <= summary['summarized_until']:
+                self._pop_oldest(entry)
+    
+    def unsummarized(self, chat_key: Tuple[int, int]) -> Optional[Tuple[int, int]]:
+        """Buffered turn count and (estimated) tokens, None if the chat isn't buffered.
+        
+        All unsummarized turns are in memory while the count is below max_turns.
+        """
+        with self.lock:
+            entry = self.chats.get(chat_key)
+            if entry is None:
+                return None
+            tokens = sum(
+                turn['token_count'] if turn['token_count'] is not None
+                else GeminiManager.estimate_text_tokens(turn['message_text'], turn['response_text'])
+                for turn in entry['turns']
+            )
+            return len(entry['turns']), tokens
+    
+    def invalidate(self, chat_key: Tuple[int, int]):
+        with self.lock:
+            self._changed(chat_key)
+            self._drop(chat_key)
+    
+    def _drop(self, chat_key: Tuple[int, int]):
+        entry = self.chats.pop(chat_key, None)
+        if entry:
+            self.total_bytes -= entry['bytes']
+    
+    def _push(self, entry: Dict, turn: Dict):
+        if len(entry['turns']) >= self.max_turns:
+            self._pop_oldest(entry)
+        entry['turns'].append(turn)
+        size = self._turn_size(turn)
+        entry['bytes'] += size
+        self.total_bytes += size
+    
+    def _pop_oldest(self, entry: Dict):
+        size = self._turn_size(entry['turns'].popleft())
+        entry['bytes'] -= size
+        self.total_bytes -= size
+    
+    def _evict(self):
+        """Drop least recently used chats until we're under the memory cap"""
+        while self.total_bytes > self.max_bytes and len(self.chats) > 1:
+            _, entry = self.chats.popitem(last=False)
+            self.total_bytes -= entry['bytes']
+            self.evictions += 1
+    
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'chats': len(self.chats),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups * 100, 1) if lookups else 0
+        }
+
+# Initialize history buffer
+history_buffer = HistoryBuffer(config.max_history_messages, config.history_buffer_max_bytes)
+
+# Pooled SQLite connections
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() hands it back to its pool"""
+    pool = None
+    
+    def close(self):
+        if self.pool is None:
+            super().close()
+        else:
+            self.pool.release(self)
+    
+    def discard(self):
+        super().close()
+
+class ConnectionPool:
+    """Fixed set of tuned SQLite connections, one per thread while checked out.
+    
+    A thread asking again while it already holds a connection gets the same
+    one back, and only the outermost close() returns it. Connections held by
+    threads that died without closing them are reclaimed when the pool runs dry.
+    """
+    PRAGMAS = (
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA temp_store=MEMORY'
+    )
+    
+    def __init__(self, db_name: str, size: int, timeout: float = 30):
+        self.db_name = db_name
+        self.size = size
+        self.timeout = timeout
+        self.idle: queue.LifoQueue = queue.LifoQueue()  # most recently used first keeps caches warm
+        self.owners: Dict[PooledConnection, threading.Thread] = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.reclaimed = 0
+    
+    def _connect(self) -> PooledConnection:
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=self.timeout,
+            check_same_thread=False,
+            factory=PooledConnection,
+            cached_statements=config.db_cached_statements
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        conn.execute(f'PRAGMA cache_size=-{config.db_cache_kb}')
+        conn.execute(f'PRAGMA mmap_size={config.db_mmap_bytes}')
+        conn.pool = self
+        return conn
+    
+    def _reclaim(self):
+        """Return connections whose owning thread exited without closing them"""
+        with self.lock:
+            orphans = [conn for conn, thread in self.owners.items() if not thread.is_alive()]
+            for conn in orphans:
+                del self.owners[conn]
+        for conn in orphans:
+            conn.rollback()
+            self.idle.put(conn)
+        self.reclaimed += len(orphans)
+    
+    def acquire(self) -> PooledConnection:
+        held = getattr(self.local, 'conn', None)
+        if held is not None:
+            self.local.depth += 1
+            return held
+        
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if create:
+                try:
+                    conn = self._connect()
+                except sqlite3.Error:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            else:
+                self.waits += 1
+                self._reclaim()
+                try:
+                    conn = self.idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError(
+                        f"No database connection free after {self.timeout}s"
+                    )
+        
+        with self.lock:
+            self.owners[conn] = threading.current_thread()
+        self.local.conn = conn
+        self.local.depth = 1
+        self.checkouts += 1
+        return conn
+    
+    def release(self, conn: PooledConnection):
+        if getattr(self.local, 'conn', None) is conn:
+            self.local.depth -= 1
+            if self.local.depth:
+                return
+            self.local.conn = None
+        with self.lock:
+            if self.owners.pop(conn, None) is None:
+                return  # already returned
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put(conn)
+    
+    def close_all(self):
+        while True:
+            try:
+                self.idle.get_nowait().discard()
+            except queue.Empty:
+                break
+    
+    def get_stats(self) -> Dict:
+        return {
+            'size': self.size,
+            'open': self.created,
+            'in_use': len(self.owners),
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'reclaimed': self.reclaimed
+        }
+
+# Write-behind batching
+class WriteBehindBuffer:
+    """Queue message writes and commit them in one transaction per flush.
+    
+    A background thread flushes with executemany every write_behind_interval_ms,
+    or sooner once write_behind_batch_rows are waiting; writers only block when
+    write_behind_max_pending rows are queued. SQLite assigns the real message
+    ids on insert; until then a row carries a provisional id above any real
+    one, which pending_turns() and the history buffer use so history reads
+    see rows that aren't committed yet. resolve_id() maps it to the real id.
+    """
+    PROVISIONAL_ID_BASE = 1 << 62  # far above any rowid SQLite hands out
+    RESOLVED_IDS_KEPT = 10000
+    MESSAGE_COLUMNS = (
+        'id', 'bot_id', 'user_id', 'chat_id', 'message_text', 'response_text', 'tokens_used',
+        'processing_time', 'model_used', 'status', 'error_message', 'prompt_tokens',
+        'candidate_tokens', 'history_tokens', 'cost_usd', 'generation_policy', 'queue_wait',
+        'token_count', 'timestamp'
+    )
+    INSERT_SQL = f'''
+        INSERT INTO messages ({', '.join(MESSAGE_COLUMNS[1:])})
+        VALUES ({', '.join('?' * (len(MESSAGE_COLUMNS) - 1))})
+    '''
+    
+    def __init__(self, db, interval: float, batch_rows: int, max_pending: int):
+        self.db = db
+        self.interval = interval
+        self.batch_rows = batch_rows
+        self.max_pending = max_pending
+        self.messages: List[Tuple] = []
+        self.in_flight: List[Tuple] = []  # messages being committed, still visible to reads
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.next_provisional_id = self.PROVISIONAL_ID_BASE
+        self.resolved: OrderedDict = OrderedDict()  # provisional id -> real id, recent flushes
+        self.thread: Optional[threading.Thread] = None
+        self.flushes = 0
+        self.forced_flushes = 0
+        self.failed_flushes = 0
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.max_batch = 0
+    
+    @staticmethod
+    def now() -> str:
+        """UTC timestamp in SQLite's CURRENT_TIMESTAMP format"""
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+    
+    def _pending(self) -> int:
+        return len(self.messages)
+    
+    @classmethod
+    def is_provisional(cls, message_id: int) -> bool:
+        return message_id >= cls.PROVISIONAL_ID_BASE
+    
+    def resolve_id(self, message_id: int) -> Optional[int]:
+        """Real id of a message; None if a provisional id isn't committed (or is too old to remember)"""
+        if not self.is_provisional(message_id):
+            return message_id
+        with self.lock:
+            return self.resolved.get(message_id)
+    
+    def _queued(self):
+        """Start the flusher on first use and flush early when the buffer fills up"""
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                    self.thread.start()
+                    atexit.register(self.flush)
+        pending = self._pending()
+        if pending >= self.max_pending:
+            self.forced_flushes += 1
+            self.flush()
+        elif pending >= self.batch_rows:
+            self.wakeup.set()
+    
+    def add_message(self, values: Dict) -> int:
+        """Queue a messages row; returns its provisional id"""
+        with self.lock:
+            message_id = self.next_provisional_id
+            self.next_provisional_id += 1
+            values = dict(values, id=message_id, timestamp=self.now())
+            self.messages.append(tuple(values.get(column) for column in self.MESSAGE_COLUMNS))
+        self._queued()
+        return message_id
+    
+    def pending_turns(self, bot_id: int, chat_id: int, after_id: int) -> List[Dict]:
+        """Successful turns for the chat that haven't been committed yet, newest first"""
+        with self.lock:
+            rows = [
+                dict(zip(self.MESSAGE_COLUMNS, row))
+                for row in self.in_flight + self.messages
+                if row[1] == bot_id and row[3] == chat_id and row[9] == 'success'
+            ]
+            # Rows of the batch being committed may already be readable under their real id
+            for row in rows:
+                row['id'] = self.resolved.get(row['id'], row['id'])
+        rows = [row for row in rows if row['id'] > after_id]
+        rows.reverse()
+        return rows
+    
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+                self.db.activity.flush_if_due()
+            except Exception as e:
+                logger.error(f"Write-behind flush failed: {e}")
+    
+    def flush(self):
+        """Commit everything queued so far in one transaction"""
+        with self.flush_lock:
+            with self.lock:
+                messages, self.messages = self.messages, []
+                self.in_flight = messages
+            batch = len(messages)
+            if not batch:
+                return
+            
+            conn = self.db.get_connection()
+            ids = {}
+            try:
+                ids, rejected = self._insert(conn, messages)
+                # Publish the real ids before commit so reads never see a row twice
+                with self.lock:
+                    self.resolved.update(ids)
+                conn.commit()
+                self.flushes += 1
+                self.rows_written += len(ids)
+                self.rows_dropped += rejected
+                self.max_batch = max(self.max_batch, batch)
+                self._forget_old_ids()
+                self._resolve_history(messages, ids)
+            except sqlite3.Error as e:
+                conn.rollback()
+                with self.lock:
+                    for provisional_id in ids:
+                        self.resolved.pop(provisional_id, None)
+                self.failed_flushes += 1
+                if self._pending() + batch > self.max_pending:
+                    self.rows_dropped += batch
+                    logger.error(f"Write-behind flush failed, dropped {batch} rows: {e}")
+                else:
+                    # Put the batch back in front of newer writes and retry next time
+                    logger.warning(f"Write-behind flush failed, will retry {batch} rows: {e}")
+                    with self.lock:
+                        self.messages[:0] = messages
+            finally:
+                with self.lock:
+                    self.in_flight = []
+                conn.close()
+    
+    def _insert(self, conn, messages: List[Tuple]) -> Tuple[Dict[int, int], int]:
+        """Insert a batch in the open transaction; returns provisional -> real ids and the rejected count.
+        
+        Ids can't collide, so an IntegrityError means the row itself is invalid
+        (e.g. a NOT NULL column); only that statement is rolled back.
+        """
+        cursor = conn.cursor()
+        ids = {}
+        rejected = 0
+        for row in messages:
+            try:
+                cursor.execute(self.INSERT_SQL, row[1:])
+            except sqlite3.IntegrityError as e:
+                rejected += 1
+                logger.error(f"Write-behind rejected an invalid message row for chat {row[3]}: {e}")
+                continue
+            ids[row[0]] = cursor.lastrowid
+        return ids, rejected
+    
+    def _forget_old_ids(self):
+        with self.lock:
+            while len(self.resolved) > self.RESOLVED_IDS_KEPT:
+                self.resolved.popitem(last=False)
+    
+    @staticmethod
+    def _resolve_history(messages: List[Tuple], ids: Dict[int, int]):
+        """Swap provisional ids in the history buffer for the real ones"""
+        by_chat: Dict[Tuple[int, int], Dict[int, int]] = {}
+        for row in messages:
+            if row[9] == 'success' and row[0] in ids:
+                by_chat.setdefault((row[1], row[3]), {})[row[0]] = ids[row[0]]
+        for chat_key, chat_ids in by_chat.items():
+            history_buffer.resolve_ids(chat_key, chat_ids)
+    
+    def get_stats(self) -> Dict:
+        return {
+            'pending': self._pending(),
+            'flushes': self.flushes,
+            'forced_flushes': self.forced_flushes,
+            'failed_flushes': self.failed_flushes,
+            'rows_written': self.rows_written,
+            'rows_dropped': self.rows_dropped,
+            'avg_batch': round(self.rows_written / max(1, self.flushes), 1),
+            'max_batch': self.max_batch
+        }
+
+# User and group activity
+class ActivityTracker:
+    """In-memory table of known users and groups in front of the users/groups tables.
+    
+    Profile rows are written only when a field actually changes (or on first
+    sight in this process). last_active / last_activity are buffered and
+    upserted together every activity_flush_interval seconds, so a chatty user
+    costs one row write per interval instead of one per message.
+    """
+    USER_UPSERT = '''
+        INSERT INTO users
+        (user_id, username, first_name, last_name, language_code, is_premium, last_active, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username = excluded.username,
+            first_name = excluded.first_name,
+            last_name = excluded.last_name,
+            language_code = excluded.language_code,
+            is_premium = excluded.is_premium,
+            last_active = excluded.last_active,
+            updated_at = excluded.updated_at
+    '''
+    USER_ACTIVITY_UPSERT = '''
+        INSERT INTO users (user_id, last_active) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET last_active = excluded.last_active
+    '''
+    GROUP_UPSERT = '''
+        INSERT INTO groups (bot_id, group_id, title, type, last_activity)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(bot_id, group_id) DO UPDATE SET
+            title = excluded.title,
+            type = excluded.type,
+            last_activity = excluded.last_activity
+    '''
+    GROUP_ACTIVITY_UPSERT = '''
+        INSERT INTO groups (bot_id, group_id, last_activity) VALUES (?, ?, ?)
+        ON CONFLICT(bot_id, group_id) DO UPDATE SET last_activity = excluded.last_activity
+    '''
+    
+    def __init__(self, db, flush_interval: float):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.users: Dict[int, Tuple] = {}  # user_id -> profile as last written
+        self.groups: Dict[Tuple[int, int], Tuple] = {}  # (bot_id, group_id) -> (title, type)
+        self.bot_users: set = set()
+        self.user_profiles: Dict[int, Tuple] = {}  # pending profile upserts
+        self.group_profiles: Dict[Tuple[int, int], Tuple] = {}
+        self.new_bot_users: set = set()
+        self.user_activity: Dict[int, str] = {}  # pending last_active
+        self.group_activity: Dict[Tuple[int, int], str] = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.last_flush = time.time()
+        self.touches = 0
+        self.rows_written = 0
+        self.flushes = 0
+    
+    @staticmethod
+    def _user_profile(user_data) -> Tuple:
+        return (
+            user_data.username,
+            user_data.first_name,
+            user_data.last_name,
+            getattr(user_data, 'language_code', 'en'),
+            bool(getattr(user_data, 'is_premium', False))
+        )
+    
+    def touch_user(self, user_data, bot_id: int):
+        """Record that a user was active; profile and bot link are written only if new"""
+        now = WriteBehindBuffer.now()
+        profile = self._user_profile(user_data)
+        with self.lock:
+            self.touches += 1
+            if self.users.get(user_data.id) != profile:
+                self.users[user_data.id] = profile
+                self.user_profiles[user_data.id] = (user_data.id, *profile, now, now)
+            else:
+                self.user_activity[user_data.id] = now
+            if (bot_id, user_data.id) not in self.bot_users:
+                self.bot_users.add((bot_id, user_data.id))
+                self.new_bot_users.add((bot_id, user_data.id))
+        self.flush_if_due()
+    
+    def touch_group(self, bot_id: int, group_id: int, title: str, group_type: str):
+        """Record group activity; title or type changes are written with the next flush"""
+        now = WriteBehindBuffer.now()
+        key = (bot_id, group_id)
+        with self.lock:
+            self.touches += 1
+            if self.groups.get(key) != (title, group_type):
+                self.groups[key] = (title, group_type)
+                self.group_profiles[key] = (bot_id, group_id, title, group_type, now)
+            else:
+                self.group_activity[key] = now
+        self.flush_if_due()
+    
+    def flush_if_due(self):
+        """Flush when the activity interval has passed.
+        
+        New users, new groups and profile changes are not held that long: they
+        go out with the write-behind interval, or immediately without write-behind.
+        """
+        with self.lock:
+            changed = bool(self.user_profiles or self.group_profiles or self.new_bot_users)
+        if changed:
+            interval = self.db.writes.interval if self.db.writes else 0
+        else:
+            interval = self.flush_interval
+        if time.time() - self.last_flush >= interval:
+            self.flush()
+    
+    def flush(self):
+        """Write pending profile changes, bot links and activity timestamps in one transaction"""
+        with self.flush_lock:
+            with self.lock:
+                self.last_flush = time.time()
+                user_profiles, self.user_profiles = self.user_profiles, {}
+                group_profiles, self.group_profiles = self.group_profiles, {}
+                new_bot_users, self.new_bot_users = self.new_bot_users, set()
+                user_activity, self.user_activity = self.user_activity, {}
+                group_activity, self.group_activity = self.group_activity, {}
+            rows = (len(user_profiles) + len(group_profiles) + len(new_bot_users)
+                    + len(user_activity) + len(group_activity))
+            if not rows:
+                return
+            
+            conn = self.db.get_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.executemany(self.USER_UPSERT, user_profiles.values())
+                cursor.executemany('INSERT OR IGNORE INTO bot_users (bot_id, user_id) VALUES (?, ?)',
+                                   new_bot_users)
+                cursor.executemany(self.USER_ACTIVITY_UPSERT, user_activity.items())
+                cursor.executemany(self.GROUP_UPSERT, group_profiles.values())
+                cursor.executemany(self.GROUP_ACTIVITY_UPSERT,
+                                   [(*key, ts) for key, ts in group_activity.items()])
+                conn.commit()
+                self.flushes += 1
+                self.rows_written += rows
+            except sqlite3.Error as e:
+                conn.rollback()
+                logger.error(f"Database error in ActivityTracker.flush: {e}")
+                # Forget what we thought was stored so the next touch rewrites it
+                with self.lock:
+                    for user_id in user_profiles:
+                        self.users.pop(user_id, None)
+                    for key in group_profiles:
+                        self.groups.pop(key, None)
+                    self.bot_users -= new_bot_users
+            finally:
+                conn.close()
+    
+    def get_stats(self) -> Dict:
+        return {
+            'known_users': len(self.users),
+            'known_groups': len(self.groups),
+            'touches': self.touches,
+            'rows_written': self.rows_written,
+            'writes_per_touch': round(self.rows_written / max(1, self.touches), 3),
+            'flushes': self.flushes
+        }
+
 # Enhanced Database Management
 class DatabaseManager:
-    def __init__(self, db_name: str):
+    def __init__(self, db_name: str, pool_size: int = 0, write_behind: bool = False):
         self.db_name = db_name
+        self.pool = ConnectionPool(db_name, pool_size) if pool_size else None
+        self.writes = WriteBehindBuffer(
+            self,
+            config.write_behind_interval_ms / 1000,
+            config.write_behind_batch_rows,
+            config.write_behind_max_pending
+        ) if write_behind else None
+        self.activity = ActivityTracker(self, config.activity_flush_interval)
+        self.analytics_lock = threading.Lock()
+        atexit.register(self.activity.flush)
         self.init_db()
     
+    def flush_writes(self):
+        """Commit queued write-behind rows before reads that need to see them"""
+        if self.writes:
+            self.writes.flush()
+    
+    def flush_all(self):
+        """Commit queued messages and buffered activity, e.g. at shutdown"""
+        self.flush_writes()
+        self.activity.flush()
+    
     def get_connection(self):
         """Get database connection with proper configuration"""
+        if self.pool:
+            return self.pool.acquire()
         conn = sqlite3.connect(
             self.db_name,
             timeout=30,
@@ -286,17 +2530,31 @@ class DatabaseManager:
             )
         ''')
         
-        # Groups table with enhanced info
-        cursor.execute('''
+        # Groups table with enhanced info, one row per bot and group
+        groups_sql = '''
             CREATE TABLE IF NOT EXISTS groups (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                group_id INTEGER UNIQUE NOT NULL,
+                bot_id INTEGER NOT NULL DEFAULT 0,
+                group_id INTEGER NOT NULL,
                 title TEXT,
                 type TEXT,
                 is_active INTEGER DEFAULT 1,
                 member_count INTEGER DEFAULT 0,
                 last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (bot_id, group_id)
+            )
+        '''
+        cursor.execute(groups_sql)
+        self._rebuild_with_bot_id(cursor, 'groups', groups_sql)
+        
+        # Users each hosted bot has seen
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bot_users (
+                bot_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (bot_id, user_id)
             )
         ''')
         
@@ -314,6 +2572,49 @@ class DatabaseManager:
             )
         ''')
         
+        # Per-user daily rollups; exact distinct users per day and the /stats totals
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analytics_users (
+                date DATE NOT NULL,
+                bot_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                messages INTEGER DEFAULT 0,
+                tokens_used INTEGER DEFAULT 0,
+                response_time_total REAL DEFAULT 0,
+                responses INTEGER DEFAULT 0,
+                last_message TIMESTAMP,
+                PRIMARY KEY (date, bot_id, user_id)
+            ) WITHOUT ROWID
+        ''')
+        
+        # Daily token, cost and latency totals per user, chat, model and bot
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'analytics_usage'")
+        backfill_usage = cursor.fetchone() is None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analytics_usage (
+                date DATE NOT NULL,
+                dimension TEXT NOT NULL,
+                key,
+                messages INTEGER DEFAULT 0,
+                prompt_tokens INTEGER DEFAULT 0,
+                candidate_tokens INTEGER DEFAULT 0,
+                total_tokens INTEGER DEFAULT 0,
+                history_tokens INTEGER DEFAULT 0,
+                cost_usd REAL DEFAULT 0,
+                response_time_total REAL DEFAULT 0,
+                responses INTEGER DEFAULT 0,
+                PRIMARY KEY (date, dimension, key)
+            ) WITHOUT ROWID
+        ''')
+        
+        # Rollup progress (id of the last message folded into analytics)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analytics_state (
+                name TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        ''')
+        
         # Admin users table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS admin_users (
@@ -325,181 +2626,1573 @@ class DatabaseManager:
             )
         ''')
         
+        # Prompt -> response cache for stateless requests
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS response_cache (
+                cache_key TEXT PRIMARY KEY,
+                prompt TEXT NOT NULL,
+                model_name TEXT,
+                response_text TEXT NOT NULL,
+                hit_count INTEGER DEFAULT 0,
+                created_at REAL NOT NULL,
+                last_hit REAL NOT NULL
+            )
+        ''')
+        
+        # Rolling per-chat summaries of older turns
+        summaries_sql = '''
+            CREATE TABLE IF NOT EXISTS chat_summaries (
+                bot_id INTEGER NOT NULL DEFAULT 0,
+                chat_id INTEGER NOT NULL,
+                summary TEXT NOT NULL,
+                summarized_until INTEGER NOT NULL,
+                token_count INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (bot_id, chat_id)
+            )
+        '''
+        cursor.execute(summaries_sql)
+        self._rebuild_with_bot_id(cursor, 'chat_summaries', summaries_sql)
+        
+        # Answers for the semantic cache; ids match the vector index slots
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS semantic_cache (
+                id INTEGER PRIMARY KEY,
+                prompt TEXT NOT NULL,
+                model_name TEXT,
+                response_text TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        
+        # Columns added after the original schema
+        self._ensure_column(cursor, 'messages', 'token_count', 'INTEGER')
+        self._ensure_column(cursor, 'messages', 'prompt_tokens', 'INTEGER DEFAULT 0')
+        self._ensure_column(cursor, 'messages', 'candidate_tokens', 'INTEGER DEFAULT 0')
+        self._ensure_column(cursor, 'messages', 'history_tokens', 'INTEGER DEFAULT 0')
+        self._ensure_column(cursor, 'messages', 'cost_usd', 'REAL DEFAULT 0')
+        self._ensure_column(cursor, 'messages', 'generation_policy', 'TEXT')
+        self._ensure_column(cursor, 'messages', 'bot_id', 'INTEGER DEFAULT 0')
+        self._ensure_column(cursor, 'messages', 'queue_wait', 'REAL')  # seconds waiting for a generation slot
+        self._ensure_column(cursor, 'analytics', 'cancelled', 'INTEGER DEFAULT 0')
+        self._ensure_column(cursor, 'analytics', 'total_tokens', 'INTEGER DEFAULT 0')
+        self._ensure_column(cursor, 'analytics', 'cost_usd', 'REAL DEFAULT 0')
+        self._ensure_column(cursor, 'analytics', 'response_time_total', 'REAL DEFAULT 0')
+        self._ensure_column(cursor, 'analytics', 'responses', 'INTEGER DEFAULT 0')  # messages with a processing_time
+        self._ensure_column(cursor, 'analytics', 'closed', 'INTEGER DEFAULT 0')  # day is over, totals are final
+        if backfill_usage:
+            self._backfill_usage(cursor)
+        
         # Create indexes for better performance
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_bot_chat ON messages(bot_id, chat_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_user_id ON users(user_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_analytics_date ON analytics(date)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_analytics_users_user ON analytics_users(bot_id, user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_last_hit ON response_cache(last_hit)')
+        
+        conn.commit()
+        conn.close()
+        logger.info("Database initialized successfully")
+    
+    def _ensure_column(self, cursor, table: str, column: str, definition: str):
+        """Add a column to an existing table if it is missing"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in [row['name'] for row in cursor.fetchall()]:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            logger.info(f"Added column {table}.{column}")
+    
+    def _backfill_usage(self, cursor):
+        """Fill a new analytics_usage table for the messages already rolled up"""
+        cursor.execute("SELECT value FROM analytics_state WHERE name = 'last_message_id'")
+        row = cursor.fetchone()
+        if not row:
+            return  # the rollup job will read every message anyway
+        for dimension in self.USAGE_DIMENSIONS:
+            cursor.execute('''
+                INSERT INTO analytics_usage
+                (date, dimension, key, messages, prompt_tokens, candidate_tokens, total_tokens,
+                 history_tokens, cost_usd, response_time_total, responses)
+                SELECT DATE(timestamp), ?, {0}, COUNT(*), TOTAL(prompt_tokens), TOTAL(candidate_tokens),
+                       TOTAL(tokens_used), TOTAL(history_tokens), TOTAL(cost_usd),
+                       TOTAL(CASE WHEN processing_time > 0 THEN processing_time END),
+                       COUNT(CASE WHEN processing_time > 0 THEN 1 END)
+                FROM messages
+                WHERE id <= ?
+                GROUP BY DATE(timestamp), {0}
+            '''.format(dimension), (dimension, row['value']))
+        logger.info("Backfilled analytics_usage from existing messages")
+    
+    def _rebuild_with_bot_id(self, cursor, table: str, create_sql: str):
+        """Recreate a pre-multi-bot table whose keys now include bot_id, keeping its rows"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        columns = [row['name'] for row in cursor.fetchall()]
+        if 'bot_id' in columns:
+            return
+        column_list = ', '.join(columns)
+        cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_legacy')
+        cursor.execute(create_sql)
+        cursor.execute(f'INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {table}_legacy')
+        cursor.execute(f'DROP TABLE {table}_legacy')
+        logger.info(f"Partitioned {table} by bot_id")
+    
+    def adopt_legacy_rows(self, bot_id: int):
+        """Hand rows saved before multi-bot hosting (bot_id 0) to the primary bot"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            adopted = 0
+            for table in ('messages', 'chat_summaries', 'groups'):
+                cursor.execute(f'UPDATE OR IGNORE {table} SET bot_id = ? WHERE bot_id = 0', (bot_id,))
+                adopted += cursor.rowcount
+                cursor.execute(f'DELETE FROM {table} WHERE bot_id = 0')
+            cursor.execute('SELECT COUNT(*) FROM bot_users')
+            if cursor.fetchone()[0] == 0:
+                cursor.execute('INSERT OR IGNORE INTO bot_users (bot_id, user_id) SELECT ?, user_id FROM users',
+                               (bot_id,))
+                adopted += cursor.rowcount
+            conn.commit()
+            if adopted:
+                logger.info(f"Assigned {adopted} pre-multi-bot rows to bot {bot_id}")
+        except sqlite3.Error as e:
+            logger.error(f"Database error in adopt_legacy_rows: {e}")
+        finally:
+            conn.close()
+    
+    def register_user(self, user_data, bot_id: int) -> bool:
+        """Register or update user; unchanged profiles only bump the buffered last_active"""
+        self.activity.touch_user(user_data, bot_id)
+        return True
+    
+    def register_group(self, bot_id: int, group_id: int, title: str, group_type: str = 'group') -> bool:
+        """Register or update group information"""
+        self.activity.touch_group(bot_id, group_id, title, group_type)
+        return True
+    
+    def save_message(self, bot_id: int, user_id: int, chat_id: int, message: str, response: str, 
+                    tokens_used: int = 0, processing_time: float = 0, 
+                    model_used: str = None, status: str = 'success', 
+                    error_message: str = None, prompt_tokens: int = 0,
+                    candidate_tokens: int = 0, history_tokens: int = 0,
+                    cost_usd: float = 0, generation_policy: str = None,
+                    queue_wait: float = None, token_count: int = None) -> bool:
+        """Save message with enhanced tracking; token_count is the turn's size for history budgeting"""
+        if self.writes:
+            message_id = self.writes.add_message({
+                'bot_id': bot_id,
+                'user_id': user_id,
+                'chat_id': chat_id,
+                'message_text': message,
+                'response_text': response,
+                'tokens_used': tokens_used,
+                'processing_time': processing_time,
+                'model_used': model_used or gemini_manager.model_name,
+                'status': status,
+                'error_message': error_message,
+                'prompt_tokens': prompt_tokens,
+                'candidate_tokens': candidate_tokens,
+                'history_tokens': history_tokens,
+                'cost_usd': cost_usd,
+                'generation_policy': generation_policy,
+                'queue_wait': queue_wait,
+                'token_count': token_count
+            })
+            if status == 'success':
+                history_buffer.append((bot_id, chat_id), {
+                    'id': message_id,
+                    'message_text': message,
+                    'response_text': response,
+                    'token_count': token_count
+                })
+            return True
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                INSERT INTO messages 
+                (user_id, chat_id, message_text, response_text, tokens_used, 
+                 processing_time, model_used, status, error_message,
+                 prompt_tokens, candidate_tokens, history_tokens, cost_usd,
+                 generation_policy, bot_id, queue_wait, token_count)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, chat_id, message, response, tokens_used, 
+                  processing_time, model_used or gemini_manager.model_name, 
+                  status, error_message, prompt_tokens, candidate_tokens,
+                  history_tokens, cost_usd, generation_policy, bot_id, queue_wait, token_count))
+            conn.commit()
+            if status == 'success':
+                history_buffer.append((bot_id, chat_id), {
+                    'id': cursor.lastrowid,
+                    'message_text': message,
+                    'response_text': response,
+                    'token_count': token_count
+                })
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Database error in save_message: {e}")
+            return False
+        finally:
+            conn.close()
+    
+    def _load_recent_turns(self, cursor, bot_id: int, chat_id: int,
+                           limit: int) -> Tuple[Optional[Dict], List[Dict]]:
+        """Chat summary and the latest unsummarized turns (newest first) from SQLite"""
+        cursor.execute('''
+            SELECT summary, summarized_until, token_count FROM chat_summaries
+            WHERE bot_id = ? AND chat_id = ?
+        ''', (bot_id, chat_id))
+        summary = cursor.fetchone()
+        summary = dict(summary) if summary else None
+        
+        after_id = summary['summarized_until'] if summary else 0
+        cursor.execute('''
+            SELECT id, message_text, response_text, token_count
+            FROM messages 
+            WHERE bot_id = ? AND chat_id = ? AND status = 'success' AND id > ?
+            ORDER BY id DESC 
+            LIMIT ?
+        ''', (bot_id, chat_id, after_id, limit))
+        rows = [dict(row) for row in cursor.fetchall()]
+        if self.writes:
+            # Overlay turns still waiting in the write-behind buffer
+            pending = self.writes.pending_turns(bot_id, chat_id, after_id)
+            if pending:
+                stored = {row['id'] for row in rows}
+                rows = sorted(
+                    rows + [row for row in pending if row['id'] not in stored],
+                    key=lambda row: row['id'], reverse=True
+                )[:limit]
+        return summary, rows
+    
+    def get_chat_history(self, bot_id: int, chat_id: int, limit: int = None,
+                         token_budget: int = None) -> ChatHistory:
+        """Get chat summary plus recent turns, packed newest-first into the token budget"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            limit = limit or config.max_history_messages
+            token_budget = token_budget or config.max_history_tokens
+            
+            # Serve from memory, touching SQLite only on a cold miss. The read
+            # runs without the buffer lock; if a write lands meanwhile the result
+            # is used for this request but not cached.
+            chat_key = (bot_id, chat_id)
+            buffered = history_buffer.get(chat_key) if limit <= history_buffer.max_turns else None
+            if buffered is None:
+                version = history_buffer.version(chat_key)
+                summary, rows = self._load_recent_turns(
+                    cursor, bot_id, chat_id, max(limit, history_buffer.max_turns)
+                )
+                history_buffer.load(chat_key, summary, rows, version)
+            else:
+                summary, rows = buffered
+            rows = rows[:limit]
+            summary_tokens = summary['token_count'] if summary else 0
+            
+            # Turns are counted when saved; estimate older rows saved without a count
+            for row in rows:
+                if row['token_count'] is None:
+                    row['token_count'] = GeminiManager.estimate_text_tokens(
+                        row['message_text'], row['response_text']
+                    )
+            
+            # Pack newest turns first until the budget is used up
+            packed = []
+            used_tokens = summary_tokens
+            for row in rows:
+                if used_tokens + row['token_count'] > token_budget:
+                    break
+                packed.append(row)
+                used_tokens += row['token_count']
+            
+            total_tokens = summary_tokens + sum(row['token_count'] for row in rows)
+            if rows or summary:
+                logger.info(
+                    f"History for chat {chat_id}: {'summary + ' if summary else ''}"
+                    f"{len(packed)}/{len(rows)} turns, "
+                    f"{used_tokens}/{total_tokens} tokens (saved {total_tokens - used_tokens})"
+                )
+            
+            history = ChatHistory(token_count=used_tokens, bot_id=bot_id, chat_id=chat_id)
+            if summary:
+                history.append({'role': 'user', 'parts': [
+                    f"Summary of our earlier conversation:\n{summary['summary']}"
+                ]})
+                history.append({'role': 'model', 'parts': ["Got it, I'll keep that in mind."]})
+            for row in reversed(packed):
+                history.append({'role': 'user', 'parts': [row['message_text']]})
+                history.append({'role': 'model', 'parts': [row['response_text']]})
+            
+            return history
+        except sqlite3.Error as e:
+            logger.error(f"Database error in get_chat_history: {e}")
+            return ChatHistory()
+        finally:
+            conn.close()
+    
+    def get_turns_to_summarize(self, bot_id: int, chat_id: int) -> Tuple[Optional[Dict], List[Dict]]:
+        """Current summary and the unsummarized turns older than the recent window"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                SELECT summary, summarized_until FROM chat_summaries
+                WHERE bot_id = ? AND chat_id = ?
+            ''', (bot_id, chat_id))
+            summary = cursor.fetchone()
+            summary = dict(summary) if summary else None
+            after_id = summary['summarized_until'] if summary else 0
+            # Enough oldest turns for one pass plus the recent window that stays verbatim
+            limit = config.summary_max_turns_per_pass + config.summary_keep_recent
+            
+            cursor.execute('''
+                SELECT id, message_text, response_text,
+                       COALESCE(token_count, LENGTH(message_text || response_text) / 4 + 1) AS token_count
+                FROM messages
+                WHERE bot_id = ? AND chat_id = ? AND status = 'success' AND id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (bot_id, chat_id, after_id, limit))
+            rows = [dict(row) for row in cursor.fetchall()]
+            if self.writes and len(rows) < limit:
+                # Include turns still waiting in the write-behind buffer instead of flushing
+                stored = {row['id'] for row in rows}
+                for row in reversed(self.writes.pending_turns(bot_id, chat_id, after_id)):
+                    if row['id'] not in stored:
+                        if row['token_count'] is None:
+                            row['token_count'] = GeminiManager.estimate_text_tokens(
+                                row['message_text'], row['response_text']
+                            )
+                        rows.append(row)
+                rows = rows[:limit]
+            
+            unsummarized_tokens = sum(row['token_count'] for row in rows)
+            if (len(rows) < config.summary_trigger_turns
+                    and unsummarized_tokens < config.summary_trigger_tokens):
+                return summary, []
+            if len(rows) < limit:
+                # We have every unsummarized turn; keep the newest ones verbatim
+                rows = rows[:-config.summary_keep_recent]
+            else:
+                rows = rows[:config.summary_max_turns_per_pass]
+            
+            # Cap the transcript so a long backlog is folded over several passes
+            turns, pass_tokens = [], 0
+            for row in rows:
+                if turns and pass_tokens + row['token_count'] > config.summary_max_tokens_per_pass:
+                    break
+                turns.append(row)
+                pass_tokens += row['token_count']
+            return summary, turns
+        except sqlite3.Error as e:
+            logger.error(f"Database error in get_turns_to_summarize: {e}")
+            return None, []
+        finally:
+            conn.close()
+    
+    def save_chat_summary(self, bot_id: int, chat_id: int, summary: str, summarized_until: int,
+                          token_count: int) -> bool:
+        """Store a chat summary unless its turns were cleared in the meantime"""
+        # The summarized turns may still be in the write-behind buffer
+        self.flush_writes()
+        if self.writes:
+            summarized_until = self.writes.resolve_id(summarized_until)
+            if summarized_until is None:
+                logger.warning(f"Summarized turns for chat {chat_id} were not stored; discarding summary")
+                return False
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT 1 FROM messages WHERE id = ?', (summarized_until,))
+            if cursor.fetchone() is None:
+                logger.info(f"Chat {chat_id} was reset during summarization; discarding summary")
+                return False
+            cursor.execute('''
+                INSERT OR REPLACE INTO chat_summaries
+                (bot_id, chat_id, summary, summarized_until, token_count, updated_at)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (bot_id, chat_id, summary, summarized_until, token_count))
+            conn.commit()
+            history_buffer.set_summary((bot_id, chat_id), {
+                'summary': summary,
+                'summarized_until': summarized_until,
+                'token_count': token_count
+            })
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Database error in save_chat_summary: {e}")
+            return False
+        finally:
+            conn.close()
+    
+    def get_user_stats(self, bot_id: int, user_id: int) -> Dict:
+        """Get user statistics from the per-user daily rollups"""
+        self.flush_writes()
+        self.update_analytics()
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                SELECT SUM(messages) as total_messages,
+                       SUM(response_time_total) / MAX(1, SUM(responses)) as avg_processing_time,
+                       MAX(last_message) as last_message,
+                       SUM(tokens_used) as total_tokens
+                FROM analytics_users 
+                WHERE bot_id = ? AND user_id = ?
+            ''', (bot_id, user_id))
+            
+            result = cursor.fetchone()
+            return {
+                'total_messages': result['total_messages'] or 0,
+                'avg_processing_time': result['avg_processing_time'] or 0,
+                'last_message': result['last_message'],
+                'total_tokens': result['total_tokens'] or 0
+            }
+        except sqlite3.Error as e:
+            logger.error(f"Database error in get_user_stats: {e}")
+            return {'total_messages': 0, 'avg_processing_time': 0, 'last_message': None, 'total_tokens': 0}
+        finally:
+            conn.close()
+    
+    def clear_user_history(self, bot_id: int, user_id: int, chat_id: int) -> bool:
+        """Clear user's chat history"""
+        self.flush_writes()
+        # Count the turns in the daily totals before they are deleted
+        self.update_analytics()
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('DELETE FROM messages WHERE bot_id = ? AND user_id = ? AND chat_id = ?', 
+                          (bot_id, user_id, chat_id))
+            # The summary may contain the cleared turns
+            cursor.execute('DELETE FROM chat_summaries WHERE bot_id = ? AND chat_id = ?', (bot_id, chat_id))
+            conn.commit()
+            history_buffer.invalidate((bot_id, chat_id))
+            gemini_manager.context_cache.invalidate(bot_id, chat_id)
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Database error in clear_user_history: {e}")
+            return False
+        finally:
+            conn.close()
+    
+    # Columns of the analytics row each message status is counted in
+    ANALYTICS_STATUS_COLUMNS = {'error': 'errors', 'cancelled': 'cancelled', 'blocked': 'blocked_requests'}
+    
+    def update_analytics(self) -> int:
+        """Fold messages written since the last rollup into analytics and analytics_users.
+        
+        Progress is kept as the last folded message id, so each run only reads
+        new rows by primary key. Returns the number of messages folded.
+        """
+        folded = 0
+        with self.analytics_lock:
+            while True:
+                batch = self._update_analytics_batch(config.analytics_rollup_batch)
+                folded += batch
+                if batch < config.analytics_rollup_batch:
+                    return folded
+    
+    def _update_analytics_batch(self, limit: int) -> int:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute("SELECT value FROM analytics_state WHERE name = 'last_message_id'")
+            row = cursor.fetchone()
+            last_id = row['value'] if row else 0
+            cursor.execute('''
+                SELECT id, DATE(timestamp) as date, timestamp, bot_id, user_id, chat_id, model_used,
+                       status, processing_time, tokens_used, cost_usd, prompt_tokens,
+                       candidate_tokens, history_tokens
+                FROM messages
+                WHERE id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (last_id, limit))
+            rows = cursor.fetchall()
+            if not rows:
+                conn.rollback()
+                return 0
+            
+            days: Dict[str, Dict] = {}
+            users: Dict[Tuple, Dict] = {}
+            usage: Dict[Tuple, Dict] = {}
+            for row in rows:
+                for dimension in self.USAGE_DIMENSIONS:
+                    totals = usage.setdefault((row['date'], dimension, row[dimension]), {
+                        'messages': 0, 'prompt_tokens': 0, 'candidate_tokens': 0, 'total_tokens': 0,
+                        'history_tokens': 0, 'cost_usd': 0.0, 'response_time_total': 0.0, 'responses': 0
+                    })
+                    totals['messages'] += 1
+                    totals['prompt_tokens'] += row['prompt_tokens'] or 0
+                    totals['candidate_tokens'] += row['candidate_tokens'] or 0
+                    totals['total_tokens'] += row['tokens_used'] or 0
+                    totals['history_tokens'] += row['history_tokens'] or 0
+                    totals['cost_usd'] += row['cost_usd'] or 0
+                    if row['processing_time']:
+                        totals['response_time_total'] += row['processing_time']
+                        totals['responses'] += 1
+
+                day = days.setdefault(row['date'], {
+                    'total_messages': 0, 'errors': 0, 'cancelled': 0, 'blocked_requests': 0,
+                    'total_tokens': 0, 'cost_usd': 0.0, 'response_time_total': 0.0, 'responses': 0
+                })
+                user = users.setdefault((row['date'], row['bot_id'], row['user_id']), {
+                    'messages': 0, 'tokens_used': 0, 'response_time_total': 0.0,
+                    'responses': 0, 'last_message': None
+                })
+                day['total_messages'] += 1
+                status_column = self.ANALYTICS_STATUS_COLUMNS.get(row['status'])
+                if status_column:
+                    day[status_column] += 1
+                day['total_tokens'] += row['tokens_used'] or 0
+                day['cost_usd'] += row['cost_usd'] or 0
+                user['messages'] += 1
+                user['tokens_used'] += row['tokens_used'] or 0
+                user['last_message'] = max(user['last_message'] or '', row['timestamp'])
+                if row['processing_time']:
+                    for totals in (day, user):
+                        totals['response_time_total'] += row['processing_time']
+                        totals['responses'] += 1
+            
+            cursor.executemany('''
+                INSERT INTO analytics
+                (date, total_messages, errors, cancelled, blocked_requests, total_tokens, cost_usd,
+                 response_time_total, responses, avg_response_time)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(date) DO UPDATE SET
+                    total_messages = total_messages + excluded.total_messages,
+                    errors = errors + excluded.errors,
+                    cancelled = cancelled + excluded.cancelled,
+                    blocked_requests = blocked_requests + excluded.blocked_requests,
+                    total_tokens = total_tokens + excluded.total_tokens,
+                    cost_usd = cost_usd + excluded.cost_usd,
+                    response_time_total = response_time_total + excluded.response_time_total,
+                    responses = responses + excluded.responses,
+                    avg_response_time = (response_time_total + excluded.response_time_total)
+                                        / MAX(1, responses + excluded.responses)
+            ''', [(date, d['total_messages'], d['errors'], d['cancelled'], d['blocked_requests'],
+                   d['total_tokens'], d['cost_usd'], d['response_time_total'], d['responses'],
+                   d['response_time_total'] / max(1, d['responses']))
+                  for date, d in days.items()])
+            cursor.executemany('''
+                INSERT INTO analytics_users
+                (date, bot_id, user_id, messages, tokens_used, response_time_total, responses, last_message)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(date, bot_id, user_id) DO UPDATE SET
+                    messages = messages + excluded.messages,
+                    tokens_used = tokens_used + excluded.tokens_used,
+                    response_time_total = response_time_total + excluded.response_time_total,
+                    responses = responses + excluded.responses,
+                    last_message = MAX(last_message, excluded.last_message)
+            ''', [(*key, u['messages'], u['tokens_used'], u['response_time_total'],
+                   u['responses'], u['last_message']) for key, u in users.items()])
+            cursor.executemany('''
+                INSERT INTO analytics_usage
+                (date, dimension, key, messages, prompt_tokens, candidate_tokens, total_tokens,
+                 history_tokens, cost_usd, response_time_total, responses)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(date, dimension, key) DO UPDATE SET
+                    messages = messages + excluded.messages,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    candidate_tokens = candidate_tokens + excluded.candidate_tokens,
+                    total_tokens = total_tokens + excluded.total_tokens,
+                    history_tokens = history_tokens + excluded.history_tokens,
+                    cost_usd = cost_usd + excluded.cost_usd,
+                    response_time_total = response_time_total + excluded.response_time_total,
+                    responses = responses + excluded.responses
+            ''', [(*key, u['messages'], u['prompt_tokens'], u['candidate_tokens'], u['total_tokens'],
+                   u['history_tokens'], u['cost_usd'], u['response_time_total'], u['responses'])
+                  for key, u in usage.items()])
+            cursor.executemany('''
+                UPDATE analytics SET unique_users = (
+                    SELECT COUNT(DISTINCT user_id) FROM analytics_users WHERE date = analytics.date
+                ) WHERE date = ?
+            ''', [(date,) for date in days])
+            # Days before today will not receive new messages
+            cursor.execute("UPDATE analytics SET closed = 1 WHERE closed = 0 AND date < DATE('now')")
+            cursor.execute('''
+                INSERT INTO analytics_state (name, value) VALUES ('last_message_id', ?)
+                ON CONFLICT(name) DO UPDATE SET value = excluded.value
+            ''', (rows[-1]['id'],))
+            conn.commit()
+            return len(rows)
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f"Database error in update_analytics: {e}")
+            return 0
+        finally:
+            conn.close()
+    
+    def get_analytics(self, days: int = 7) -> Dict:
+        """Get bot analytics for the last N days (including today) from the daily rollups"""
+        self.flush_writes()
+        self.update_analytics()
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            since = (datetime.utcnow().date() - timedelta(days=days - 1)).isoformat()
+            cursor.execute('''
+                SELECT 
+                    SUM(total_messages) as total_messages,
+                    SUM(response_time_total) / MAX(1, SUM(responses)) as avg_processing_time,
+                    SUM(errors) as errors,
+                    SUM(cancelled) as cancelled,
+                    SUM(total_tokens) as total_tokens,
+                    SUM(cost_usd) as cost_usd
+                FROM analytics 
+                WHERE date >= ?
+            ''', (since,))
+            result = cursor.fetchone()
+            cursor.execute('SELECT COUNT(DISTINCT user_id) FROM analytics_users WHERE date >= ?', (since,))
+            unique_users = cursor.fetchone()[0]
+            return {
+                'total_messages': result['total_messages'] or 0,
+                'unique_users': unique_users,
+                'avg_processing_time': result['avg_processing_time'] or 0,
+                'errors': result['errors'] or 0,
+                'cancelled': result['cancelled'] or 0,
+                'total_tokens': result['total_tokens'] or 0,
+                'cost_usd': result['cost_usd'] or 0
+            }
+        except sqlite3.Error as e:
+            logger.error(f"Database error in get_analytics: {e}")
+            return {'total_messages': 0, 'unique_users': 0, 'avg_processing_time': 0, 'errors': 0,
+                    'cancelled': 0, 'total_tokens': 0, 'cost_usd': 0}
+        finally:
+            conn.close()
+    
+    def get_daily_analytics(self, days: int = 7) -> List[Dict]:
+        """One rollup row per day, newest first; call get_analytics or update_analytics first"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                SELECT date, total_messages, unique_users, errors, cancelled, blocked_requests,
+                       avg_response_time, total_tokens, cost_usd, closed
+                FROM analytics
+                ORDER BY date DESC
+                LIMIT ?
+            ''', (days,))
+            return [dict(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Database error in get_daily_analytics: {e}")
+            return []
+        finally:
+            conn.close()
+    
+    USAGE_DIMENSIONS = ('user_id', 'chat_id', 'model_used', 'bot_id')
+    
+    def get_bot_user_ids(self, bot_id: int) -> List[int]:
+        """Users who have talked to the given bot"""
+        # New users may still be waiting in the activity tracker
+        self.activity.flush()
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT user_id FROM bot_users WHERE bot_id = ?', (bot_id,))
+            return [row[0] for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Database error in get_bot_user_ids: {e}")
+            return []
+        finally:
+            conn.close()
+    
+    def get_usage_rollup(self, dimension: str, days: int = 7, limit: int = 10) -> List[Dict]:
+        """Token, cost and latency totals grouped by user, chat, model or bot, biggest spenders first.
+        
+        Reads the daily rollups for the last N days (including today); call
+        get_analytics or update_analytics first for up-to-date figures.
+        """
+        if dimension not in self.USAGE_DIMENSIONS:
+            raise ValueError(f"Unknown usage dimension: {dimension}")
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            since = (datetime.utcnow().date() - timedelta(days=days - 1)).isoformat()
+            cursor.execute('''
+                SELECT key,
+                       SUM(messages) as messages,
+                       SUM(prompt_tokens) as prompt_tokens,
+                       SUM(candidate_tokens) as candidate_tokens,
+                       SUM(total_tokens) as total_tokens,
+                       SUM(history_tokens) as history_tokens,
+                       SUM(cost_usd) as cost_usd,
+                       SUM(response_time_total) / MAX(1, SUM(responses)) as avg_processing_time
+                FROM analytics_usage
+                WHERE dimension = ? AND date >= ?
+                GROUP BY key
+                ORDER BY total_tokens DESC
+                LIMIT ?
+            ''', (dimension, since, limit))
+            rollup = []
+            for row in cursor.fetchall():
+                row = dict(row)
+                prompt_tokens = row['prompt_tokens'] or 0
+                row['history_share'] = round(
+                    (row['history_tokens'] or 0) / prompt_tokens * 100, 1
+                ) if prompt_tokens else 0
+                row['cost_usd'] = round(row['cost_usd'] or 0, 4)
+                row['avg_processing_time'] = round(row['avg_processing_time'] or 0, 2)
+                rollup.append(row)
+            return rollup
+        except sqlite3.Error as e:
+            logger.error(f"Database error in get_usage_rollup: {e}")
+            return []
+        finally:
+            conn.close()
+
+# Initialize database manager
+db_manager = DatabaseManager(config.db_name, config.db_pool_size, config.write_behind_enabled)
+
+# Event-loop-safe database access
+class AsyncDatabase:
+    """Awaitable front for DatabaseManager.
+    
+    Calls run on a few dedicated DB threads, so handlers never wait on disk
+    I/O or SQLite locks on the event loop:
+    
+        history = await async_db.get_chat_history(bot_id, chat_id)
+    """
+    def __init__(self, db: DatabaseManager, workers: int):
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+        self.workers = workers
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+    
+    def __getattr__(self, name: str):
+        method = getattr(self.db, name)
+        if not callable(method):
+            raise AttributeError(name)
         
-        conn.commit()
-        conn.close()
-        logger.info("Database initialized successfully")
+        async def call(*args, **kwargs):
+            return await self.call(method, *args, **kwargs)
+        return call
     
-    def register_user(self, user_data) -> bool:
-        """Register or update user with enhanced data"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    async def call(self, func, *args, **kwargs):
+        """Run a blocking database function on a DB thread and await its result"""
+        def timed():
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                self.total_time += elapsed
+                self.max_time = max(self.max_time, elapsed)
+        
+        self.in_flight += 1
+        self.calls += 1
         try:
-            cursor.execute('''
-                INSERT OR REPLACE INTO users 
-                (user_id, username, first_name, last_name, language_code, is_premium, last_active, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            ''', (
-                user_data.id,
-                user_data.username,
-                user_data.first_name,
-                user_data.last_name,
-                getattr(user_data, 'language_code', 'en'),
-                getattr(user_data, 'is_premium', False)
-            ))
-            conn.commit()
-            return True
-        except sqlite3.Error as e:
-            logger.error(f"Database error in register_user: {e}")
-            return False
+            return await asyncio.wrap_future(self.executor.submit(timed))
+        except Exception:
+            self.errors += 1
+            raise
         finally:
-            conn.close()
+            self.in_flight -= 1
     
-    def register_group(self, group_id: int, title: str, group_type: str = 'group') -> bool:
-        """Register or update group information"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def get_stats(self) -> Dict:
+        return {
+            'workers': self.workers,
+            'in_flight': self.in_flight,
+            'calls': self.calls,
+            'errors': self.errors,
+            'avg_ms': round(self.total_time / max(1, self.calls) * 1000, 2),
+            'max_ms': round(self.max_time * 1000, 2)
+        }
+
+async_db = AsyncDatabase(db_manager, config.db_async_workers)
+
+# Response cache for stateless requests
+class ResponseCache:
+    """Prompt -> response cache: in-memory LRU tier in front of a SQLite table"""
+    def __init__(self, db: DatabaseManager):
+        self.db = db
+        self.memory: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self.puts = 0
+    
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        """Normalize a prompt so trivially different phrasings share an entry"""
+        prompt = re.sub(r'\s+', ' ', prompt.lower()).strip()
+        return prompt.rstrip('?!. ')
+    
+    @staticmethod
+    def key_settings(generation_settings: Dict) -> Dict:
+        """Settings that identify an answer; the output cap shrinks with load, so it's left out"""
+        return {k: v for k, v in generation_settings.items() if k != 'max_output_tokens'}
+    
+    def make_key(self, prompt: str, model_name: str, generation_settings: Dict) -> str:
+        payload = json.dumps(
+            [self.normalize(prompt), model_name, self.key_settings(generation_settings)],
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """Look up a cached response, promoting SQLite hits into memory"""
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and now - entry[1] < config.response_cache_ttl:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+            if entry:
+                del self.memory[key]
+        
+        conn = self.db.get_connection()
         try:
-            cursor.execute('''
-                INSERT OR REPLACE INTO groups 
-                (group_id, title, type, last_activity)
-                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (group_id, title, group_type))
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT response_text, created_at FROM response_cache WHERE cache_key = ? AND created_at > ?',
+                (key, now - config.response_cache_ttl)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            cursor.execute(
+                'UPDATE response_cache SET hit_count = hit_count + 1, last_hit = ? WHERE cache_key = ?',
+                (now, key)
+            )
             conn.commit()
-            return True
         except sqlite3.Error as e:
-            logger.error(f"Database error in register_group: {e}")
-            return False
+            logger.error(f"Database error in ResponseCache.get: {e}")
+            self.misses += 1
+            return None
         finally:
             conn.close()
+        
+        self.db_hits += 1
+        self._remember(key, row['response_text'], row['created_at'])
+        return row['response_text']
     
-    def save_message(self, user_id: int, chat_id: int, message: str, response: str, 
-                    tokens_used: int = 0, processing_time: float = 0, 
-                    model_used: str = None, status: str = 'success', 
-                    error_message: str = None) -> bool:
-        """Save message with enhanced tracking"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def put(self, key: str, prompt: str, model_name: str, response_text: str):
+        """Store a response in both tiers"""
+        now = time.time()
+        self._remember(key, response_text, now)
+        
+        conn = self.db.get_connection()
         try:
+            cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO messages 
-                (user_id, chat_id, message_text, response_text, tokens_used, 
-                 processing_time, model_used, status, error_message)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (user_id, chat_id, message, response, tokens_used, 
-                  processing_time, model_used or gemini_manager.model_name, 
-                  status, error_message))
+                INSERT OR REPLACE INTO response_cache
+                (cache_key, prompt, model_name, response_text, hit_count, created_at, last_hit)
+                VALUES (?, ?, ?, ?, 0, ?, ?)
+            ''', (key, prompt, model_name, response_text, now, now))
+            self.puts += 1
+            if self.puts % 100 == 1:
+                self._evict(cursor, now)
             conn.commit()
-            return True
         except sqlite3.Error as e:
-            logger.error(f"Database error in save_message: {e}")
-            return False
+            logger.error(f"Database error in ResponseCache.put: {e}")
         finally:
             conn.close()
     
-    def get_chat_history(self, chat_id: int, limit: int = None) -> List[Dict]:
-        """Get chat history with enhanced formatting"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def _remember(self, key: str, response_text: str, created_at: float):
+        with self.lock:
+            self.memory[key] = (response_text, created_at)
+            self.memory.move_to_end(key)
+            while len(self.memory) > config.response_cache_memory_entries:
+                self.memory.popitem(last=False)
+    
+    def _evict(self, cursor, now: float):
+        """Drop expired rows and trim the table to its size limit, least recently hit first"""
+        cursor.execute('DELETE FROM response_cache WHERE created_at <= ?',
+                       (now - config.response_cache_ttl,))
+        expired = cursor.rowcount
+        cursor.execute('''
+            DELETE FROM response_cache WHERE cache_key IN (
+                SELECT cache_key FROM response_cache
+                ORDER BY last_hit DESC
+                LIMIT -1 OFFSET ?
+            )
+        ''', (config.response_cache_max_entries,))
+        self.evictions += expired + cursor.rowcount
+    
+    def get_stats(self) -> Dict:
+        hits = self.memory_hits + self.db_hits
+        lookups = hits + self.misses
+        return {
+            'hits': hits,
+            'memory_hits': self.memory_hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'bypassed': self.bypassed,
+            'evictions': self.evictions,
+            'memory_entries': len(self.memory),
+            'hit_rate': round(hits / lookups * 100, 1) if lookups else 0
+        }
+
+# Initialize response cache
+response_cache = ResponseCache(db_manager)
+
+# Semantic cache for paraphrased stateless requests
+class EmbeddingBackend:
+    """Turns text into a fixed-size float32 vector"""
+    dimensions = 0
+    
+    def embed(self, text: str):
+        raise NotImplementedError
+
+class GeminiEmbeddingBackend(EmbeddingBackend):
+    """Embeddings from the Gemini embedding API"""
+    dimensions = 768
+    
+    def __init__(self, model_name: str = 'models/text-embedding-004'):
+        self.model_name = model_name
+    
+    def embed(self, text: str):
+        result = genai.embed_content(
+            model=self.model_name,
+            content=text,
+            task_type='semantic_similarity'
+        )
+        return np.asarray(result['embedding'], dtype=np.float32)
+
+class HashingEmbeddingBackend(EmbeddingBackend):
+    """Offline stand-in: hashed word and character trigram features"""
+    dimensions = 512
+    
+    def embed(self, text: str):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        words = re.findall(r'\w+', text.lower())
+        features = words + [
+            word[i:i + 3] for word in words for i in range(max(1, len(word) - 2))
+        ]
+        for feature in features:
+            digest = hashlib.md5(feature.encode()).digest()
+            index = int.from_bytes(digest[:4], 'little') % self.dimensions
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        return vector
+
+class VectorIndex:
+    """Fixed-capacity float32 matrix plus id and model arrays, memory-mapped from disk"""
+    def __init__(self, directory: str, dimensions: int, capacity: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True)
+        self.meta_path = self.directory / 'index.json'
+        self.dimensions = dimensions
+        self.capacity = capacity
+        self.count = 0
+        self.next_slot = 0
+        self.model_names: List[str] = []  # model code -> name
+        # Array files and their expected sizes in bytes
+        files = {
+            'vectors.f32': (np.float32, (capacity, dimensions)),
+            'ids.i64': (np.int64, (capacity,)),
+            'models.i16': (np.int16, (capacity,))
+        }
+        
+        mode = 'w+'
+        if self.meta_path.exists():
+            try:
+                meta = json.loads(self.meta_path.read_text())
+                missing = [
+                    name for name, (dtype, shape) in files.items()
+                    if not (self.directory / name).exists()
+                    or (self.directory / name).stat().st_size != np.dtype(dtype).itemsize * int(np.prod(shape))
+                ]
+                if meta['dimensions'] != dimensions or meta['capacity'] != capacity:
+                    logger.warning("Semantic index shape changed; starting a new index")
+                elif missing:
+                    logger.warning(f"Semantic index files missing or truncated ({', '.join(missing)}); "
+                                   f"starting a new index")
+                else:
+                    self.count = meta['count']
+                    self.next_slot = meta['next_slot']
+                    self.model_names = meta['models']
+                    mode = 'r+'
+            except (ValueError, KeyError) as e:
+                logger.warning(f"Semantic index metadata unreadable, starting fresh: {e}")
+        self.started_fresh = mode == 'w+'
+        
+        self.vectors, self.ids, self.models = (
+            np.memmap(self.directory / name, dtype=dtype, mode=mode, shape=shape)
+            for name, (dtype, shape) in files.items()
+        )
+    
+    def add(self, vector, entry_id: int, model_name: str) -> Optional[int]:
+        """Store a vector, returning the id it replaced once the index is full"""
+        if model_name not in self.model_names:
+            self.model_names.append(model_name)
+        slot = self.next_slot
+        replaced = int(self.ids[slot]) if self.count == self.capacity else None
+        self.vectors[slot] = vector
+        self.ids[slot] = entry_id
+        self.models[slot] = self.model_names.index(model_name)
+        self.next_slot = (slot + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        return replaced
+    
+    def search(self, vector, model_name: str) -> Tuple[Optional[int], float]:
+        """Id and cosine similarity of the closest vector stored for the model"""
+        if self.count == 0 or model_name not in self.model_names:
+            return None, 0.0
+        scores = self.vectors[:self.count] @ vector
+        scores[self.models[:self.count] != self.model_names.index(model_name)] = -np.inf
+        best = int(np.argmax(scores))
+        if scores[best] == -np.inf:
+            return None, 0.0
+        return int(self.ids[best]), float(scores[best])
+    
+    def flush(self):
+        self.vectors.flush()
+        self.ids.flush()
+        self.models.flush()
+        self.meta_path.write_text(json.dumps({
+            'dimensions': self.dimensions,
+            'capacity': self.capacity,
+            'count': self.count,
+            'next_slot': self.next_slot,
+            'models': self.model_names
+        }))
+
+class SemanticCache:
+    """Return cached answers for prompts similar to ones already answered"""
+    def __init__(self, db: DatabaseManager, backend: EmbeddingBackend):
+        self.db = db
+        self.backend = backend
+        self.index = VectorIndex(
+            config.semantic_cache_dir,
+            backend.dimensions,
+            config.semantic_cache_max_entries
+        )
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.total_hit_similarity = 0.0
+        self.next_id = self._load_next_id()
+    
+    def _load_next_id(self) -> int:
+        conn = self.db.get_connection()
         try:
-            limit = limit or config.max_history_messages
-            cursor.execute('''
-                SELECT message_text, response_text, timestamp 
-                FROM messages 
-                WHERE chat_id = ? AND status = 'success'
-                ORDER BY timestamp DESC 
-                LIMIT ?
-            ''', (chat_id, limit))
-            
-            rows = cursor.fetchall()
-            history = []
-            for row in reversed(rows):
-                history.append({'role': 'user', 'parts': [row['message_text']]})
-                history.append({'role': 'model', 'parts': [row['response_text']]})
-            
-            return history
-        except sqlite3.Error as e:
-            logger.error(f"Database error in get_chat_history: {e}")
-            return []
+            if self.index.started_fresh:
+                # Entries of a lost index can never be found again
+                conn.execute('DELETE FROM semantic_cache')
+                conn.commit()
+            row = conn.execute('SELECT MAX(id) FROM semantic_cache').fetchone()
+            return (row[0] or 0) + 1
         finally:
             conn.close()
     
-    def get_user_stats(self, user_id: int) -> Dict:
-        """Get user statistics"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def _embed(self, prompt: str):
+        vector = self.backend.embed(ResponseCache.normalize(prompt))
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+    
+    def lookup(self, prompt: str, model_name: str) -> Tuple[Optional[str], object]:
+        """Cached answer (or None) and the prompt's embedding for a later add()"""
         try:
-            cursor.execute('''
-                SELECT COUNT(*) as total_messages,
-                       AVG(processing_time) as avg_processing_time,
-                       MAX(timestamp) as last_message
-                FROM messages 
-                WHERE user_id = ?
-            ''', (user_id,))
-            
-            result = cursor.fetchone()
-            return {
-                'total_messages': result['total_messages'],
-                'avg_processing_time': result['avg_processing_time'] or 0,
-                'last_message': result['last_message']
-            }
+            vector = self._embed(prompt)
+        except Exception as e:
+            logger.error(f"Embedding failed: {e}")
+            self.errors += 1
+            return None, None
+        
+        with self.lock:
+            entry_id, similarity = self.index.search(vector, model_name)
+        if entry_id is None or similarity < config.semantic_cache_threshold:
+            self.misses += 1
+            return None, vector
+        
+        conn = self.db.get_connection()
+        try:
+            row = conn.execute(
+                'SELECT response_text FROM semantic_cache WHERE id = ? AND model_name = ? AND created_at > ?',
+                (entry_id, model_name, time.time() - config.response_cache_ttl)
+            ).fetchone()
         except sqlite3.Error as e:
-            logger.error(f"Database error in get_user_stats: {e}")
-            return {'total_messages': 0, 'avg_processing_time': 0, 'last_message': None}
+            logger.error(f"Database error in SemanticCache.lookup: {e}")
+            row = None
         finally:
             conn.close()
+        
+        if row is None:
+            self.misses += 1
+            return None, vector
+        self.hits += 1
+        self.total_hit_similarity += similarity
+        logger.info(f"Semantic cache hit (similarity {similarity:.3f})")
+        return row['response_text'], vector
     
-    def clear_user_history(self, user_id: int, chat_id: int) -> bool:
-        """Clear user's chat history"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def add(self, prompt: str, model_name: str, response_text: str, vector=None):
+        """Index a new answer"""
+        try:
+            if vector is None:
+                vector = self._embed(prompt)
+        except Exception as e:
+            logger.error(f"Embedding failed: {e}")
+            self.errors += 1
+            return
+        
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            replaced = self.index.add(vector, entry_id, model_name)
+            self.index.flush()
+        
+        conn = self.db.get_connection()
         try:
-            cursor.execute('DELETE FROM messages WHERE user_id = ? AND chat_id = ?', 
-                          (user_id, chat_id))
+            if replaced is not None:
+                conn.execute('DELETE FROM semantic_cache WHERE id = ?', (replaced,))
+            conn.execute('''
+                INSERT INTO semantic_cache (id, prompt, model_name, response_text, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (entry_id, prompt, model_name, response_text, time.time()))
             conn.commit()
-            return True
         except sqlite3.Error as e:
-            logger.error(f"Database error in clear_user_history: {e}")
-            return False
+            logger.error(f"Database error in SemanticCache.add: {e}")
         finally:
             conn.close()
     
-    def get_analytics(self, days: int = 7) -> Dict:
-        """Get bot analytics"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    async def lookup_async(self, prompt: str, model_name: str) -> Tuple[Optional[str], object]:
+        return await asyncio.to_thread(self.lookup, prompt, model_name)
+    
+    async def add_async(self, prompt: str, model_name: str, response_text: str, vector=None):
+        await asyncio.to_thread(self.add, prompt, model_name, response_text, vector)
+    
+    def get_stats(self) -> Dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'entries': self.index.count,
+            'avg_hit_similarity': round(self.total_hit_similarity / max(1, self.hits), 3)
+        }
+
+def create_semantic_cache() -> Optional[SemanticCache]:
+    """Build the semantic cache if it is enabled and NumPy is available"""
+    if not config.semantic_cache_enabled:
+        return None
+    if np is None:
+        logger.warning("Semantic cache enabled but NumPy is not installed; disabling it")
+        return None
+    backends = {
+        'gemini': GeminiEmbeddingBackend,
+        'hashing': HashingEmbeddingBackend
+    }
+    backend_name = config.semantic_cache_backend
+    if config.generation_backend == 'standin' and backend_name == 'gemini':
+        # No API access offline; local embeddings keep the cache path exercised
+        backend_name = 'hashing'
+    backend = backends[backend_name]()
+    logger.info(f"Semantic cache enabled with {backend_name} embeddings")
+    return SemanticCache(db_manager, backend)
+
+semantic_cache = create_semantic_cache()
+
+# Request coalescing
+class SingleFlight:
+    """Share one in-flight generation between identical concurrent requests"""
+    def __init__(self):
+        self.in_flight: Dict[str, asyncio.Future] = {}
+        self.leaders = 0
+        self.saved = 0
+    
+    @staticmethod
+    def make_key(prompt: str, history: List, model_name: str, generation_settings: Dict) -> str:
+        """Requests coalesce when prompt, context, model and settings all match"""
+        payload = json.dumps(
+            [ResponseCache.normalize(prompt), history, model_name,
+             ResponseCache.key_settings(generation_settings)],
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+    
+    async def do(self, key: str, generate) -> Tuple[GenerationResult, bool]:
+        """Run generate() once per key; returns the result and whether we were the leader"""
+        while True:
+            future = self.in_flight.get(key)
+            if future is None:
+                break
+            try:
+                result = await asyncio.shield(future)
+                self.saved += 1
+                return result, False
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # we were cancelled ourselves
+                # The leader was cancelled; try again, possibly as the new leader
+        
+        future = asyncio.get_running_loop().create_future()
+        # Mark the exception as retrieved when there are no followers
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.in_flight[key] = future
+        self.leaders += 1
         try:
-            cursor.execute('''
-                SELECT 
-                    COUNT(*) as total_messages,
-                    COUNT(DISTINCT user_id) as unique_users,
-                    AVG(processing_time) as avg_processing_time,
-                    SUM(CASE WHEN status != 'success' THEN 1 ELSE 0 END) as errors
-                FROM messages 
-                WHERE timestamp >= datetime('now', '-{} days')
-            '''.format(days))
+            result = await generate()
+            future.set_result(result)
+            return result, True
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self.in_flight[key]
+    
+    def get_stats(self) -> Dict:
+        return {
+            'in_flight': len(self.in_flight),
+            'leaders': self.leaders,
+            'saved': self.saved
+        }
+
+single_flight = SingleFlight()
+
+# Superseded request handling
+class ChatTaskTracker:
+    """Track in-flight AI requests per chat and user so newer ones supersede older ones.
+    
+    'cancel_previous' cancels the older request when a newer one arrives;
+    'queue' runs them one at a time in arrival order. /reset cancels either way.
+    """
+    POLICIES = ('cancel_previous', 'queue')
+    
+    def __init__(self, policy: str):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown superseded request policy: {policy}")
+        self.policy = policy
+        self.tasks: Dict[Tuple[int, int, int], List[asyncio.Task]] = {}
+        self.cancelled = 0
+        self.queued = 0
+    
+    @asynccontextmanager
+    async def track(self, bot_id: int, chat_id: int, user_id: int):
+        """Register the current task for the chat, applying the policy to older ones"""
+        key = (bot_id, chat_id, user_id)
+        task = asyncio.current_task()
+        pending = self.tasks.setdefault(key, [])
+        previous = list(pending)
+        pending.append(task)
+        try:
+            if previous and self.policy == 'queue':
+                self.queued += 1
+                await asyncio.wait([previous[-1]])
+            elif previous:
+                self._cancel(previous, 'superseded')
+            yield
+        finally:
+            pending.remove(task)
+            if not pending and self.tasks.get(key) is pending:
+                del self.tasks[key]
+    
+    def cancel(self, bot_id: int, chat_id: int, user_id: int, reason: str = 'reset') -> int:
+        """Cancel every in-flight request for the chat; returns how many were running"""
+        return self._cancel(self.tasks.get((bot_id, chat_id, user_id), []), reason)
+    
+    def _cancel(self, tasks: List[asyncio.Task], reason: str) -> int:
+        count = 0
+        for task in tasks:
+            if not task.done() and task is not asyncio.current_task():
+                task.cancel(reason)
+                count += 1
+        self.cancelled += count
+        return count
+    
+    def get_stats(self) -> Dict:
+        return {
+            'policy': self.policy,
+            'in_flight': sum(len(tasks) for tasks in self.tasks.values()),
+            'cancelled': self.cancelled,
+            'queued': self.queued
+        }
+
+chat_tasks = ChatTaskTracker(config.superseded_request_policy)
+
+# Fair scheduling of generation slots
+class RequestScheduler:
+    """Weighted fair queue between the handlers and generation.
+    
+    Every chat is a flow. Waiting requests are served in order of their
+    virtual finish time, so a busy group only delays its own messages, and
+    chats in a heavier lane (e.g. premium users) get a bigger share of slots.
+    Requests that would wait longer than scheduler_max_wait are turned away.
+    """
+    def __init__(self, max_active: int, max_depth: int, max_wait: float, lane_weights: Dict[str, float]):
+        self.max_active = max_active
+        self.max_depth = max_depth
+        self.max_wait = max_wait
+        self.lane_weights = lane_weights
+        self.heap: List[Tuple[float, int, float, asyncio.Future]] = []  # (finish, seq, start, waiter)
+        self.flow_finish: Dict[object, float] = {}
+        self.virtual_time = 0.0
+        self.seq = 0
+        self.active = 0
+        self.queued = 0
+        self.peak_queued = 0
+        self.avg_service_time = 0.0
+        self.admitted: Dict[str, int] = {}
+        self.rejected: Dict[str, int] = {}
+        self.total_queue_wait = 0.0
+    
+    def _tag(self, flow, lane: str) -> Tuple[float, float]:
+        """Virtual start and finish times for the flow's next request"""
+        start = max(self.virtual_time, self.flow_finish.get(flow, 0.0))
+        return start, start + 1.0 / self.lane_weights.get(lane, 1.0)
+    
+    def estimated_wait(self, finish: float = math.inf) -> float:
+        """Seconds until a request with this finish tag would get a slot"""
+        ahead = sum(1 for entry in self.heap if entry[0] < finish and not entry[3].done())
+        if self.active < self.max_active and not ahead:
+            return 0.0
+        return (ahead + 1) * self.avg_service_time / self.max_active
+    
+    def _reject(self, reason: str):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        raise SchedulerOverloadedError(reason)
+    
+    def _dispatch(self):
+        while self.active < self.max_active and self.heap:
+            _, _, start, waiter = heapq.heappop(self.heap)
+            if waiter.done():
+                continue  # gave up while waiting
+            self.virtual_time = max(self.virtual_time, start)
+            self.active += 1
+            waiter.set_result(None)
+        if not self.heap and not self.active:
+            # Idle: old finish tags no longer matter
+            self.flow_finish.clear()
+    
+    def _release(self, held_for: float):
+        self.active -= 1
+        self.avg_service_time = held_for if not self.avg_service_time else (
+            0.9 * self.avg_service_time + 0.1 * held_for
+        )
+        self._dispatch()
+    
+    @asynccontextmanager
+    async def slot(self, flow, lane: str = 'standard'):
+        """Hold a generation slot for the block; yields the seconds spent queued"""
+        start, finish = self._tag(flow, lane)
+        queued_at = time.time()
+        if self.active >= self.max_active or self.heap:
+            if self.queued >= self.max_depth:
+                self._reject('queue_full')
+            if self.estimated_wait(finish) > self.max_wait:
+                self._reject('wait_too_long')
             
-            result = cursor.fetchone()
-            return {
-                'total_messages': result['total_messages'],
-                'unique_users': result['unique_users'],
-                'avg_processing_time': result['avg_processing_time'] or 0,
-                'errors': result['errors']
-            }
-        except sqlite3.Error as e:
-            logger.error(f"Database error in get_analytics: {e}")
-            return {'total_messages': 0, 'unique_users': 0, 'avg_processing_time': 0, 'errors': 0}
+            self.flow_finish[flow] = finish
+            waiter = asyncio.get_running_loop().create_future()
+            self.seq += 1
+            heapq.heappush(self.heap, (finish, self.seq, start, waiter))
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+            try:
+                await asyncio.wait_for(waiter, self.max_wait)
+            except asyncio.TimeoutError:
+                self._reject('timed_out')
+            except BaseException:
+                # Cancelled just after being handed a slot; pass it on
+                if waiter.done() and not waiter.cancelled():
+                    self._release(0.0)
+                raise
+            finally:
+                self.queued -= 1
+        else:
+            self.flow_finish[flow] = finish
+            self.virtual_time = max(self.virtual_time, start)
+            self.active += 1
+        
+        wait = time.time() - queued_at
+        self.total_queue_wait += wait
+        self.admitted[lane] = self.admitted.get(lane, 0) + 1
+        started = time.time()
+        try:
+            yield wait
         finally:
-            conn.close()
+            self._release(time.time() - started)
+    
+    def get_stats(self) -> Dict:
+        admitted = sum(self.admitted.values())
+        return {
+            'max_active': self.max_active,
+            'active': self.active,
+            'queued': self.queued,
+            'peak_queued': self.peak_queued,
+            'estimated_wait': round(self.estimated_wait(), 2),
+            'avg_queue_wait': round(self.total_queue_wait / max(1, admitted), 3),
+            'admitted': dict(self.admitted),
+            'rejected': dict(self.rejected)
+        }
 
-# Initialize database manager
-db_manager = DatabaseManager(config.db_name)
+request_scheduler = RequestScheduler(
+    config.max_concurrent_generations,
+    config.scheduler_max_depth,
+    config.scheduler_max_wait,
+    config.scheduler_lane_weights
+)
+
+# Local prompt pre-filter
+class AhoCorasick:
+    """Multi-pattern matcher that finds every pattern in one pass over the text"""
+    def __init__(self, patterns: List[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[str]] = [[]]
+        for pattern in patterns:
+            self._add(pattern)
+        self._build()
+    
+    def _add(self, pattern: str):
+        state = 0
+        for char in pattern:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.output[state].append(pattern)
+    
+    def _build(self):
+        """Breadth-first pass wiring up failure links"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                if self.fail[next_state] == next_state:
+                    self.fail[next_state] = 0
+                self.output[next_state] += self.output[self.fail[next_state]]
+    
+    def find(self, text: str):
+        """Yield (end_index, pattern) for every match"""
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for pattern in self.output[state]:
+                yield i, pattern
+
+@dataclass
+class PrefilterVerdict:
+    blocked: bool
+    reason: str = ''
+    reply: str = ''
+
+class PromptPrefilter:
+    """Reject prompts that Gemini would block or that aren't worth a call, without an API round trip"""
+    BLOCKED_REPLY = "⚠️ Your request was blocked due to content safety policies."
+    EMPTY_REPLY = "⚠️ I couldn't generate a response for that query."
+    TOO_LONG_REPLY = "⚠️ Your message is too long. Please keep it under {} characters."
+    URL_PATTERN = re.compile(r'https?://|www\.', re.IGNORECASE)
+    CODE_PATTERN = re.compile(r'```.*?(?:```|$)|`[^`]*`')
+    
+    def __init__(self, deny_list_file: str):
+        self.patterns = self._load(deny_list_file)
+        self.matcher = AhoCorasick(self.patterns)
+        self.checked = 0
+        self.blocked: Dict[str, int] = {}
+        self.tokens_saved = 0
+    
+    @staticmethod
+    def _load(path: str) -> List[str]:
+        """One phrase per line; blank lines and # comments are ignored"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                lines = [line.strip() for line in f]
+        except OSError as e:
+            logger.warning(f"No prompt deny list loaded: {e}")
+            return []
+        patterns = [PromptPrefilter.normalize(line) for line in lines if line and not line.startswith('#')]
+        logger.info(f"Loaded {len(patterns)} deny-list phrases")
+        return patterns
+    
+    @staticmethod
+    def normalize(text: str) -> str:
+        return ' '.join(text.lower().split())
+    
+    def _denied(self, text: str) -> Optional[str]:
+        """First deny-list phrase found on word boundaries"""
+        for end, pattern in self.matcher.find(text):
+            start = end - len(pattern) + 1
+            before = text[start - 1] if start > 0 else ' '
+            after = text[end + 1] if end + 1 < len(text) else ' '
+            if not before.isalnum() and not after.isalnum():
+                return pattern
+        return None
+    
+    @staticmethod
+    def _letter_count(text: str) -> int:
+        """Letters and digits in any script; a CJK character is a word on its own, so it counts twice"""
+        return sum(
+            2 if unicodedata.east_asian_width(char) in ('W', 'F') else 1
+            for char in text if char.isalnum()
+        )
+    
+    @staticmethod
+    def _spammy(text: str) -> bool:
+        """Long letter runs, one word repeated over and over, or a wall of links.
+        
+        Code is left out of the first two: dividers and repeated tokens are normal there.
+        """
+        prose = PromptPrefilter.CODE_PATTERN.sub(' ', text)
+        if re.search(r'([^\W_])\1{' + str(config.prefilter_max_char_run) + ',}', prose):
+            return True
+        words = prose.split()
+        if len(words) >= 10:
+            most_common = max(words.count(word) for word in set(words))
+            if most_common / len(words) > config.prefilter_max_word_share:
+                return True
+        return len(PromptPrefilter.URL_PATTERN.findall(text)) > config.prefilter_max_links
+    
+    def check(self, prompt: str) -> PrefilterVerdict:
+        self.checked += 1
+        verdict = self._check(prompt)
+        if verdict.blocked:
+            self.blocked[verdict.reason] = self.blocked.get(verdict.reason, 0) + 1
+            self.tokens_saved += len(prompt) // 4 + 1
+        return verdict
+    
+    def _check(self, prompt: str) -> PrefilterVerdict:
+        if not config.prefilter_enabled:
+            return PrefilterVerdict(False)
+        text = self.normalize(prompt or '')
+        if self._letter_count(text) < config.prefilter_min_chars:
+            return PrefilterVerdict(True, 'empty', self.EMPTY_REPLY)
+        if len(text) > config.prefilter_max_chars:
+            return PrefilterVerdict(True, 'too_long', self.TOO_LONG_REPLY.format(config.prefilter_max_chars))
+        if self._spammy(text):
+            return PrefilterVerdict(True, 'spam', self.BLOCKED_REPLY)
+        if self.patterns and self._denied(text):
+            return PrefilterVerdict(True, 'deny_list', self.BLOCKED_REPLY)
+        return PrefilterVerdict(False)
+    
+    def get_stats(self) -> Dict:
+        saved = sum(self.blocked.values())
+        return {
+            'checked': self.checked,
+            'saved': saved,
+            'saved_rate': round(saved / max(1, self.checked) * 100, 1),
+            'by_reason': dict(self.blocked),
+            'tokens_saved': self.tokens_saved,
+            'deny_list_size': len(self.patterns)
+        }
+
+prompt_prefilter = PromptPrefilter(config.prefilter_deny_list_file)
 
 # Enhanced Rate Limiting
 class RateLimiter:
@@ -554,6 +4247,94 @@ class RateLimiter:
 # Initialize rate limiter
 rate_limiter = RateLimiter()
 
+# Conversation compaction
+class ConversationSummarizer:
+    """Fold older turns of long chats into a rolling per-chat summary"""
+    def __init__(self):
+        self.running: set = set()
+        self.compactions = 0
+        self.failures: Dict[Tuple[int, int], Tuple[int, float]] = {}  # chat -> (failures, retry_at)
+    
+    def maybe_schedule(self, bot_id: int, chat_id: int):
+        """Start a background compaction for the chat unless one is already running"""
+        if (bot_id, chat_id) in self.running:
+            return
+        failure = self.failures.get((bot_id, chat_id))
+        if failure and time.time() < failure[1]:
+            return
+        # Skip the database while the buffered turns show the chat is still short
+        buffered = history_buffer.unsummarized((bot_id, chat_id))
+        if buffered:
+            turns, tokens = buffered
+            if (turns < history_buffer.max_turns and turns < config.summary_trigger_turns
+                    and tokens < config.summary_trigger_tokens):
+                return
+        self.running.add((bot_id, chat_id))
+        asyncio.create_task(self._compact(bot_id, chat_id))
+    
+    async def _compact(self, bot_id: int, chat_id: int):
+        try:
+            summary, turns = await async_db.get_turns_to_summarize(bot_id, chat_id)
+            if not turns:
+                return
+            
+            transcript = '\n'.join(
+                f"User: {turn['message_text']}\nAssistant: {turn['response_text']}"
+                for turn in turns
+            )
+            prompt = (
+                "Summarize the conversation below in a short paragraph or a few bullet points. "
+                "Keep names, facts, decisions and open questions the assistant will need later.\n\n"
+            )
+            if summary:
+                prompt += f"Earlier summary:\n{summary['summary']}\n\n"
+            prompt += f"Conversation:\n{transcript}"
+            
+            # Summaries spend the same project quota as replies
+            estimate = gemini_manager._estimate_tokens(prompt)
+            reservation = await admission_controller.admit(estimate)
+            try:
+                result = await gemini_manager.pool.run(gemini_manager.generate_response, prompt)
+            except BaseException:
+                admission_controller.release(reservation)
+                raise
+            admission_controller.settle(reservation, result.total_tokens or estimate)
+            new_summary = result.text
+            if new_summary.startswith("⚠️"):
+                logger.warning(f"Summarization for chat {chat_id} was blocked")
+                self._back_off(bot_id, chat_id)
+                return
+            
+            # The reply's usage already says how long the summary is
+            token_count = result.candidate_tokens
+            if token_count is None:
+                token_count = await asyncio.to_thread(gemini_manager.count_tokens, new_summary)
+            saved = await async_db.save_chat_summary(
+                bot_id, chat_id, new_summary, turns[-1]['id'], token_count
+            )
+            self.failures.pop((bot_id, chat_id), None)
+            if saved:
+                self.compactions += 1
+                folded_tokens = sum(turn['token_count'] for turn in turns)
+                logger.info(f"Compacted {len(turns)} turns ({folded_tokens} tokens) of chat {chat_id} "
+                            f"into a {token_count}-token summary")
+        except AdmissionRejectedError as e:
+            logger.info(f"Postponed summarization for chat {chat_id}: {e}")
+            self._back_off(bot_id, chat_id)
+        except Exception as e:
+            logger.error(f"Summarization failed for chat {chat_id}: {e}")
+            self._back_off(bot_id, chat_id)
+        finally:
+            self.running.discard((bot_id, chat_id))
+    
+    def _back_off(self, bot_id: int, chat_id: int):
+        """Don't retry a failed compaction on every turn; wait longer after each failure"""
+        failures = self.failures.get((bot_id, chat_id), (0, 0))[0] + 1
+        delay = min(config.summary_retry_backoff * 2 ** (failures - 1), 3600)
+        self.failures[(bot_id, chat_id)] = (failures, time.time() + delay)
+
+conversation_summarizer = ConversationSummarizer()
+
 # Enhanced Message Formatting
 class MessageFormatter:
     @staticmethod
@@ -566,6 +4347,10 @@ class MessageFormatter:
         
         chunks = []
         while text:
+            if len(text) <= max_length:
+                chunks.append(text)
+                break
+            
             # Try to split at natural boundaries
             split_index = text.rfind('\n\n', 0, max_length)
             if split_index == -1:
@@ -644,26 +4429,224 @@ class MessageFormatter:
                     await asyncio.sleep(0.5)
                     
             except Exception as e:
-                logger.error(f"Formatting error: {e}")
-                # Fallback to plain text
+                logger.error(f"Formatting error: {e}")
+                # Fallback to plain text
+                try:
+                    await update.message.reply_text(
+                        chunk,
+                        disable_web_page_preview=True
+                    )
+                except Exception as e2:
+                    logger.error(f"Plain text fallback failed: {e2}")
+                    return False
+        
+        return True
+
+# Streaming replies
+class ChatEditLimiter:
+    """Space out message edits per chat, shared by every reply streaming into it.
+    
+    Telegram's edit limits apply per chat, so several streams in one group
+    split a single edit budget instead of each getting their own.
+    """
+    MAX_CHATS = 10000
+    
+    def __init__(self):
+        self.next_edit: Dict[int, float] = {}
+        self.skipped = 0
+    
+    def try_acquire(self, chat_id: int, interval: float) -> bool:
+        """Claim the chat's next edit slot if it is free now"""
+        now = time.monotonic()
+        if now < self.next_edit.get(chat_id, 0):
+            self.skipped += 1
+            return False
+        if len(self.next_edit) >= self.MAX_CHATS:
+            self.next_edit = {chat: at for chat, at in self.next_edit.items() if at > now}
+        self.next_edit[chat_id] = now + interval
+        return True
+    
+    def claim(self, chat_id: int, interval: float):
+        """Book a final edit, which goes out right away, so other streams hold back"""
+        self.next_edit[chat_id] = max(self.next_edit.get(chat_id, 0), time.monotonic()) + interval
+
+chat_edit_limiter = ChatEditLimiter()
+
+class StreamingReply:
+    """Progressively edit a placeholder message while Gemini streams text"""
+    CURSOR = ' ▌'
+    FINAL_ATTEMPTS = 3  # tries per final page through flood control and network errors
+    
+    def __init__(self, update: Update):
+        self.update = update
+        self.chat_id = update.effective_chat.id
+        self.edit_interval = (
+            config.stream_group_edit_interval
+            if update.effective_chat.type in ['group', 'supergroup']
+            else config.stream_edit_interval
+        )
+        # Leave room for the cursor and HTML entity expansion
+        self.page_length = config.max_message_length - 96
+        self.text = ''
+        self.messages = []
+        self.sent_pages: List[str] = []
+        self.edits = 0
+        self._loop = None
+        self._done = None
+        self._task = None
+        self.cancelled = threading.Event()
+    
+    async def start(self):
+        """Send the placeholder and start the throttled edit loop"""
+        self._loop = asyncio.get_running_loop()
+        self._done = asyncio.Event()
+        message = await self.update.message.reply_text("💭 Thinking...")
+        self.messages.append(message)
+        self.sent_pages.append("💭 Thinking...")
+        self._task = asyncio.create_task(self._edit_loop())
+    
+    def feed(self, chunk: str):
+        """Receive a chunk from the generation thread"""
+        if self.cancelled.is_set():
+            # Stop consuming the stream so the worker frees up early
+            raise GenerationCancelledError("Streaming reply was cancelled")
+        self._loop.call_soon_threadsafe(self._append, chunk)
+    
+    def _append(self, chunk: str):
+        self.text += chunk
+    
+    async def _edit_loop(self):
+        while not self._done.is_set():
+            try:
+                await asyncio.wait_for(self._done.wait(), self.edit_interval)
+            except asyncio.TimeoutError:
+                pass
+            if (not self._done.is_set() and self.text
+                    and chat_edit_limiter.try_acquire(self.chat_id, self.edit_interval)):
+                try:
+                    await self._flush(final=False)
+                except TelegramError as e:
+                    # A missed interim edit is caught up by the next one
+                    logger.warning(f"Streaming edit failed, continuing: {e}")
+    
+    async def finish(self, final_text: str):
+        """Replace the streamed text with the final response"""
+        await self._stop()
+        self.text = final_text
+        chat_edit_limiter.claim(self.chat_id, self.edit_interval)
+        try:
+            await self._flush(final=True)
+        except TelegramError as e:
+            logger.warning(f"Could not finish the streamed reply, sending it as a new message: {e}")
+            await MessageFormatter.send_formatted_message(self.update, final_text)
+            return
+        logger.info(f"Streamed reply in {len(self.messages)} message(s) with {self.edits} edits")
+    
+    async def abort(self, error_text: str):
+        """Show an error in place of the partial response"""
+        self.cancelled.set()
+        await self._stop()
+        self.text = error_text
+        chat_edit_limiter.claim(self.chat_id, self.edit_interval)
+        await self._flush(final=True)
+    
+    async def _stop(self):
+        if self._task:
+            self._done.set()
+            task, self._task = self._task, None
+            try:
+                await task
+            except Exception as e:
+                logger.warning(f"Streaming edit loop stopped with an error: {e}")
+    
+    async def _flush(self, final: bool):
+        """Bring the sent messages in line with the current text"""
+        pages = MessageFormatter.split_message(self.text, self.page_length) or ['...']
+        for i, page in enumerate(pages):
+            if not final and i == len(pages) - 1:
+                page += self.CURSOR
+            if i < len(self.sent_pages) and self.sent_pages[i] == page:
+                continue
+            if final:
+                await self._render_final(i, page)
+                continue
+            try:
+                await self._render(i, page)
+            except RetryAfter as e:
+                # Telegram asked us to slow down; drop this edit and retry later
+                logger.warning(f"Streaming edit throttled for {e.retry_after}s")
+                return
+        
+        if final:
+            # The final text can be shorter than what was streamed (e.g. blocked output)
+            for message in self.messages[len(pages):]:
                 try:
-                    await update.message.reply_text(
-                        chunk,
-                        disable_web_page_preview=True
-                    )
-                except Exception as e2:
-                    logger.error(f"Plain text fallback failed: {e2}")
-                    return False
+                    await message.delete()
+                except Exception as e:
+                    logger.warning(f"Could not delete surplus streamed message: {e}")
+            del self.messages[len(pages):]
+            del self.sent_pages[len(pages):]
+    
+    async def _render_final(self, index: int, page: str):
+        """Render a page of the final text, waiting out flood control and network errors"""
+        for attempt in range(1, self.FINAL_ATTEMPTS + 1):
+            try:
+                await self._render(index, page)
+                return
+            except RetryAfter as e:
+                if attempt == self.FINAL_ATTEMPTS:
+                    raise
+                delay = e.retry_after
+            except BadRequest:
+                # Not transient (BadRequest is a NetworkError in python-telegram-bot)
+                raise
+            except NetworkError as e:
+                if attempt == self.FINAL_ATTEMPTS:
+                    raise
+                delay = attempt
+            logger.warning(f"Final streaming edit failed (attempt {attempt}), retrying in {delay}s")
+            await asyncio.sleep(delay)
+    
+    async def _render(self, index: int, page: str):
+        """Send or edit a single page, falling back to plain text"""
+        formatted_text = MessageFormatter.markdown_to_html(page)
+        try:
+            if index < len(self.messages):
+                await self.messages[index].edit_text(
+                    formatted_text,
+                    parse_mode=ParseMode.HTML,
+                    disable_web_page_preview=True
+                )
+                self.edits += 1
+            else:
+                message = await self.update.message.reply_text(
+                    formatted_text,
+                    parse_mode=ParseMode.HTML,
+                    disable_web_page_preview=True
+                )
+                self.messages.append(message)
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                pass
+            elif index < len(self.messages):
+                await self.messages[index].edit_text(page, disable_web_page_preview=True)
+            else:
+                self.messages.append(
+                    await self.update.message.reply_text(page, disable_web_page_preview=True)
+                )
         
-        return True
+        if index < len(self.sent_pages):
+            self.sent_pages[index] = page
+        else:
+            self.sent_pages.append(page)
 
 # Enhanced Telegram Handlers
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Enhanced start command with user statistics"""
     user = update.effective_user
-    db_manager.register_user(user)
+    await async_db.register_user(user, context.bot.id)
     
-    user_stats = db_manager.get_user_stats(user.id)
+    user_stats = await async_db.get_user_stats(context.bot.id, user.id)
     
     keyboard = [
         [InlineKeyboardButton("📊 My Statistics", callback_data="stats")],
@@ -711,6 +4694,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • `/start` - Initialize the bot and see your stats
 • `/help` - Show this help message
 • `/askai <question>` - Ask the AI a question
+• `/askai --fresh <question>` - Ask without using cached answers
 • `/reset` - Clear conversation history
 • `/stats` - View your usage statistics
 • `/settings` - Manage your preferences
@@ -749,7 +4733,7 @@ Need more help? Contact the admin or check our updates!
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user statistics"""
     user = update.effective_user
-    user_stats = db_manager.get_user_stats(user.id)
+    user_stats = await async_db.get_user_stats(context.bot.id, user.id)
     remaining_requests = rate_limiter.get_remaining_requests(user.id)
     
     stats_text = f"""
@@ -758,6 +4742,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 **Usage Stats:**
 • Total messages: {user_stats['total_messages']}
 • Average response time: {user_stats['avg_processing_time']:.2f}s
+• Tokens used: {user_stats['total_tokens']:,}
 • Last activity: {user_stats['last_message'] or 'Just now'}
 
 **Rate Limits:**
@@ -820,7 +4805,8 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     elif query.data == "reset_history":
         user = query.from_user
         chat_id = query.message.chat.id
-        if db_manager.clear_user_history(user.id, chat_id):
+        chat_tasks.cancel(context.bot.id, chat_id, user.id)
+        if await async_db.clear_user_history(context.bot.id, user.id, chat_id):
             await query.message.reply_text("🧹 Your chat history has been cleared!")
         else:
             await query.message.reply_text("⚠️ Failed to clear your history.")
@@ -848,7 +4834,8 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Reset conversation context"""
     user = update.effective_user
     chat_id = update.message.chat.id
-    if db_manager.clear_user_history(user.id, chat_id):
+    chat_tasks.cancel(context.bot.id, chat_id, user.id)
+    if await async_db.clear_user_history(context.bot.id, user.id, chat_id):
         await update.message.reply_text("🔄 Conversation context has been reset!")
     else:
         await update.message.reply_text("⚠️ Failed to reset conversation context.")
@@ -857,7 +4844,11 @@ async def ask_ai_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /askai command with enhanced processing"""
     user = update.effective_user
     chat_id = update.message.chat.id
-    question = ' '.join(context.args).strip()
+    args = list(context.args)
+    bypass_cache = bool(args) and args[0] == '--fresh'
+    if bypass_cache:
+        args = args[1:]
+    question = ' '.join(args).strip()
 
     if not question:
         await update.message.reply_text("Please provide a question after /askai command.")
@@ -880,18 +4871,19 @@ async def ask_ai_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"Admin check error: {e}")
             return
 
-    await process_ai_request(update, context, question, chat_id)
+    await process_ai_request(update, context, question, chat_id, bypass_cache=bypass_cache)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle all messages with enhanced processing"""
     message = update.message
     user = message.from_user
-    db_manager.register_user(user)
+    await async_db.register_user(user, context.bot.id)
     chat_id = message.chat.id
 
     # Register group if in a group
     if message.chat.type in ['group', 'supergroup']:
-        db_manager.register_group(
+        await async_db.register_group(
+            context.bot.id,
             message.chat.id, 
             message.chat.title,
             message.chat.type
@@ -923,9 +4915,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await process_ai_request(update, context, message.text.strip(), chat_id)
 
 async def process_ai_request(update: Update, context: ContextTypes.DEFAULT_TYPE, 
-                            question: str, chat_id: int):
+                            question: str, chat_id: int, bypass_cache: bool = False):
     """Process AI request with enhanced features"""
     user = update.effective_user
+    bot_id = context.bot.id  # every hosted bot keeps its own conversations
     start_time = time.time()
 
     # Rate limiting
@@ -937,54 +4930,215 @@ async def process_ai_request(update: Update, context: ContextTypes.DEFAULT_TYPE,
         )
         return
 
-    try:
-        # Show typing indicator
-        await context.bot.send_chat_action(
-            chat_id=update.effective_chat.id, 
-            action=ChatAction.TYPING
+    # Cheap local checks before spending an API call
+    verdict = prompt_prefilter.check(question)
+    if verdict.blocked:
+        logger.info(f"Pre-filter rejected prompt from user {user.id} ({verdict.reason})")
+        await update.message.reply_text(verdict.reply)
+        await async_db.save_message(
+            bot_id,
+            user.id,
+            chat_id,
+            question or '',
+            verdict.reply,
+            status='blocked',
+            error_message=f"prefilter: {verdict.reason}"
         )
+        return
 
-        # Get conversation history
-        history = db_manager.get_chat_history(chat_id)
-        
-        # Generate response
-        response_text = gemini_manager.generate_response(question, history)
+    streaming_reply = None
+    decision = None
+    queue_wait = None
+    result = None
+    is_leader = False
+    try:
+        # Newer requests in this chat supersede or queue behind older ones
+        async with chat_tasks.track(bot_id, chat_id, user.id):
+            # Show typing indicator
+            await context.bot.send_chat_action(
+                chat_id=update.effective_chat.id, 
+                action=ChatAction.TYPING
+            )
+
+            # Get conversation history
+            history = await async_db.get_chat_history(bot_id, chat_id)
+            
+            # Output length and sampling for this kind of request at the current load
+            decision = generation_policy.decide(update.effective_chat.type, question)
+            logger.info(f"Generation policy for chat {chat_id}: {decision.label}")
+            
+            @asynccontextmanager
+            async def generation_slot():
+                nonlocal queue_wait
+                # Wait for a generation slot, fairly shared between chats
+                lane = 'premium' if getattr(user, 'is_premium', False) else 'standard'
+                async with request_scheduler.slot((bot_id, chat_id), lane) as queue_wait:
+                    yield
+            
+            async def generate() -> GenerationResult:
+                nonlocal streaming_reply
+                # Cache misses are admitted against the project-wide Gemini quota in
+                # _run_cached, and only then take a generation slot
+                if config.stream_responses:
+                    # Stream the response into a placeholder message
+                    streaming_reply = StreamingReply(update)
+                    await streaming_reply.start()
+                    return await gemini_manager.generate_response_stream_async(
+                        question, history, streaming_reply.feed, bypass_cache=bypass_cache,
+                        settings=decision.settings, slot=generation_slot
+                    )
+                return await gemini_manager.generate_response_async(
+                    question, history, bypass_cache=bypass_cache, settings=decision.settings,
+                    slot=generation_slot
+                )
+            
+            # Identical concurrent requests share a single generation
+            flight_key = SingleFlight.make_key(
+                question, history, gemini_manager.model_name, decision.settings
+            )
+            result, is_leader = await single_flight.do(flight_key, generate)
+            response_text = result.text
+            if not is_leader:
+                logger.info(f"Coalesced request from user {user.id} onto an in-flight generation")
+            
+            # Calculate processing time
+            processing_time = time.time() - start_time
         
-        # Calculate processing time
-        processing_time = time.time() - start_time
+        # Delivered outside the tracker: the answer is complete, so a newer message or
+        # /reset arriving now can't cancel it and swap it for a "Stopped" notice
         
         # Add footer to successful responses
         if not response_text.startswith("⚠️"):
             response_text += FOOTER
         
         # Send formatted response
-        await MessageFormatter.send_formatted_message(update, response_text)
+        if streaming_reply:
+            await streaming_reply.finish(response_text)
+        else:
+            await MessageFormatter.send_formatted_message(update, response_text)
+        
+        # Token accounting; coalesced followers didn't spend any quota
+        if is_leader and result.total_tokens is None:
+            await asyncio.to_thread(gemini_manager.measure_usage, result, question, history)
+        prompt_tokens = result.prompt_tokens if is_leader else 0
+        candidate_tokens = result.candidate_tokens if is_leader else 0
+        total_tokens = result.total_tokens if is_leader else 0
+        history_tokens = getattr(history, 'token_count', 0)
+        # Size of this turn in later histories: the question counted on its own plus the
+        # reply's output tokens. Cache hits report no usage, so their reply is counted too.
+        message_tokens = result.message_tokens if is_leader else None
+        if message_tokens is None:
+            message_tokens = await asyncio.to_thread(gemini_manager.count_tokens, question)
+        reply_tokens = result.candidate_tokens
+        if not reply_tokens:
+            reply_tokens = await asyncio.to_thread(gemini_manager.count_tokens, result.text)
+        turn_tokens = message_tokens + reply_tokens
         
         # Save to DB
-        db_manager.save_message(
+        await async_db.save_message(
+            bot_id,
             user.id,
             chat_id,
             question,
             response_text,
-            tokens_used=len(response_text.split()),  # Approximate token count
+            tokens_used=total_tokens,
             processing_time=processing_time,
-            model_used=gemini_manager.model_name
+            model_used=result.model_name,
+            prompt_tokens=prompt_tokens,
+            candidate_tokens=candidate_tokens,
+            history_tokens=history_tokens if prompt_tokens else 0,
+            cost_usd=gemini_manager.estimate_cost(result.model_name, prompt_tokens, candidate_tokens),
+            generation_policy=decision.label,
+            queue_wait=queue_wait,
+            token_count=turn_tokens
+        )
+        conversation_summarizer.maybe_schedule(bot_id, chat_id)
+
+    except asyncio.CancelledError as e:
+        # Superseded by a newer message or /reset; the handler itself finishes normally
+        asyncio.current_task().uncancel()
+        reason = e.args[0] if e.args else 'cancelled'
+        logger.info(f"AI request from user {user.id} in chat {chat_id} cancelled ({reason})")
+        if streaming_reply:
+            notice = (
+                "⏹️ Stopped in favour of your newer message."
+                if reason == 'superseded'
+                else "⏹️ Stopped because the conversation was reset."
+            )
+            try:
+                await streaming_reply.abort(notice)
+            except Exception as e2:
+                logger.error(f"Failed to update cancelled reply: {e2}")
+        
+        await async_db.save_message(
+            bot_id,
+            user.id,
+            chat_id,
+            question,
+            None,
+            status='cancelled',
+            error_message=reason,
+            generation_policy=decision.label if decision else None,
+            queue_wait=queue_wait
+        )
+
+    except OverloadedError as e:
+        logger.warning(f"Turned away AI request from user {user.id} in chat {chat_id} ({e})")
+        overload_message = "🚦 I'm handling a lot of requests right now. Please try again in a minute."
+        try:
+            if streaming_reply:
+                await streaming_reply.abort(overload_message)
+            else:
+                await update.message.reply_text(overload_message)
+        except Exception as e2:
+            logger.error(f"Failed to deliver overload message: {e2}")
+        
+        await async_db.save_message(
+            bot_id,
+            user.id,
+            chat_id,
+            question,
+            None,
+            status='overloaded',
+            error_message=f"{e.component}: {e.reason}",
+            generation_policy=decision.label if decision else None,
+            queue_wait=time.time() - start_time
         )
 
     except Exception as e:
         logger.error(f"AI processing error: {e}", exc_info=True)
         error_message = f"⚠️ Sorry, I encountered an error: {str(e)}"
-        await update.message.reply_text(error_message)
+        try:
+            if streaming_reply:
+                await streaming_reply.abort(error_message)
+            else:
+                await update.message.reply_text(error_message)
+        except Exception as e2:
+            logger.error(f"Failed to deliver error message: {e2}")
         
         # Save error to DB
-        db_manager.save_message(
+        await async_db.save_message(
+            bot_id,
             user.id,
             chat_id,
             question,
             None,
             status='error',
-            error_message=str(e)
+            error_message=str(e),
+            generation_policy=decision.label if decision else None,
+            queue_wait=queue_wait
         )
+    
+    finally:
+        # Settle the leader's quota reservation whichever way the request ended
+        if is_leader and result is not None and result.admission:
+            used = result.total_tokens
+            if used is None:
+                used = getattr(history, 'token_count', 0) + GeminiManager.estimate_text_tokens(
+                    question, result.text
+                )
+            admission_controller.settle(result.admission, used)
+            result.admission = None
 
 # Set bot commands description
 async def post_init(application: Application):
@@ -1001,6 +5155,7 @@ async def post_init(application: Application):
         logger.info("Bot commands set successfully")
     except Exception as e:
         logger.error(f"Error setting bot commands: {e}")
+    logger.info(f"Startup completed in {time.time() - STARTUP_TIME:.2f}s")
 
 # Enhanced Flask Admin Interface
 app = Flask(__name__)
@@ -1235,18 +5390,6 @@ ADMIN_TEMPLATE = """
             display: inline-block;
         }
         
-        .analytics-chart {
-            height: 300px;
-            background: #f8f9fa;
-            border-radius: 5px;
-            margin-top: 20px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            font-weight: bold;
-            color: #6c757d;
-        }
-        
         .tabs {
             display: flex;
             margin-bottom: 20px;
@@ -1324,6 +5467,143 @@ ADMIN_TEMPLATE = """
         </div>
         
         <div class="tab-content active" id="dashboard">
+            <div class="section">
+                <h2 class="section-title">Generation Pool</h2>
+                <div class="stats-grid">
+                    <div class="stat-card">
+                        <div class="stat-label">In Flight</div>
+                        <div class="stat-value">{{ pool_stats.in_flight }}/{{ pool_stats.max_in_flight }}</div>
+                    </div>
+                    <div class="stat-card">
+                        <div class="stat-label">Queued (Peak)</div>
+                        <div class="stat-value">{{ pool_stats.queued }} ({{ pool_stats.peak_queued }})</div>
+                    </div>
+                    <div class="stat-card">
+                        <div class="stat-label">Avg Queue Wait</div>
+                        <div class="stat-value">{{ pool_stats.avg_queue_wait }}s</div>
+                    </div>
+                    <div class="stat-card">
+                        <div class="stat-label">Timeouts</div>
+                        <div class="stat-value">{{ pool_stats.timeouts }}</div>
+                    </div>
+                    <div class="stat-card">
+                        <div class="stat-label">Coalesced Calls Saved</div>
+                        <div class="stat-value">{{ flight_stats.saved }}</div>
+                    </div>
+                </div>
+            </div>
+            
+            <div class="section">
+                <h2 class="section-title">Request Scheduler</h2>
+                <div class="stats-grid">
+                    <div class="stat-card">
+                        <div class="stat-label">Active</div>
+                        <div class="stat-value">{{ scheduler_stats.active }}/{{ scheduler_stats.max_active }}</div>
+                    </div>
+                    <div class="stat-card">
+                        <div class="stat-label">Waiting (Peak)</div>
+                        <div class="stat-value">{{ scheduler_stats.queued }} ({{ scheduler_stats.peak_queued }})</div>
+                    </div>
+                    <div class="stat-card">
+                        <div class="stat-label">Avg Wait</div>
+                        <div class="stat-value">{{ scheduler_stats.avg_queue_wait }}s</div>
+                    </div>
+                    {% for lane, count in scheduler_stats.admitted.items() %}
+                    <div class="stat-card">
+                        <div class="stat-label">Admitted: {{ lane }}</div>
+                        <div class="stat-value">{{ count }}</div>
+                    </div>
+                    {% endfor %}
+                    {% for reason, count in scheduler_stats.rejected.items() %}
+                    <div class="stat-card">
+                        <div class="stat-label">Overloaded: {{ reason.replace('_', ' ') }}</div>
+                        <div class="stat-value">{{ count }}</div>
+                    </div>
+                    {% endfor %}
+                </div>
+            </div>
+            
+            <div class="section">
+                <h2 class="section-title">Gemini Quota Admission</h2>
+                <div class="stats-grid">
+                    <div class="stat-card">
+                        <div class="stat-label">Requests / Min</div>
+                        <div class="stat-value">{{ admission_stats.rpm }}/{{ admission_stats.rpm_limit or '∞' }}{% if admission_stats.rpm_utilization is not none %} ({{ admission_stats.rpm_utilization }}%){% endif %}</div>
+                    </div>
+                    <div class="stat-card">
+                        <div class="stat-label">Tokens / Min</div>
+                        <div class="stat-value">{{ admission_stats.tpm }}/{{ admission_stats.tpm_limit or '∞' }}{% if admission_stats.tpm_utilization is not none %} ({{ admission_stats.tpm_utilization }}%){% endif %}</div>
+                    </div>
+                    <div class="stat-card">
+                        <div class="stat-label">Delayed (Avg Wait)</div>
+                        <div class="stat-value">{{ admission_stats.delayed }} ({{ admission_stats.avg_wait }}s)</div>
+                    </div>
+                    {% for reason, count in admission_stats.shed.items() %}
+                    <div class="stat-card">
+                        <div class="stat-label">Shed: {{ reason | upper }}</div>
+                        <div class="stat-value">{{ count }}</div>
+                    </div>
+                    {% endfor %}
+                </div>
+            </div>
+            
+            <div class="section">
+                <h2 class="section-title">Prompt Pre-filter</h2>
+                <div class="stats-grid">
+                    <div class="stat-card">
+                        <div class="stat-label">API Calls Saved</div>
+                        <div class="stat-value">{{ prefilter_stats.saved }} ({{ prefilter_stats.saved_rate }}%)</div>
+                    </div>
+                    <div class="stat-card">
+                        <div class="stat-label">Prompt Tokens Saved</div>
+                        <div class="stat-value">{{ prefilter_stats.tokens_saved }}</div>
+                    </div>
+                    {% for reason, count in prefilter_stats.by_reason.items() %}
+                    <div class="stat-card">
+                        <div class="stat-label">Rejected: {{ reason.replace('_', ' ') }}</div>
+                        <div class="stat-value">{{ count }}</div>
+                    </div>
+                    {% endfor %}
+                </div>
+            </div>
+            
+            <div class="section">
+                <h2 class="section-title">API Keys</h2>
+                <div class="stats-grid">
+                    {% for key in key_stats %}
+                    <div class="stat-card">
+                        <div class="stat-label">{{ key.name }}{% if key.cooldown %} - resting{% for model, secs in key.cooldown.items() %} {{ model }} {{ secs }}s{% endfor %}{% endif %}</div>
+                        <div class="stat-value">{{ key.utilization }}%</div>
+                        <div class="message-meta">
+                            {{ key.rpm }}/{{ key.rpm_limit }} RPM | {{ key.tpm }}/{{ key.tpm_limit }} TPM | {{ key.rate_limited }} x 429
+                        </div>
+                    </div>
+                    {% endfor %}
+                </div>
+            </div>
+            
+            <div class="section">
+                <h2 class="section-title">Response Cache</h2>
+                <div class="stats-grid">
+                    <div class="stat-card">
+                        <div class="stat-label">Hit Rate</div>
+                        <div class="stat-value">{{ cache_stats.hit_rate }}%</div>
+                    </div>
+                    <div class="stat-card">
+                        <div class="stat-label">Hits (Memory / DB)</div>
+                        <div class="stat-value">{{ cache_stats.memory_hits }} / {{ cache_stats.db_hits }}</div>
+                    </div>
+                    <div class="stat-card">
+                        <div class="stat-label">Misses</div>
+                        <div class="stat-value">{{ cache_stats.misses }}</div>
+                    </div>
+                    <div class="stat-card">
+                        <div class="stat-label">Bypassed</div>
+                        <div class="stat-value">{{ cache_stats.bypassed }}</div>
+                    </div>
+                </div>
+            </div>
+            
             <div class="section">
                 <h2 class="section-title">Recent Messages</h2>
                 <div class="message-list">
@@ -1367,8 +5647,25 @@ ADMIN_TEMPLATE = """
         <div class="tab-content" id="analytics">
             <div class="section">
                 <h2 class="section-title">Analytics Overview</h2>
-                <div class="analytics-chart">
-                    Analytics Charts Will Appear Here (Integration with Chart.js would go here)
+                <div class="message-list">
+                    {% for day in daily_analytics %}
+                    <div class="message-item">
+                        <div class="message-content">
+                            <div><strong>{{ day.date }}</strong>{% if not day.closed %} (today, in progress){% endif %}</div>
+                            <div>
+                                {{ day.total_messages }} messages from {{ day.unique_users }} users
+                                | Errors: {{ day.errors }} | Cancelled: {{ day.cancelled }} | Blocked: {{ day.blocked_requests }}
+                            </div>
+                            <div class="message-meta">
+                                avg {{ "%.2f"|format(day.avg_response_time or 0) }}s
+                                | Tokens: {{ "{:,}".format(day.total_tokens or 0) }}
+                                | Est. cost: ${{ "%.2f"|format(day.cost_usd or 0) }}
+                            </div>
+                        </div>
+                    </div>
+                    {% else %}
+                    <div class="message-item">No messages yet</div>
+                    {% endfor %}
                 </div>
                 
                 <h3 style="margin-top:30px;">Key Metrics</h3>
@@ -1389,7 +5686,41 @@ ADMIN_TEMPLATE = """
                         <div class="stat-label">Avg Response</div>
                         <div class="stat-value">{{ analytics_7d.avg_response_time }}s</div>
                     </div>
+                    <div class="stat-card">
+                        <div class="stat-label">Cancelled (Superseded)</div>
+                        <div class="stat-value">{{ analytics_7d.cancelled }}</div>
+                    </div>
+                    <div class="stat-card">
+                        <div class="stat-label">7-Day Tokens</div>
+                        <div class="stat-value">{{ "{:,}".format(analytics_7d.total_tokens) }}</div>
+                    </div>
+                    <div class="stat-card">
+                        <div class="stat-label">7-Day Est. Cost</div>
+                        <div class="stat-value">${{ "%.2f"|format(analytics_7d.cost_usd) }}</div>
+                    </div>
+                </div>
+                
+                {% for title, rows in [('Token Usage by Model', usage_by_model), ('Token Usage by Bot', usage_by_bot), ('Top Chats by Tokens', usage_by_chat), ('Top Users by Tokens', usage_by_user)] %}
+                <h3 style="margin-top:30px;">{{ title }}</h3>
+                <div class="message-list">
+                    {% for row in rows %}
+                    <div class="message-item">
+                        <div class="message-content">
+                            <div><strong>{{ row.key }}</strong></div>
+                            <div>
+                                Tokens: {{ row.total_tokens or 0 }}
+                                (prompt {{ row.prompt_tokens or 0 }}, output {{ row.candidate_tokens or 0 }})
+                                | History share: {{ row.history_share }}%
+                                | Est. cost: ${{ row.cost_usd }}
+                            </div>
+                            <div class="message-meta">
+                                {{ row.messages }} messages | avg {{ row.avg_processing_time }}s
+                            </div>
+                        </div>
+                    </div>
+                    {% endfor %}
                 </div>
+                {% endfor %}
             </div>
         </div>
         
@@ -1440,6 +5771,13 @@ ADMIN_TEMPLATE = """
 
 @app.route('/')
 def admin_dashboard():
+    # Get 7-day analytics (also brings the daily rollups up to date)
+    analytics_7d = db_manager.get_analytics(7)
+    analytics_7d['error_rate'] = round(
+        (analytics_7d['errors'] / max(1, analytics_7d['total_messages'])) * 100, 1
+    ) if analytics_7d['total_messages'] > 0 else 0
+    analytics_7d['avg_response_time'] = round(analytics_7d['avg_processing_time'], 2)
+    
     conn = db_manager.get_connection()
     cursor = conn.cursor()
     
@@ -1450,10 +5788,11 @@ def admin_dashboard():
     cursor.execute('SELECT COUNT(*) FROM groups WHERE is_active = 1')
     group_count = cursor.fetchone()[0]
     
-    cursor.execute('SELECT COUNT(*) FROM messages WHERE DATE(timestamp) = DATE("now")')
-    messages_today = cursor.fetchone()[0]
+    cursor.execute("SELECT total_messages FROM analytics WHERE date = DATE('now')")
+    row = cursor.fetchone()
+    messages_today = row[0] if row else 0
     
-    cursor.execute('SELECT AVG(processing_time) FROM messages WHERE processing_time > 0')
+    cursor.execute('SELECT SUM(response_time_total) / MAX(1, SUM(responses)) FROM analytics')
     avg_response_time = round(cursor.fetchone()[0] or 0, 2)
     
     # Get recent messages
@@ -1467,19 +5806,12 @@ def admin_dashboard():
     ''')
     recent_messages = [dict(row) for row in cursor.fetchall()]
     
-    # Get 7-day analytics
-    analytics_7d = db_manager.get_analytics(7)
-    analytics_7d['error_rate'] = round(
-        (analytics_7d['errors'] / max(1, analytics_7d['total_messages'])) * 100, 1
-    ) if analytics_7d['total_messages'] > 0 else 0
-    analytics_7d['avg_response_time'] = round(analytics_7d['avg_processing_time'], 2)
-    
     # Get top users
     cursor.execute('''
-        SELECT u.user_id, u.username, COUNT(m.id) as message_count, MAX(m.timestamp) as last_active
-        FROM users u
-        LEFT JOIN messages m ON u.user_id = m.user_id
-        GROUP BY u.user_id
+        SELECT a.user_id, u.username, SUM(a.messages) as message_count, MAX(a.last_message) as last_active
+        FROM analytics_users a
+        LEFT JOIN users u ON u.user_id = a.user_id
+        GROUP BY a.user_id
         ORDER BY message_count DESC
         LIMIT 10
     ''')
@@ -1494,29 +5826,69 @@ def admin_dashboard():
         avg_response_time=avg_response_time,
         recent_messages=recent_messages,
         analytics_7d=analytics_7d,
-        top_users=top_users
+        daily_analytics=db_manager.get_daily_analytics(7),
+        top_users=top_users,
+        usage_by_model=db_manager.get_usage_rollup('model_used'),
+        usage_by_bot=db_manager.get_usage_rollup('bot_id'),
+        usage_by_chat=db_manager.get_usage_rollup('chat_id'),
+        usage_by_user=db_manager.get_usage_rollup('user_id'),
+        pool_stats=gemini_manager.pool.get_stats(),
+        scheduler_stats=request_scheduler.get_stats(),
+        admission_stats=admission_controller.get_stats(),
+        key_stats=gemini_manager.key_pool.get_stats(),
+        prefilter_stats=prompt_prefilter.get_stats(),
+        cache_stats=response_cache.get_stats(),
+        flight_stats=single_flight.get_stats()
     )
 
+@app.route('/metrics')
+def metrics():
+    """Runtime performance metrics as JSON"""
+    return jsonify({
+        'generation_pool': gemini_manager.pool.get_stats(),
+        'request_scheduler': request_scheduler.get_stats(),
+        'admission': admission_controller.get_stats(),
+        'response_cache': response_cache.get_stats(),
+        'semantic_cache': semantic_cache.get_stats() if semantic_cache else None,
+        'history_buffer': history_buffer.get_stats(),
+        'db_pool': db_manager.pool.get_stats() if db_manager.pool else None,
+        'async_db': async_db.get_stats(),
+        'write_behind': db_manager.writes.get_stats() if db_manager.writes else None,
+        'activity': db_manager.activity.get_stats(),
+        'single_flight': single_flight.get_stats(),
+        'chat_tasks': chat_tasks.get_stats(),
+        'api_keys': gemini_manager.key_pool.get_stats(),
+        'context_cache': gemini_manager.context_cache.get_stats(),
+        'generation_policy': generation_policy.get_stats(),
+        'prefilter': prompt_prefilter.get_stats(),
+        'models': gemini_manager.router.get_stats(),
+        'usage_by_model': db_manager.get_usage_rollup('model_used', days=1)
+    })
+
 @app.route('/broadcast', methods=['POST'])
 def broadcast():
     message = request.form.get('message').strip()
     if not message:
         return jsonify({'error': 'Message cannot be empty'}), 400
 
-    conn = db_manager.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id FROM users')
-    user_ids = [row[0] for row in cursor.fetchall()]
-    conn.close()
+    # Each hosted bot can only message the users who started it
+    audiences = [
+        (token, db_manager.get_bot_user_ids(bot_id_from_token(token)))
+        for token in config.telegram_tokens
+    ]
 
     # Run broadcast in a separate thread
     def run_broadcast():
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        bot = Bot(token=config.telegram_token)
-        result = loop.run_until_complete(async_broadcast(bot, user_ids, message))
+        success, failures = 0, 0
+        for token, user_ids in audiences:
+            bot = Bot(token=token)
+            sent, failed = loop.run_until_complete(async_broadcast(bot, user_ids, message))
+            success += sent
+            failures += failed
         loop.close()
-        return result
+        return success, failures
 
     try:
         with ThreadPoolExecutor() as executor:
@@ -1574,9 +5946,14 @@ def backup_database():
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             backup_path = backup_dir / f"backup_{timestamp}.db"
             
-            # Copy database
-            with open(config.db_name, 'rb') as src, open(backup_path, 'wb') as dst:
-                dst.write(src.read())
+            # Copy database with SQLite's online backup, which includes pages still in the WAL
+            src = db_manager.get_connection()
+            dst = sqlite3.connect(backup_path)
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+                src.close()
             
             logger.info(f"Database backup created: {backup_path}")
             
@@ -1593,6 +5970,19 @@ def backup_database():
         # Wait until next backup
         time.sleep(config.backup_interval)
 
+# Daily Analytics Rollups
+def roll_up_analytics():
+    """Regularly fold new messages into the daily analytics tables"""
+    while True:
+        try:
+            folded = db_manager.update_analytics()
+            if folded:
+                logger.debug(f"Rolled up {folded} messages into daily analytics")
+        except Exception as e:
+            logger.error(f"Analytics rollup failed: {e}")
+        
+        time.sleep(config.analytics_rollup_interval)
+
 # Log Rotation System
 def rotate_logs():
     """Regular log rotation function"""
@@ -1626,30 +6016,82 @@ def rotate_logs():
 def run_flask():
     app.run(host=config.flask_host, port=config.flask_port, use_reloader=False)
 
-def main():
-    # Validate token format
-    try:
-        test_bot = Bot(token=config.telegram_token)
-        asyncio.get_event_loop().run_until_complete(test_bot.get_me())
-        logger.info("Telegram token validated successfully")
-    except InvalidToken as e:
-        logger.error("Invalid Telegram token! Please check your .env file")
-        return
-    except Exception as e:
-        logger.error("Error validating Telegram token: %s", e)
-        return
+# Offline load testing
+class LoadTestMessage:
+    """Minimal stand-in for telegram.Message that records nothing"""
+    def __init__(self, chat, user, text: str = ''):
+        self.chat = chat
+        self.from_user = user
+        self.text = text
+    
+    async def reply_text(self, text: str, **kwargs):
+        return LoadTestMessage(self.chat, self.from_user, text)
+    
+    async def edit_text(self, text: str, **kwargs):
+        self.text = text
+        return self
+    
+    async def delete(self):
+        return True
 
-    # Start maintenance threads
-    threading.Thread(target=backup_database, daemon=True).start()
-    threading.Thread(target=rotate_logs, daemon=True).start()
+class LoadTestBot:
+    def __init__(self, bot_id: int):
+        self.id = bot_id
+        self.username = f'loadtest_bot_{bot_id}'
     
-    # Start Flask in a separate thread
-    threading.Thread(target=run_flask, daemon=True).start()
+    async def send_chat_action(self, **kwargs):
+        return True
+
+async def run_load_test(total: int, concurrency: int, chats: int, bots: int = 1):
+    """Drive process_ai_request end to end against the configured backend"""
+    contexts = [SimpleNamespace(bot=LoadTestBot(bot_id)) for bot_id in range(1, bots + 1)]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+    
+    async def one(i: int):
+        nonlocal failures
+        user = SimpleNamespace(id=10_000_000 + i, username=f'load{i}', first_name='Load', last_name='Test')
+        chat = SimpleNamespace(id=20_000_000 + i % chats, type='private', title=None)
+        question = f"Load test question {i}: explain topic {i % 50}"
+        update = SimpleNamespace(
+            message=LoadTestMessage(chat, user, question),
+            effective_user=user,
+            effective_chat=chat
+        )
+        context = contexts[i % bots]
+        async with semaphore:
+            started = time.time()
+            try:
+                await process_ai_request(update, context, question, chat.id)
+            except Exception as e:
+                failures += 1
+                logger.error(f"Load test request {i} failed: {e}")
+            latencies.append(time.time() - started)
+    
+    started = time.time()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.time() - started
+    await async_db.flush_all()
+    
+    latencies.sort()
+    def percentile(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+    
+    print(f"Backend:     {gemini_manager.backend.name}")
+    print(f"Requests:    {total} ({concurrency} concurrent, {chats} chats, {bots} bots)")
+    print(f"Failures:    {failures}")
+    print(f"Elapsed:     {elapsed:.2f}s ({total / elapsed:.1f} req/s)")
+    print(f"Latency p50: {percentile(0.50):.3f}s  p95: {percentile(0.95):.3f}s  p99: {percentile(0.99):.3f}s")
+    print(f"Pool:        {gemini_manager.pool.get_stats()}")
+    print(f"Models:      {gemini_manager.router.get_stats()}")
 
-    # Create Telegram Application
+def build_application(token: str) -> Application:
+    """Telegram Application for one hosted bot; all bots share the AI and DB layers"""
     application = Application.builder() \
-        .token(config.telegram_token) \
+        .token(token) \
         .post_init(post_init) \
+        .concurrent_updates(config.max_concurrent_updates) \
         .build()
 
     # Add handlers
@@ -1661,13 +6103,75 @@ def main():
     application.add_handler(CommandHandler("settings", settings_command))
     application.add_handler(CallbackQueryHandler(handle_callback_query))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
 
-    # Start polling
-    logger.info("Bot is running...")
-    application.run_polling(
-        allowed_updates=Update.ALL_TYPES,
-        close_loop=False
-    )
+async def run_bots(tokens: List[str]):
+    """Poll every hosted bot on one event loop until SIGINT/SIGTERM"""
+    running = []
+    for token in tokens:
+        application = build_application(token)
+        try:
+            # initialize() calls getMe, so bad tokens fail here
+            await application.initialize()
+        except InvalidToken:
+            logger.error(f"Invalid Telegram token for bot {bot_id_from_token(token)}, skipping it")
+            continue
+        except Exception as e:
+            logger.error(f"Error validating Telegram token for bot {bot_id_from_token(token)}: {e}")
+            continue
+        await post_init(application)
+        await application.start()
+        await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        running.append(application)
+        logger.info(f"Bot @{application.bot.username} ({application.bot.id}) is running...")
+
+    if not running:
+        logger.error("No valid Telegram token! Please check your .env file")
+        return
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    logger.info("Shutting down bots...")
+    for application in running:
+        try:
+            await application.updater.stop()
+            await application.stop()
+            await application.shutdown()
+        except Exception as e:
+            logger.error(f"Error stopping bot {application.bot.id}: {e}")
+    await async_db.flush_all()
+
+def main():
+    tokens = config.telegram_tokens
+    
+    # Conversations stored before multi-bot hosting belong to the first bot
+    db_manager.adopt_legacy_rows(bot_id_from_token(tokens[0]))
+
+    # Start maintenance threads
+    threading.Thread(target=backup_database, daemon=True).start()
+    threading.Thread(target=roll_up_analytics, daemon=True).start()
+    threading.Thread(target=rotate_logs, daemon=True).start()
+    
+    # Start Flask in a separate thread
+    threading.Thread(target=run_flask, daemon=True).start()
+
+    logger.info(f"Hosting {len(tokens)} bot(s)")
+    asyncio.run(run_bots(tokens))
 
 if __name__ == '__main__':
-    main()
+    if LOAD_TEST_MODE:
+        import argparse
+        parser = argparse.ArgumentParser(description="Run the AI pipeline without Telegram")
+        parser.add_argument('--loadtest', action='store_true')
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--chats', type=int, default=100)
+        parser.add_argument('--bots', type=int, default=1)
+        args = parser.parse_args()
+        asyncio.run(run_load_test(args.requests, args.concurrency, args.chats, args.bots))
+    else:
+        main()